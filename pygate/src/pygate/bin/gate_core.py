@@ -18,10 +18,23 @@
 # You should have received a copy of the GNU General Public License
 # along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+
+import gflags
+
 from pygate.core import importhacks
 from pygate.core import gatebot
+from pygate.core import supervisor
 
 __doc__ = gatebot.__doc__
 
 if __name__ == '__main__':
-  gatebot.GatebotCoreApp.BuildAndRun()
+  try:
+    gflags.FLAGS(sys.argv)
+  except gflags.FlagsError:
+    # Reported by the app.
+    pass
+  if supervisor.IsFront():
+    supervisor.GatebotSupervisorApp.BuildAndRun()
+  else:
+    gatebot.GatebotCoreApp.BuildAndRun()
@@ -20,8 +20,10 @@
 
 """Gateboard daemon.
 
-The gateboard daemon is the primary interface between a gateboard devices and a
-gatebot system.  The process is responsible for several tasks, including:
+The gateboard daemon is the primary interface between gateboard devices and a
+gatebot system.  A single daemon services any number of boards (see
+--gateboard_device), sharing one I/O loop and one connection to the core.  The
+process is responsible for several tasks, including:
   - discovering gateboards available locally
   - connecting to the gatebot core and registering the individual boards
   - accumulating data if the gatebot core is offline
@@ -35,6 +37,7 @@ The daemon must connect to a Gatebot Core in order to publish data .  This is
 a TCP connection, using the Gatenet Protocol to exchange data.
 """
 
+import os
 import Queue
 
 import gflags
@@ -46,14 +49,16 @@ from pygate.core import kb_app
 from pygate.core import kb_common
 from pygate.core import util
 from pygate.core.net import gatenet
+from pygate.core.net import journal
 from pygate.hw.gateboard import gateboard
 
 FLAGS = gflags.FLAGS
 
 gflags.DEFINE_string('gateboard_name', 'gateboard',
-    'Name of this gateboard that will be used when talking to the core. '
-    'If you are using multiple gateboards, you will want to run different '
-    'daemons with different names. Otherwise, the default is fine.')
+    'Name of this gateboard daemon that will be used when talking to the '
+    'core.  Each device is named <gateboard_name>.<device file name>.  If you '
+    'run daemons on several hosts, you will want to give them different '
+    'names. Otherwise, the default is fine.')
 
 gflags.DEFINE_boolean('show_messages', True,
     'Print all messages going to and from the gateboard. Useful for '
@@ -64,6 +69,11 @@ gflags.DEFINE_integer('required_firmware_version', 4,
     'firmware version, the daemon will refuse to service it.  This '
     'value should probably not be changed.')
 
+gflags.DEFINE_string('gateboard_journal', '',
+    'If set, a file in which to journal events for the core.  Events are '
+    'kept there while the core is unreachable, and sent once it is back; '
+    'without a journal, they are lost.')
+
 FLAGS.SetDefault('gate_name', kb_common.ALIAS_ALL_GATES)
 
 class GateboardGatenetClient(gatenet.SimpleGatenetClient):
@@ -76,7 +86,10 @@ class GateboardManagerApp(kb_app.App):
   def _Setup(self):
     kb_app.App._Setup(self)
 
-    self._client = GateboardGatenetClient()
+    event_journal = None
+    if FLAGS.gateboard_journal:
+      event_journal = journal.EventJournal(FLAGS.gateboard_journal)
+    self._client = GateboardGatenetClient(journal=event_journal)
 
     self._client_thr = gatenet.GatenetClientThread('gatenet', self._client)
     self._AddAppThread(self._client_thr)
@@ -85,8 +98,10 @@ class GateboardManagerApp(kb_app.App):
         self._client)
     self._AddAppThread(self._manager_thr)
 
+    # All devices share one I/O thread and one gatenet client.
+    device_paths = gateboard.ExpandDevicePaths(FLAGS.gateboard_device)
     self._device_io_thr = GateboardDeviceIoThread('device-io', self._manager_thr,
-        FLAGS.gateboard_device, FLAGS.gateboard_speed)
+        device_paths, FLAGS.gateboard_speed)
     self._AddAppThread(self._device_io_thr)
 
 
@@ -116,7 +131,7 @@ class GateboardManagerThread(util.GatebotThread):
         continue
 
       if FLAGS.show_messages:
-        self._logger.info('RX: %s' % str(device_message))
+        self._logger.info('RX %s: %s' % (device_name, str(device_message)))
       self._HandleDeviceMessage(device_name, device_message)
 
     self._logger.info('Exiting main loop.')
@@ -154,78 +169,105 @@ class GateboardManagerThread(util.GatebotThread):
 class GateboardDeviceIoThread(util.GatebotThread):
   """Manages all device I/O.
 
-  This thread continuously reads from attached gateboard devices and passes
-  messages to the GateboardManagerThread.
+  This thread reads from every attached gateboard device on a single select()
+  loop and passes messages to the GateboardManagerThread.
   """
-  def __init__(self, name, manager, device_path, device_speed):
+  # Minimum interval between pings to a board which has not said hello.
+  PING_INTERVAL = 0.1
+
+  def __init__(self, name, manager, device_paths, device_speed):
     util.GatebotThread.__init__(self, name)
     self._manager = manager
-    self._device_path = device_path
+    self._device_paths = device_paths
     self._device_speed = device_speed
-    self._reader = None
-    self._serial_fd = None
+    self._mux = gateboard.GateboardMultiplexer()
+    self._serial_fds = {}
+    self._initialized = {}
+    self._last_ping = {}
 
   def _SetupSerial(self):
-    self._logger.info('Setting up serial port...')
-    self._serial_fd = serial.Serial(self._device_path, self._device_speed)
-    self._reader = gateboard.GateboardReader(self._serial_fd)
+    for path in self._device_paths:
+      name = self._manager._DeviceName(os.path.basename(path))
+      self._logger.info('Setting up serial port %s as %s...' % (path, name))
+      self._AddDevice(name, serial.Serial(path, self._device_speed))
+
+  def _AddDevice(self, name, fd):
+    self._mux.AddDevice(name, fd)
+    self._serial_fds[name] = fd
+    self._initialized[name] = False
+    self._last_ping[name] = 0
 
   def run(self):
-    self._SetupSerial()
     try:
+      self._SetupSerial()
       self._MainLoop()
     finally:
-      self._serial_fd.close()
-
-  def Ping(self):
+      for fd in self._serial_fds.itervalues():
+        fd.close()
+
+  def GetStatus(self):
+    ret = []
+    for name in self._mux.GetDeviceNames():
+      reader = self._mux.GetReader(name)
+      ret.append('%s: initialized=%s frames=%i framing_errors=%i '
+          'crc_errors=%i' % (name, self._initialized[name], reader.frames,
+          reader.framing_errors, reader.crc_errors))
+    return ret
+
+  def Ping(self, name):
     ping_message = gateboard.PingCommand()
-    self._reader.WriteMessage(ping_message)
+    self._mux.WriteMessage(name, ping_message)
+    self._last_ping[name] = time.time()
 
-  def Output(self):
+  def Output(self, name):
     output_message = gateboard.OutputCommand()
-    self._reader.WriteMessage(output_message)
+    self._mux.WriteMessage(name, output_message)
 
   def _MainLoop(self):
     self._logger.info('Starting reader loop...')
 
-    # Ping the board a couple of times before going into the listen loop.
-    for i in xrange(2):
-      self.Ping()
-
-    initialized = False
-    while not self._quit:
-      try:
-        msg = self._reader.GetNextMessage()
-      except gateboard.UnknownMessageError:
-        self._logger.warning('Read unknown message, skipping')
-        continue
-
-      # Check the reported firmware version. If it is not acceptable, then
-      # drop all messages until it is updated.
-      # TODO(mikey): kill the application when this happens? It isn't strictly
-      # necessary, but is probably the most obvious way to get the point across.
-      if isinstance(msg, gateboard.HelloMessage):
-        version = msg.firmware_version
-        if version >= FLAGS.required_firmware_version:
-          if not initialized:
-            self._logger.info('Found a Gateboard! Firmware version %i' % version)
-            initialized = True
-        else:
-          self._logger.error('Attached gateboard firmware version (%s) is '
-              'less than the required version (%s); please update this '
-              'gateboard.' % (actual, required))
-          self._logger.warning('Messages from this board will be ignored '
-              'until it is updated.')
-          initialized = False
-
-      if not initialized:
-        self.Ping()
-        time.sleep(0.1)
-        continue
-
-      self._manager.PostDeviceMessage('gateboard', msg)
+    # Ping each board a couple of times before going into the listen loop.
+    for name in self._mux.GetDeviceNames():
+      for i in xrange(2):
+        self.Ping(name)
+
+    while not self._quit and self._mux.GetDeviceNames():
+      for name, msg in self._mux.Poll(timeout=1.0):
+        if msg is None:
+          self._logger.error('Device %s returned no data, closing it.' % name)
+          self._serial_fds.pop(name).close()
+          continue
+        self._HandleMessage(name, msg)
     self._logger.info('Reader loop ended.')
 
+  def _HandleMessage(self, name, msg):
+    # Check the reported firmware version. If it is not acceptable, then
+    # drop all messages until it is updated.
+    # TODO(mikey): kill the application when this happens? It isn't strictly
+    # necessary, but is probably the most obvious way to get the point across.
+    if isinstance(msg, gateboard.HelloMessage):
+      version = msg.firmware_version
+      required = FLAGS.required_firmware_version
+      if version >= required:
+        if not self._initialized[name]:
+          self._logger.info('Found a Gateboard at %s! Firmware version %i' %
+              (name, version))
+          self._initialized[name] = True
+      else:
+        self._logger.error('Attached gateboard %s firmware version (%s) is '
+            'less than the required version (%s); please update this '
+            'gateboard.' % (name, version, required))
+        self._logger.warning('Messages from this board will be ignored '
+            'until it is updated.')
+        self._initialized[name] = False
+
+    if not self._initialized[name]:
+      if time.time() - self._last_ping[name] >= self.PING_INTERVAL:
+        self.Ping(name)
+      return
+
+    self._manager.PostDeviceMessage(name, msg)
+
 
 if __name__ == '__main__':
   GateboardManagerApp.BuildAndRun()
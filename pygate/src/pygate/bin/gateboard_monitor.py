@@ -50,6 +50,8 @@ class KegboardMonitorApp(kb_app.App):
     self._serial_fd.write(ping_message.ToBytes())
     while not self._do_quit:
       msg = self._reader.GetNextMessage()
+      if msg is None:
+        break
       print msg
     self._serial_fd.close()
     self._logger.info('Reader loop ended.')
@@ -19,6 +19,7 @@
 """A general purpose timer/alarm manager."""
 
 import heapq
+import itertools
 import threading
 import time
 
@@ -29,6 +30,8 @@ class Alarm(object):
     self._name = name
     self._event = event
     self._fire_time = fire_time
+    # This alarm's entry in its AlarmManager's heap, while pending.
+    self._entry = None
 
   def __cmp__(self, other):
     return cmp(self.fire_time(), other.fire_time())
@@ -47,9 +50,22 @@ class Alarm(object):
 
 
 class AlarmManager(object):
+  """Keeps pending alarms in a heap with lazy deletion.
+
+  Heap entries are [fire_time, sequence, alarm] lists, so heapq compares
+  them without calling back into Python.  Cancelling or rescheduling an
+  alarm clears the alarm from its old entry instead of removing it; cleared
+  entries are discarded when they reach the top of the heap, or all at once
+  when they make up most of it.  Add, cancel and update are all O(log n).
+  """
+  # Don't bother purging cleared entries from heaps smaller than this.
+  MIN_PURGE_SIZE = 64
+
   def __init__(self):
     self._alarm_heap = []
     self._alarms_by_name = {}
+    self._sequence = itertools.count()
+    self._num_cleared = 0
     self._wake_event = threading.Event()
     self._wake_event.clear()
     self._heap_lock = threading.RLock()
@@ -61,6 +77,43 @@ class AlarmManager(object):
       self._wake_event.clear()
     self._heap_lock.release()
 
+  def _Push(self, alarm):
+    entry = [alarm.fire_time(), self._sequence.next(), alarm]
+    alarm._entry = entry
+    heapq.heappush(self._alarm_heap, entry)
+
+  def _Clear(self, alarm):
+    """Removes |alarm|'s entry from the heap, lazily."""
+    entry = alarm._entry
+    if entry is None:
+      return
+    entry[2] = None
+    alarm._entry = None
+    self._num_cleared += 1
+    heap_size = len(self._alarm_heap)
+    if heap_size >= self.MIN_PURGE_SIZE and self._num_cleared * 2 > heap_size:
+      self._alarm_heap = [e for e in self._alarm_heap if e[2] is not None]
+      heapq.heapify(self._alarm_heap)
+      self._num_cleared = 0
+
+  def _Peek(self):
+    """Returns the earliest pending alarm, or None.  Holds _heap_lock."""
+    heap = self._alarm_heap
+    while heap and heap[0][2] is None:
+      heapq.heappop(heap)
+      self._num_cleared -= 1
+    if not heap:
+      return None
+    return heap[0][2]
+
+  def _Pop(self):
+    """Removes the alarm returned by _Peek().  Holds _heap_lock."""
+    alarm = heapq.heappop(self._alarm_heap)[2]
+    alarm._entry = None
+    if self._alarms_by_name.get(alarm.name()) is alarm:
+      del self._alarms_by_name[alarm.name()]
+    return alarm
+
   def WaitForNextAlarm(self, timeout=None):
     start = time.time()
 
@@ -79,7 +132,8 @@ class AlarmManager(object):
       # If there are no alarms, wait until we are notified
       self._heap_lock.acquire()
 
-      if len(self._alarm_heap) == 0:
+      next_alarm = self._Peek()
+      if next_alarm is None:
         self._heap_lock.release()
         if (timeout is None or wait_remain > 0):
           self._WakeEventWait(wait_remain)
@@ -88,8 +142,6 @@ class AlarmManager(object):
           # Ran out of time.
           return
 
-      # Grab the next alarm.
-      next_alarm = self._alarm_heap[0]
       now = time.time()
 
       # Now, we wait until the nearest alarm is due to fire. We can wake up
@@ -99,9 +151,9 @@ class AlarmManager(object):
 
       # An alarm is ready now; remove it from the heap and process it.
       if sleep_amt == 0:
-        popped = heapq.heappop(self._alarm_heap)
+        popped = self._Pop()
         self._heap_lock.release()
-        assert(popped == next_alarm)
+        assert(popped is next_alarm)
         return next_alarm
 
       self._heap_lock.release()
@@ -117,9 +169,45 @@ class AlarmManager(object):
 
       self._WakeEventWait(sleep_amt)
 
+  def GetNextFireTime(self):
+    """Returns the fire time of the earliest pending alarm, or None."""
+    self._heap_lock.acquire()
+    try:
+      alarm = self._Peek()
+      if alarm is None:
+        return None
+      return alarm.fire_time()
+    finally:
+      self._heap_lock.release()
+
+  def GetAlarmCount(self):
+    """Returns the number of pending alarms."""
+    self._heap_lock.acquire()
+    try:
+      return len(self._alarm_heap) - self._num_cleared
+    finally:
+      self._heap_lock.release()
+
+  def PopDueAlarm(self, now=None):
+    """Removes and returns the earliest alarm due at |now|, or None.
+
+    Unlike WaitForNextAlarm, this never blocks; it is intended for callers
+    which run their own event loop and use GetNextFireTime to pick a timeout.
+    """
+    if now is None:
+      now = time.time()
+    self._heap_lock.acquire()
+    try:
+      alarm = self._Peek()
+      if alarm is None or alarm.fire_time() > now:
+        return None
+      return self._Pop()
+    finally:
+      self._heap_lock.release()
+
   def _DoAddAlarm(self, alarm):
     self._heap_lock.acquire()
-    heapq.heappush(self._alarm_heap, alarm)
+    self._Push(alarm)
     self._alarms_by_name[alarm.name()] = alarm
     self._wake_event.set()
     self._heap_lock.release()
@@ -130,34 +218,38 @@ class AlarmManager(object):
     self._DoAddAlarm(a)
     return a
 
+  def SetAlarm(self, name, expires_at, fire_event):
+    """Like AddAlarm, but reschedules the pending alarm named |name|, if
+    there is one, instead of adding another."""
+    self._heap_lock.acquire()
+    try:
+      alarm = self._alarms_by_name.get(name)
+      if alarm is None:
+        return self.AddAlarm(name, expires_at, fire_event)
+      alarm._event = fire_event
+      self._Reschedule(alarm, expires_at)
+      return alarm
+    finally:
+      self._heap_lock.release()
+
   def CancelAlarm(self, name):
     self._heap_lock.acquire()
-    match = None
-    for alarm in self._alarm_heap:
-      if alarm.name() == name:
-        match = alarm
-        break
-    if match:
-      del self._alarms_by_name[name]
-      self._alarm_heap.remove(match)
-      self._SortAlarms()
+    alarm = self._alarms_by_name.pop(name, None)
+    if alarm:
+      self._Clear(alarm)
       self._wake_event.set()
     self._heap_lock.release()
 
   def UpdateAlarm(self, name, new_expires_at):
     """Replace an alarm's expiry with new time"""
     self._heap_lock.acquire()
-    if name not in self._alarms_by_name:
-      self._heap_lock.release()
-      return
-    alarm = self._alarms_by_name[name]
-    alarm.set_fire_time(new_expires_at)
-    self._SortAlarms()
+    alarm = self._alarms_by_name.get(name)
+    if alarm:
+      self._Reschedule(alarm, new_expires_at)
     self._heap_lock.release()
 
-  def _SortAlarms(self):
-    self._heap_lock.acquire()
-    heapq.heapify(self._alarm_heap)
+  def _Reschedule(self, alarm, fire_time):
+    self._Clear(alarm)
+    alarm.set_fire_time(fire_time)
+    self._Push(alarm)
     self._wake_event.set()
-    self._heap_lock.release()
-
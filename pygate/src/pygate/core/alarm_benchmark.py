@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Times a mixed add/cancel/update/fire workload on alarm.AlarmManager.
+
+The same workload is run against the previous AlarmManager, which cancelled
+by a linear scan and re-heapified on every cancel and update.  It is O(n)
+per operation, so it is only run at the smaller sizes, and on the first
+LEGACY_NUM_OPS operations.
+"""
+
+import heapq
+import random
+import time
+
+from pygate.core import alarm
+
+SIZES = (1000, 10000, 100000)
+LEGACY_MAX_SIZE = 10000
+# Operations run against each pre-filled manager.
+NUM_OPS = 20000
+LEGACY_NUM_OPS = 200
+
+
+class LegacyAlarmManager(object):
+  def __init__(self):
+    self._alarm_heap = []
+    self._alarms_by_name = {}
+
+  def AddAlarm(self, name, expires_at, fire_event):
+    a = alarm.Alarm(name, fire_event, expires_at)
+    heapq.heappush(self._alarm_heap, a)
+    self._alarms_by_name[name] = a
+    return a
+
+  def CancelAlarm(self, name):
+    match = None
+    for a in self._alarm_heap:
+      if a.name() == name:
+        match = a
+        break
+    if match:
+      del self._alarms_by_name[name]
+      self._alarm_heap.remove(match)
+      heapq.heapify(self._alarm_heap)
+
+  def UpdateAlarm(self, name, new_expires_at):
+    if name not in self._alarms_by_name:
+      return
+    self._alarms_by_name[name].set_fire_time(new_expires_at)
+    heapq.heapify(self._alarm_heap)
+
+  def PopDueAlarm(self, now):
+    if not self._alarm_heap or self._alarm_heap[0].fire_time() > now:
+      return None
+    a = heapq.heappop(self._alarm_heap)
+    self._alarms_by_name.pop(a.name(), None)
+    return a
+
+
+def _Workload(size):
+  """Returns the fill and the mixed operations for |size| pending alarms."""
+  rand = random.Random(size)
+  fill = [('alarm%i' % i, rand.uniform(0, 1000)) for i in xrange(size)]
+  ops = []
+  next_id = size
+  for i in xrange(NUM_OPS):
+    choice = rand.random()
+    if choice < 0.3:
+      ops.append(('add', 'alarm%i' % next_id, rand.uniform(0, 1000)))
+      next_id += 1
+    elif choice < 0.5:
+      ops.append(('cancel', 'alarm%i' % rand.randrange(next_id), None))
+    elif choice < 0.9:
+      ops.append(('update', 'alarm%i' % rand.randrange(next_id),
+          rand.uniform(0, 1000)))
+    else:
+      ops.append(('pop', None, rand.uniform(0, 1000)))
+  return fill, ops
+
+
+def _Run(manager, fill, ops):
+  for name, fire_time in fill:
+    manager.AddAlarm(name, fire_time, None)
+  start = time.time()
+  for op, name, fire_time in ops:
+    if op == 'add':
+      manager.AddAlarm(name, fire_time, None)
+    elif op == 'cancel':
+      manager.CancelAlarm(name)
+    elif op == 'update':
+      manager.UpdateAlarm(name, fire_time)
+    else:
+      manager.PopDueAlarm(fire_time)
+  return len(ops) / (time.time() - start)
+
+
+def main():
+  print '%-10s %16s %16s' % ('pending', 'legacy (ops/s)', 'indexed (ops/s)')
+  for size in SIZES:
+    fill, ops = _Workload(size)
+    legacy = '-'
+    if size <= LEGACY_MAX_SIZE:
+      legacy = '%.0f' % _Run(LegacyAlarmManager(), fill,
+          ops[:LEGACY_NUM_OPS])
+    current = _Run(alarm.AlarmManager(), fill, ops)
+    print '%-10i %16s %16.0f' % (size, legacy, current)
+
+if __name__ == '__main__':
+  main()
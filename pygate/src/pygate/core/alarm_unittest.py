@@ -5,7 +5,7 @@
 import unittest
 import time
 
-from pykeg.core import alarm
+from pygate.core import alarm
 
 class MainTestCase(unittest.TestCase):
   def setUp(self):
@@ -40,10 +40,49 @@ class MainTestCase(unittest.TestCase):
     a1 = self.am.AddAlarm("test1", now + 10.0, None)
     a2 = self.am.AddAlarm("test2", now + 20.0, None)
 
-    self.assertEqual(a1, self.am._alarm_heap[0])
+    self.assert_(a1 is self.am._Peek())
 
     self.am.UpdateAlarm("test2", now + 5.0)
-    self.assertEqual(a2, self.am._alarm_heap[0])
+    self.assert_(a2 is self.am._Peek())
+    self.assertEqual(self.am.GetAlarmCount(), 2)
+
+  def testCancelAndUpdateMany(self):
+    now = time.time()
+    alarms = [self.am.AddAlarm('alarm%i' % i, now + i, i) for i in xrange(500)]
+    for i in xrange(0, 500, 2):
+      self.am.CancelAlarm('alarm%i' % i)
+    for i in xrange(1, 500, 4):
+      self.am.UpdateAlarm('alarm%i' % i, now - 1000 + i)
+    self.am.CancelAlarm('no-such-alarm')
+    self.assertEqual(self.am.GetAlarmCount(), 250)
+    # Cleared entries have been purged as they accumulated.
+    self.assert_(len(self.am._alarm_heap) < 500)
+
+    fired = []
+    while True:
+      alarm = self.am.PopDueAlarm(now + 1000)
+      if alarm is None:
+        break
+      fired.append(alarm.event())
+    expected = range(1, 500, 4) + [i for i in xrange(1, 500, 2) if i % 4 != 1]
+    self.assertEqual(fired, expected)
+    self.assertEqual(self.am.GetAlarmCount(), 0)
+    self.assertEqual(self.am._alarms_by_name, {})
+
+  def testSetAlarm(self):
+    now = time.time()
+    a1 = self.am.SetAlarm("test1", now + 10.0, 'first')
+    a2 = self.am.AddAlarm("test2", now + 5.0, None)
+    # Reschedules the pending alarm rather than adding another.
+    self.assert_(self.am.SetAlarm("test1", now - 1.0, 'second') is a1)
+    self.assertEqual(self.am.GetAlarmCount(), 2)
+    alarm = self.am.PopDueAlarm(now)
+    self.assert_(alarm is a1)
+    self.assertEqual(alarm.event(), 'second')
+    # Once fired, the name can be reused.
+    a3 = self.am.SetAlarm("test1", now + 1.0, None)
+    self.assert_(a3 is not a1)
+    self.assertEqual(self.am.GetNextFireTime(), now + 1.0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,175 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs Backend calls on worker threads, off the core service thread.
+
+Calls are queued with AsyncBackend.Call() and run by BackendWorkerThreads.
+Each result is published on the event hub as a BackendCallCompleteEvent.
+The AsyncBackend must be registered as an event handler on every thread
+that makes calls; it runs each callback on the thread that made the call.
+"""
+
+import itertools
+import Queue
+import threading
+import time
+
+import gflags
+
+from pygate.core import backend
+from pygate.core import kbevent
+from pygate.core import manager
+from pygate.core import util
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('backend_workers', 4,
+    'Number of threads running backend calls for the core.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('backend_queue_size', 100,
+    'Maximum number of backend calls waiting for a worker.  Calls made when '
+    'the queue is full fail immediately.')
+
+gflags.DEFINE_float('backend_call_timeout', 5.0,
+    'Seconds a caller waits for a backend call before it is given a '
+    'BackendTimeoutError.  The call itself is not interrupted.')
+
+
+class BackendBusyError(backend.BackendError):
+  """The backend call queue was full."""
+
+class BackendTimeoutError(backend.BackendError):
+  """The backend call did not complete in time."""
+
+
+class AsyncBackend(manager.Manager):
+  def __init__(self, name, event_hub, backend, alarm_manager):
+    manager.Manager.__init__(self, name, event_hub)
+    self._backend = backend
+    self._alarm_manager = alarm_manager
+    self._queue = Queue.Queue(FLAGS.backend_queue_size)
+    self._call_ids = itertools.count(1)
+    # Maps call id to (method, callback, calling thread) for calls not yet
+    # completed.
+    self._pending = {}
+    self._lock = threading.Lock()
+    self._queue_wait = util.LatencyHistogram()
+    self._latency = {}
+    self.rejected = 0
+    self.timeouts = 0
+    self.errors = 0
+
+  def GetBackend(self):
+    return self._backend
+
+  def GetStatus(self):
+    ret = []
+    ret.append('pending calls: %i, queued: %i' % (len(self._pending),
+        self._queue.qsize()))
+    ret.append('rejected: %i, timeouts: %i, errors: %i' % (self.rejected,
+        self.timeouts, self.errors))
+    ret.extend(self._queue_wait.GetStatus('queue wait'))
+    for method in sorted(self._latency):
+      ret.extend(self._latency[method].GetStatus(method))
+    return ret
+
+  def Call(self, callback, method, *args, **kwargs):
+    """Runs backend.|method|(*args, **kwargs) on a worker thread.
+
+    callback(result, error) is called on the calling thread when the call
+    returns, raises a BackendError (passed as |error|), or takes longer than
+    --backend_call_timeout.  If |callback| is None, the result is dropped.
+    """
+    call_id = None
+    if callback is not None:
+      call_id = self._call_ids.next()
+      self._pending[call_id] = (method, callback, threading.currentThread())
+      timeout_event = kbevent.BackendCallCompleteEvent(call_id=call_id,
+          error=BackendTimeoutError(method))
+      self._alarm_manager.AddAlarm(self._AlarmName(call_id),
+          time.time() + FLAGS.backend_call_timeout, timeout_event)
+    try:
+      self._queue.put_nowait((call_id, method, args, kwargs, time.time()))
+    except Queue.Full:
+      self.rejected += 1
+      self._logger.warning('Backend queue full, rejecting %s' % method)
+      if call_id is not None:
+        self._PublishEvent(kbevent.BackendCallCompleteEvent(call_id=call_id,
+            error=BackendBusyError(method)))
+
+  def _AlarmName(self, call_id):
+    return 'backend-call-%i' % call_id
+
+  def RunPendingCall(self, timeout=None):
+    """Waits up to |timeout| for a queued call and runs it.  Called by the
+    worker threads.
+
+    Returns True if a call was run.
+    """
+    try:
+      call_id, method, args, kwargs, queued_at = self._queue.get(True, timeout)
+    except Queue.Empty:
+      return False
+    start = time.time()
+    self._queue_wait.Record(start - queued_at)
+    result = error = None
+    try:
+      result = getattr(self._backend, method)(*args, **kwargs)
+    except backend.BackendError, e:
+      error = e
+    except Exception, e:
+      # Database errors and the like must not kill the worker.
+      self.errors += 1
+      self._logger.error('Backend call %s failed:' % method)
+      util.LogTraceback(self._logger.error)
+      error = backend.BackendError(e)
+    self._GetHistogram(method).Record(time.time() - start)
+    if call_id is not None:
+      self._PublishEvent(kbevent.BackendCallCompleteEvent(call_id=call_id,
+          result=result, error=error))
+    return True
+
+  def _GetHistogram(self, method):
+    histogram = self._latency.get(method)
+    if histogram is None:
+      histogram = self._latency.setdefault(method, util.LatencyHistogram())
+    return histogram
+
+  @util.synchronized
+  def _TakePending(self, call_id):
+    """Returns and forgets the pending call |call_id|, if it was made from
+    this thread."""
+    entry = self._pending.get(call_id)
+    if entry is None or entry[2] is not threading.currentThread():
+      # Already completed or timed out, or another thread's call.
+      return None
+    del self._pending[call_id]
+    return entry
+
+  @manager.EventHandler(kbevent.BackendCallCompleteEvent)
+  def _HandleCallCompleteEvent(self, event):
+    entry = self._TakePending(event.call_id)
+    if entry is None:
+      return
+    method, callback, thread = entry
+    self._alarm_manager.CancelAlarm(self._AlarmName(event.call_id))
+    if isinstance(event.error, BackendTimeoutError):
+      self.timeouts += 1
+      self._logger.warning('Backend call %s timed out' % method)
+    callback(event.result, event.error)
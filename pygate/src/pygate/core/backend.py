@@ -21,16 +21,26 @@
 import datetime
 import logging
 import socket
+import time
 
+import gflags
+from django.db import transaction
 from django.db.utils import DatabaseError
 
 from pygate.core import kb_common
 from pygate.core import config
 from pygate.core import models
 from pygate.core import protolib
+from pygate.core import tokencache
 
 from pygate.web.api import krest
 
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('unknown_token_flush_interval', 5,
+    'Seconds between writes of newly seen unknown auth tokens to the '
+    'database.')
+
 class BackendError(Exception):
   """Base backend error exception."""
 
@@ -70,10 +80,41 @@ class Backend:
     """Records a new entry with the given parameters."""
     raise NotImplementedError
 
+  def RecordEntries(self, entries):
+    """Records several entries, each a dict of RecordEntry arguments.
+
+    Returns a list holding, for each entry in order, the recorded entry or
+    the BackendError which prevented recording it.  Backends which record
+    the whole batch in one transaction may instead raise BackendError, having
+    recorded none of it.
+    """
+    ret = []
+    for entry in entries:
+      try:
+        ret.append(self.RecordEntry(**entry))
+      except BackendError, e:
+        ret.append(e)
+    return ret
+
   def GetAuthToken(self, auth_device, token_value):
     """Returns an AuthenticationToken instance."""
     raise NotImplementedError
 
+  def FlushUnknownTokens(self, force=False):
+    """Records unknown tokens seen by GetAuthToken, if it batches them.
+
+    Backends which only flush periodically flush now if |force| is true.
+    """
+    pass
+
+  def WatchTokens(self, callback):
+    """Calls callback(auth_device, token_value) when a token changes.
+
+    Both arguments are None if any token may have changed.  Backends which
+    cannot see changes do nothing.
+    """
+    pass
+
 
 class GatebotBackend(Backend):
   """Django models backed Backend."""
@@ -85,6 +126,8 @@ class GatebotBackend(Backend):
       self._site = site
     else:
       self._site = models.GatebotSite.objects.get(name=sitename)
+    self._unknown_tokens = tokencache.UnknownTokenLog()
+    self._last_unknown_flush = 0
 
   def _GetConfigDict(self):
     try:
@@ -154,6 +197,17 @@ class GatebotBackend(Backend):
 
     return protolib.ToProto(d)
 
+  def RecordEntries(self, entries):
+    """Records all |entries| in a single transaction, or none of them."""
+    try:
+      return self._RecordEntries(entries)
+    except DatabaseError, e:
+      raise BackendError, e
+
+  @transaction.commit_on_success
+  def _RecordEntries(self, entries):
+    return [self.RecordEntry(**entry) for entry in entries]
+
 
   def GetAuthToken(self, auth_device, token_value):
 
@@ -162,16 +216,53 @@ class GatebotBackend(Backend):
       try:
         user = models.User.objects.get(username=token_value, is_active=True)
       except models.User.DoesNotExist:
-        raise NoTokenError(auth_device)
+        raise NoTokenError
       fake_token = models.AuthenticationToken(auth_device='core.user',
           token_value=token_value, seqn=0, user=user, enabled=True)
       return protolib.ToProto(fake_token)
 
-    tok, created = models.AuthenticationToken.objects.get_or_create( site=self._site,
-        auth_device=auth_device, token_value=token_value)
+    # Read-only: unknown tokens are only recorded, in batches, by
+    # FlushUnknownTokens().
+    try:
+      tok = models.AuthenticationToken.objects.select_related('user').get(
+          site=self._site, auth_device=auth_device, token_value=token_value)
+    except models.AuthenticationToken.DoesNotExist:
+      self._unknown_tokens.Record(auth_device, token_value)
+      raise NoTokenError
     if not tok.user:
       raise NoTokenError
-    return protolib.ToProto(tok)
+    return protolib.ToProto(tok, full=True)
+
+  def FlushUnknownTokens(self, force=False):
+    """Creates unassigned rows for the unknown tokens seen since the last
+    flush, at most every --unknown_token_flush_interval seconds.
+
+    Users claim these rows from the web interface.
+    """
+    now = time.time()
+    if not len(self._unknown_tokens):
+      return
+    if not force and (now - self._last_unknown_flush <
+        FLAGS.unknown_token_flush_interval):
+      return
+    self._last_unknown_flush = now
+    batch = self._unknown_tokens.TakeBatch()
+    try:
+      self._CreateUnknownTokens(batch.keys())
+    except DatabaseError, e:
+      raise BackendError, e
+    self._logger.info('Recorded %i unknown token(s)' % len(batch))
+
+  @transaction.commit_on_success
+  def _CreateUnknownTokens(self, keys):
+    for auth_device, token_value in keys:
+      models.AuthenticationToken.objects.get_or_create(site=self._site,
+          auth_device=auth_device, token_value=token_value)
+
+  def WatchTokens(self, callback):
+    def _Changed(sender, auth_device=None, token_value=None, **kwargs):
+      callback(auth_device, token_value)
+    models.auth_token_changed.connect(_Changed, weak=False)
 
 
 class WebBackend(Backend):
@@ -206,6 +297,6 @@ class WebBackend(Backend):
       return token
     except krest.NotFoundError:
       raise NoTokenError
-    except socket.error:
+    except socket.error, e:
       self._logger.warning('Socket error fetching token; ignoring.')
-      raise NoTokenError
+      raise BackendError(e)
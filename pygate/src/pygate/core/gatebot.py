@@ -27,6 +27,7 @@ system.
 For more information, please see the gatebot documentation.
 """
 
+import itertools
 import logging
 import time
 import warnings
@@ -35,11 +36,16 @@ warnings.simplefilter("ignore", DeprecationWarning)
 import gflags
 
 from pygate.core import alarm
+from pygate.core import asyncbackend
 from pygate.core import backend
 from pygate.core import kbevent
 from pygate.core import kb_app
 from pygate.core import kb_threads
 from pygate.core import manager
+from pygate.core import supervisor
+from pygate.core import tracing
+from pygate.core import util
+from pygate.core.net import epollnet
 from pygate.core.net import gatenet
 
 FLAGS = gflags.FLAGS
@@ -47,6 +53,22 @@ FLAGS = gflags.FLAGS
 gflags.DEFINE_boolean('web_backend', False,
     'If true, uses the web backend implementation rather than a database connection.')
 
+gflags.DEFINE_enum('gatenet_server', 'asyncore', ['asyncore', 'epoll'],
+    'Gatenet server implementation. "epoll" scales to many more clients '
+    'and bounds the data buffered for each of them; both speak the same '
+    'protocol.')
+
+gflags.DEFINE_boolean('core_event_loop', False,
+    'If true, runs the event hub, managers, gatenet server, alarms and '
+    'heartbeat on a single event loop thread, rather than on one thread per '
+    'service.')
+
+gflags.DEFINE_integer('service_shards', 1,
+    'Number of threads handling gate events.  Each gate is assigned to one '
+    'thread, with its own latch and authentication managers, so a busy gate '
+    'does not delay the others.  Ignored with --core_event_loop.',
+    lower_bound=1)
+
 class GatebotEnv(object):
   """ A class that wraps the context of the gatebot core.
 
@@ -57,7 +79,11 @@ class GatebotEnv(object):
     self._event_hub = kbevent.EventHub()
     self._logger = logging.getLogger('env')
 
-    self._gatenet_server = gatenet.GatenetServer(name='gatenet', kb_env=self,
+    if FLAGS.gatenet_server == 'epoll':
+      server_cls = epollnet.EpollGatenetServer
+    else:
+      server_cls = gatenet.GatenetServer
+    self._gatenet_server = server_cls(name='gatenet', kb_env=self,
         addr=FLAGS.kb_core_bind_addr)
 
     if FLAGS.web_backend:
@@ -71,38 +97,104 @@ class GatebotEnv(object):
 
     # Build managers
     self._alarm_manager = alarm.AlarmManager()
-    self._gate_manager = manager.GateManager('gate-manager', self._event_hub)
-    self._latch_manager = manager.LatchManager('latch-manager', self._event_hub,
-        self._gate_manager)
-    self._authentication_manager = manager.AuthenticationManager('auth-manager',
-        self._event_hub, self._latch_manager, self._gate_manager, self._backend)
+    self._async_backend = asyncbackend.AsyncBackend('async-backend',
+        self._event_hub, self._backend, self._alarm_manager)
     self._entry_manager = manager.EntryManager('entry-manager', self._event_hub,
         self._backend)
     self._subscription_manager = manager.SubscriptionManager('pubsub',
         self._event_hub, self._gatenet_server)
 
+    num_shards = FLAGS.service_shards
+    if FLAGS.core_event_loop and num_shards > 1:
+      self._logger.warning('--service_shards is ignored with --core_event_loop')
+      num_shards = 1
+    # Each shard has its own gate, latch and authentication managers, which
+    # only see the shard's gates.
+    if supervisor.IsWorker():
+      # Interleave latch ids with the other workers'.
+      latch_ids = itertools.count(
+          int(time.time()) * FLAGS.core_workers + FLAGS.core_worker_index,
+          FLAGS.core_workers)
+    else:
+      latch_ids = itertools.count(int(time.time()))
+    self._shards = []
+    for i in xrange(num_shards):
+      suffix = ''
+      if num_shards > 1:
+        suffix = '-%i' % i
+      shard = util.AttrDict()
+      shard.gate_manager = manager.GateManager('gate-manager' + suffix,
+          self._event_hub)
+      shard.latch_manager = manager.LatchManager('latch-manager' + suffix,
+          self._event_hub, shard.gate_manager, self._alarm_manager,
+          latch_ids=latch_ids)
+      shard.authentication_manager = manager.AuthenticationManager(
+          'auth-manager' + suffix, self._event_hub, shard.latch_manager,
+          shard.gate_manager, self._async_backend)
+      self._shards.append(shard)
+
     # Build threads
     self._threads = set()
-    self._service_thread = kb_threads.EventHandlerThread(self, 'service-thread')
-    self._service_thread.AddEventHandler(self._gate_manager)
-    self._service_thread.AddEventHandler(self._latch_manager)
+    if FLAGS.core_event_loop:
+      self._service_thread = kb_threads.CoreEventLoopThread(self,
+          'core-loop-thread')
+    else:
+      self._service_thread = kb_threads.EventHandlerThread(self,
+          'service-thread')
+    if num_shards == 1:
+      self._AddShardHandlers(self._service_thread, self._shards[0])
+    else:
+      for i, shard in enumerate(self._shards):
+        thr = kb_threads.GateShardThread(self, 'shard-%i-thread' % i,
+            shard.gate_manager)
+        self._AddShardHandlers(thr, shard)
+        self.AddThread(thr)
     self._service_thread.AddEventHandler(self._entry_manager)
-    self._service_thread.AddEventHandler(self._authentication_manager)
     self._service_thread.AddEventHandler(self._subscription_manager)
+    self._service_thread.AddEventHandler(self._async_backend)
 
     self.AddThread(self._service_thread)
 
-    self.AddThread(kb_threads.EventHubServiceThread(self, 'eventhub-thread'))
-    self.AddThread(kb_threads.NetProtocolThread(self, 'net-thread'))
-    self.AddThread(kb_threads.AlarmManagerThread(self, 'alarmmanager-thread'))
-    self.AddThread(kb_threads.HeartbeatThread(self, 'heartbeat-thread'))
+    if not FLAGS.core_event_loop:
+      self.AddThread(kb_threads.EventHubServiceThread(self, 'eventhub-thread'))
+      self.AddThread(kb_threads.NetProtocolThread(self, 'net-thread'))
+      self.AddThread(kb_threads.AlarmManagerThread(self, 'alarmmanager-thread'))
+      self.AddThread(kb_threads.HeartbeatThread(self, 'heartbeat-thread'))
+
+    for i in xrange(FLAGS.backend_workers):
+      self.AddThread(kb_threads.BackendWorkerThread(self,
+          'backend-worker-%i' % i))
+
+    self._entry_writer_thread = kb_threads.EntryWriterThread(self,
+        'entry-writer-thread')
+    self.AddThread(self._entry_writer_thread)
 
     self._watchdog_thread = kb_threads.WatchdogThread(self, 'watchdog-thread')
     self.AddThread(self._watchdog_thread)
 
     for gate in self._backend.GetAllGates():
+      if supervisor.IsWorker() and (supervisor.WorkerForGate(gate.name,
+          FLAGS.core_workers) != FLAGS.core_worker_index):
+        # Owned by another worker.
+        continue
       # TODO: get rid of max_tick_delta parameter entirely
-      self._gate_manager.RegisterGate(gate.name)
+      self.GetGateManager(gate.name).RegisterGate(gate.name)
+
+    for group_name, gate_names in kb_threads.GetGateGroups().iteritems():
+      for shard in self._shards:
+        shard.gate_manager.SetGateGroup(group_name, gate_names)
+
+  def _AddShardHandlers(self, thr, shard):
+    thr.AddEventHandler(shard.gate_manager)
+    thr.AddEventHandler(shard.latch_manager)
+    thr.AddEventHandler(shard.authentication_manager)
+    # Backend callbacks run on the thread which made the call.
+    thr.AddEventHandler(self._async_backend)
+
+  def _GetShard(self, gate_name):
+    if gate_name is None:
+      return self._shards[0]
+    return self._shards[kb_threads.ShardForGate(gate_name, len(self._shards))]
 
   def AddThread(self, thr):
     self._threads.add(thr)
@@ -118,20 +210,31 @@ class GatebotEnv(object):
   def GetBackend(self):
     return self._backend
 
+  def GetAsyncBackend(self):
+    return self._async_backend
+
   def GetGatenetServer(self):
     return self._gatenet_server
 
   def GetEventHub(self):
     return self._event_hub
 
-  def GetGateManager(self):
-    return self._gate_manager
+  # With --service_shards, each gate belongs to the managers of one shard.
+  # Without a gate name, these return the first shard's.
+  def GetGateManager(self, gate_name=None):
+    return self._GetShard(gate_name).gate_manager
+
+  def GetLatchManager(self, gate_name=None):
+    return self._GetShard(gate_name).latch_manager
 
-  def GetLatchManager(self):
-    return self.latch_manager
+  def GetEntryManager(self):
+    return self._entry_manager
 
-  def GetAuthenticationManager(self):
-    return self._authentication_manager
+  def GetEntryWriterThread(self):
+    return self._entry_writer_thread
+
+  def GetAuthenticationManager(self, gate_name=None):
+    return self._GetShard(gate_name).authentication_manager
 
   def GetThreads(self):
     return self._threads
@@ -163,6 +266,25 @@ class GatebotCoreApp(kb_app.App):
     for thr in self._env.GetThreads():
       self._AddAppThread(thr)
 
+  def _DumpStatus(self):
+    kb_app.App._DumpStatus(self)
+    tracer = tracing.GetTracer()
+    for line in tracer.GetStatus():
+      self._logger.info(line)
+    if FLAGS.trace_histogram_file:
+      try:
+        tracer.DumpHistograms(FLAGS.trace_histogram_file)
+      except IOError, e:
+        self._logger.warning('Could not write %s: %s' % (
+            FLAGS.trace_histogram_file, e))
+    if FLAGS.handler_stats_file:
+      try:
+        kb_threads.DumpStats(FLAGS.handler_stats_file,
+            self._env.GetEventHub(), self._env.GetThreads())
+      except IOError, e:
+        self._logger.warning('Could not write %s: %s' % (
+            FLAGS.handler_stats_file, e))
+
   def Quit(self):
     self._do_quit = True
     event = kbevent.QuitEvent()
@@ -171,6 +293,20 @@ class GatebotCoreApp(kb_app.App):
 
     self._logger.info('Stopping any remaining threads')
     self._StopThreads()
+
+    # Entries queued by the service thread must not be lost.  Wait for the
+    # writer to finish its batch, then record anything queued after it quit.
+    self._logger.info('Recording queued entries')
+    writer = self._env.GetEntryWriterThread()
+    if writer.hasStarted():
+      writer.join()
+    self._env.GetEntryManager().FlushEntries()
+    # Likewise unknown tokens, which are otherwise only recorded every
+    # --unknown_token_flush_interval seconds.
+    try:
+      self._env.GetBackend().FlushUnknownTokens(force=True)
+    except backend.BackendError, e:
+      self._logger.error('Could not record unknown tokens: %s' % e)
     self._logger.info('Gatebot stopped.')
     self._TeardownLogging()
 
@@ -1,17 +1,31 @@
-import asyncore
 import datetime
 import Queue
+import threading
 import time
+import zlib
 
 import gflags
 
 from pygate.core import kb_common
 from pygate.core import kbevent
+from pygate.core import kbjson
 from pygate.core import util
 from pygate.core.net import gatenet
 
 FLAGS = gflags.FLAGS
 
+gflags.DEFINE_float('slow_handler_ms', 0,
+    'If set, logs a warning for every event handler call which takes longer '
+    'than this many milliseconds.')
+
+gflags.DEFINE_string('handler_stats_file', '',
+    'If set, the event queue and handler counters are written to this file, '
+    'as JSON, on every status dump.')
+
+gflags.DEFINE_multistring('gate_group', [],
+    'Defines a named group of gates, as NAME=GATE[,GATE...].  Token events '
+    'reported for NAME apply to every gate in the group.  May be repeated.')
+
 ### Base gatebot thread class
 
 class CoreThread(util.GatebotThread):
@@ -21,6 +35,10 @@ class CoreThread(util.GatebotThread):
     self._kb_env = kb_env
 
   ### Event listener methods
+  def GetEventTypes(self):
+    """Returns the event classes this thread subscribes to on the EventHub."""
+    return (kbevent.QuitEvent,)
+
   def PostEvent(self, event):
     if isinstance(event, kbevent.QuitEvent):
       self._logger.info('got quit event, quitting')
@@ -49,10 +67,27 @@ class WatchdogThread(CoreThread):
 class EventHubServiceThread(CoreThread):
   """Handles all event dispatches for the event hub."""
 
+  def GetStatus(self):
+    return self._kb_env.GetEventHub().GetStatus()
+
   def ThreadMain(self):
     hub = self._kb_env.GetEventHub()
     while not self._quit:
-      hub.DispatchNextEvent(timeout=0.5)
+      hub.DispatchEvents(timeout=0.5)
+
+
+def _PublishHeartbeat(hub, seconds):
+  """Publishes the heartbeat events due at |seconds| into the hour.
+
+  Returns the updated seconds counter.
+  """
+  hub.PublishEvent(kbevent.HeartbeatSecondEvent())
+  if (seconds % 60) == 0:
+    hub.PublishEvent(kbevent.HeartbeatMinuteEvent())
+  if (seconds % 3600) == 0:
+    hub.PublishEvent(kbevent.HeartbeatHourEvent())
+    seconds = 0
+  return seconds
 
 
 class HeartbeatThread(CoreThread):
@@ -63,16 +98,7 @@ class HeartbeatThread(CoreThread):
     seconds = 0
     while not self._quit:
       time.sleep(1.0)
-      seconds += 1
-      event = kbevent.HeartbeatSecondEvent()
-      hub.PublishEvent(event)
-      if (seconds % 60) == 0:
-        event = kbevent.HeartbeatMinuteEvent()
-        hub.PublishEvent(event)
-      if (seconds % 3600) == 0:
-        event = kbevent.HeartbeatHourEvent()
-        hub.PublishEvent(event)
-        seconds = 0
+      seconds = _PublishHeartbeat(hub, seconds + 1)
 
 
 class AlarmManagerThread(CoreThread):
@@ -87,11 +113,61 @@ class AlarmManagerThread(CoreThread):
         self._kb_env.GetEventHub().PublishEvent(event)
 
 
+class EntryWriterThread(CoreThread):
+  """Records entries queued by the EntryManager."""
+
+  def GetStatus(self):
+    return self._kb_env.GetEntryManager().GetStatus()
+
+  def ThreadMain(self):
+    entry_manager = self._kb_env.GetEntryManager()
+    while not self._quit:
+      entry_manager.WriteEntries(timeout=0.5)
+    entry_manager.FlushEntries()
+
+
+class BackendWorkerThread(CoreThread):
+  """Runs backend calls queued on the AsyncBackend."""
+
+  def ThreadMain(self):
+    async_backend = self._kb_env.GetAsyncBackend()
+    while not self._quit:
+      async_backend.RunPendingCall(timeout=0.5)
+
+
+def _HandlerName(cb):
+  """Returns 'Class.method' for a bound method callback."""
+  owner = getattr(cb, 'im_self', None)
+  if owner is None:
+    return cb.__name__
+  return '%s.%s' % (owner.__class__.__name__, cb.__name__)
+
+
+def DumpStats(path, event_hub, threads):
+  """Writes the counters of |event_hub| and of each EventHandlerThread in
+  |threads| to |path|, as JSON."""
+  data = {
+    'dumped_at': time.time(),
+    'hub': event_hub.GetStats(),
+    'threads': dict((thr.getName(), thr.GetStats()) for thr in threads
+        if isinstance(thr, EventHandlerThread)),
+  }
+  f = open(path, 'w')
+  try:
+    f.write(kbjson.dumps(data))
+  finally:
+    f.close()
+
+
 class EventHandlerThread(CoreThread):
   """ Basic event handling thread. """
   def __init__(self, kb_env, name):
     CoreThread.__init__(self, kb_env, name)
     self._event_queue = Queue.Queue()
+    self._queue_stats = util.QueueStats('event')
+    # Keyed by (event class, callback).
+    self._handler_stats = util.CallStats()
+    self._slow_handler_secs = FLAGS.slow_handler_ms / 1000.0
     self._event_handlers = set()
     self._all_event_map = {}
 
@@ -107,8 +183,16 @@ class EventHandlerThread(CoreThread):
         for cb in callback_list:
           self._all_event_map[event_type].add(cb)
 
+  def GetEventTypes(self):
+    return (kbevent.QuitEvent,) + tuple(self._all_event_map.keys())
+
   def GetStatus(self):
-    lines = []
+    lines = self._queue_stats.GetStatus(self._event_queue)
+    for (event_cls, cb), (count, total, max_secs) in self._handler_stats.Items():
+      lines.append('%s %s: calls=%i total=%.1fms max=%.1fms' % (
+          event_cls.__name__, _HandlerName(cb), count, total * 1000.0,
+          max_secs * 1000.0))
+    lines.append('')
     for handler in self._event_handlers:
       handler_lines = handler.GetStatus()
       if handler_lines:
@@ -124,25 +208,36 @@ class EventHandlerThread(CoreThread):
       self._Step(timeout=0.5)
 
   def _Step(self, timeout=0.5):
-    event = self._WaitForEvent(timeout)
-    if event is not None:
+    """Waits for events and processes them as a batch.
+
+    Returns the list of events taken from the queue.
+    """
+    batch = util.GetQueueBatch(self._event_queue, FLAGS.event_batch_size,
+        timeout)
+    if batch:
+      self._queue_stats.Record(len(batch), self._event_queue.qsize())
+    now = time.time()
+    events = []
+    for queued_at, event in batch:
+      self._queue_stats.RecordResidence(now - queued_at)
+      events.append(event)
+    for event in events:
+      if self._quit:
+        # Unhandled events stay unacknowledged, so their senders resend them.
+        break
       self._ProcessEvent(event)
-    return event
+      if event.pending_ack is not None:
+        event.pending_ack.Release()
+    return events
 
   def PostEvent(self, event):
-    self._event_queue.put(event)
+    if event.pending_ack is not None:
+      event.pending_ack.Hold()
+    self._event_queue.put((time.time(), event))
 
   def _GetCallbacksForEvent(self, event):
     return self._all_event_map.get(event.__class__, tuple())
 
-  def _WaitForEvent(self, timeout=0.5):
-    """ Block until an event is posted, then process it """
-    try:
-      ev = self._event_queue.get(timeout=timeout)
-      return ev
-    except Queue.Empty:
-      return None
-
   def _ProcessEvent(self, event):
     """ Execute the event callback associated with the event, if present. """
     if FLAGS.debug_events:
@@ -153,16 +248,95 @@ class EventHandlerThread(CoreThread):
       return
     callbacks = self._GetCallbacksForEvent(event)
     for cb in callbacks:
+      start = time.time()
       cb(event)
+      elapsed = time.time() - start
+      self._handler_stats.Record((event.__class__, cb), elapsed)
+      if self._slow_handler_secs and elapsed > self._slow_handler_secs:
+        self._logger.warning('Slow handler: %s took %.1fms for %s' % (
+            _HandlerName(cb), elapsed * 1000.0, event.__class__.__name__))
+
+  def GetStats(self):
+    """Returns the queue and handler counters as a dict."""
+    handlers = []
+    for (event_cls, cb), (count, total, max_secs) in self._handler_stats.Items():
+      handlers.append({
+        'event': event_cls.__name__,
+        'handler': _HandlerName(cb),
+        'calls': count,
+        'total_ms': total * 1000.0,
+        'max_ms': max_secs * 1000.0,
+      })
+    return {
+      'queue': self._queue_stats.AsDict(self._event_queue),
+      'handlers': handlers,
+    }
 
   def _FlushEvents(self):
     """ Process all events in the Queue immediately """
     while True:
-      ev = self._Step(timeout=0.5)
-      if ev is None:
+      events = self._Step(timeout=0.5)
+      if not events:
         break
 
 
+# Events about a single gate, or a gate group, which are only handled by the
+# shard(s) owning the gate.
+GATE_EVENTS = (
+  kbevent.LatchUpdate,
+  kbevent.TokenAuthEvent,
+  kbevent.LatchRequest,
+  kbevent.MeterUpdate,
+  kbevent.LatchIdleEvent,
+  kbevent.GateIdleEvent,
+)
+
+
+def ShardForGate(gate_name, num_shards, seed=0):
+  """Returns the index of the shard which owns |gate_name|.
+
+  Independent partitionings of the same gates should use different |seed|s.
+  """
+  return (zlib.crc32(gate_name, seed) & 0xffffffff) % num_shards
+
+
+def GetGateGroups():
+  """Returns the --gate_group definitions, as a dict of name to gate names."""
+  groups = {}
+  for spec in FLAGS.gate_group:
+    group_name, sep, gate_names = spec.partition('=')
+    if not sep or not group_name:
+      raise ValueError('Bad --gate_group %r; expected NAME=GATE[,GATE...]' %
+          spec)
+    groups[group_name] = [n.strip() for n in gate_names.split(',')
+        if n.strip()]
+  return groups
+
+
+class GateShardThread(EventHandlerThread):
+  """Handles events for the gates registered on |gate_manager|.
+
+  Events in GATE_EVENTS are only queued if they name one of those gates, or a
+  group or alias containing one; all other events are handled as usual.
+  """
+  def __init__(self, kb_env, name, gate_manager):
+    EventHandlerThread.__init__(self, kb_env, name)
+    self._gate_manager = gate_manager
+    self.skipped = 0
+
+  def GetStatus(self):
+    lines = ['events for other shards: %i' % self.skipped]
+    return lines + EventHandlerThread.GetStatus(self)
+
+  def PostEvent(self, event):
+    # Called from the event hub thread.
+    if (isinstance(event, GATE_EVENTS) and
+        not self._gate_manager.GetGatesForName(event.gate_name)):
+      self.skipped += 1
+      return
+    EventHandlerThread.PostEvent(self, event)
+
+
 ### Service threads
 class NetProtocolThread(CoreThread):
   def ThreadMain(self):
@@ -170,5 +344,71 @@ class NetProtocolThread(CoreThread):
     server = self._kb_env.GetGatenetServer()
     server.StartServer()
     while not self._quit:
-      asyncore.loop(timeout=0.5, count=1)
+      server.Poll(0.5)
     server.StopServer()
+
+
+class CoreEventLoopThread(EventHandlerThread):
+  """Runs the whole core on a single event loop.
+
+  This replaces the service, eventhub, net, alarm and heartbeat threads:
+  gatenet I/O, event hub dispatch, event handlers, alarms and heartbeats are
+  all serviced from this one thread.  Events are dispatched as soon as the
+  loop wakes, rather than after a hop through several thread queues.
+  """
+  def __init__(self, kb_env, name):
+    EventHandlerThread.__init__(self, kb_env, name)
+    self._server = None
+
+  def PostEvent(self, event):
+    # Called by the event hub, which is dispatched from this thread.
+    self._ProcessEvent(event)
+
+  def _OnEventPublished(self):
+    if self._server and threading.currentThread() is not self:
+      self._server.Wakeup()
+
+  def _NextTimeout(self, now, next_heartbeat):
+    timeout = next_heartbeat - now
+    next_alarm = self._kb_env.GetAlarmManager().GetNextFireTime()
+    if next_alarm is not None:
+      timeout = min(timeout, next_alarm - now)
+    return max(0, timeout)
+
+  def _FireAlarms(self, now):
+    am = self._kb_env.GetAlarmManager()
+    hub = self._kb_env.GetEventHub()
+    while True:
+      alarm = am.PopDueAlarm(now)
+      if alarm is None:
+        break
+      self._logger.info('firing alarm: %s' % alarm)
+      hub.PublishEvent(alarm.event())
+
+  def ThreadMain(self):
+    hub = self._kb_env.GetEventHub()
+    server = self._kb_env.GetGatenetServer()
+    server.StartServer()
+    self._server = server
+    hub.SetWakeupCallback(self._OnEventPublished)
+
+    seconds = 0
+    next_heartbeat = time.time() + 1.0
+    try:
+      while not self._quit:
+        # Events published before the loop started (or from other threads
+        # since the last pass) are handled first.
+        while not self._quit and hub.DispatchEvents(timeout=0):
+          pass
+        if self._quit:
+          break
+        server.Poll(self._NextTimeout(time.time(), next_heartbeat))
+        now = time.time()
+        while now >= next_heartbeat:
+          seconds = _PublishHeartbeat(hub, seconds + 1)
+          next_heartbeat += 1.0
+        self._FireAlarms(now)
+    finally:
+      hub.SetWakeupCallback(None)
+      self._server = None
+      server.StopServer()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Times gate event handling on one service thread and on gate shards.
+
+Each event is a LatchRequest for one of the gates, spread evenly.  The
+handler sleeps for HANDLER_SECS to stand in for the database and network
+waits of the real managers; pure Python handling would not scale across
+threads.  With one shard per gate, throughput should grow with the number
+of gates; gates which hash to the same shard still share its thread.
+"""
+
+import sys
+import threading
+import time
+
+import gflags
+
+from pygate.core import kbevent
+from pygate.core import kb_threads
+
+GATE_COUNTS = (1, 2, 4, 8)
+NUM_EVENTS = 400
+HANDLER_SECS = 0.002
+
+
+class _Env(object):
+  def __init__(self):
+    self._event_hub = kbevent.EventHub()
+
+  def GetEventHub(self):
+    return self._event_hub
+
+
+class _GateManager(object):
+  def __init__(self, gate_names):
+    self._gates = set(gate_names)
+
+  def GetGatesForName(self, name):
+    if name in self._gates:
+      return (name,)
+    return ()
+
+
+class _Handler(object):
+  def __init__(self, counter):
+    self._counter = counter
+
+  def GetEventHandlers(self):
+    return {kbevent.LatchRequest: set([self._HandleEvent])}
+
+  def GetStatus(self):
+    return []
+
+  def _HandleEvent(self, event):
+    time.sleep(HANDLER_SECS)
+    self._counter.Add()
+
+
+class _Counter(object):
+  def __init__(self, target):
+    self._target = target
+    self._count = 0
+    self._lock = threading.Lock()
+    self.done = threading.Event()
+
+  def Add(self):
+    self._lock.acquire()
+    self._count += 1
+    if self._count == self._target:
+      self.done.set()
+    self._lock.release()
+
+
+def _Run(num_gates, sharded):
+  env = _Env()
+  hub = env.GetEventHub()
+  counter = _Counter(NUM_EVENTS)
+  gate_names = ['gate%i' % i for i in xrange(num_gates)]
+  threads = [kb_threads.EventHubServiceThread(env, 'eventhub-thread')]
+  if sharded:
+    shard_gates = [[] for i in xrange(num_gates)]
+    for name in gate_names:
+      shard_gates[kb_threads.ShardForGate(name, num_gates)].append(name)
+    for i, names in enumerate(shard_gates):
+      thr = kb_threads.GateShardThread(env, 'shard-%i-thread' % i,
+          _GateManager(names))
+      thr.AddEventHandler(_Handler(counter))
+      threads.append(thr)
+  else:
+    thr = kb_threads.EventHandlerThread(env, 'service-thread')
+    thr.AddEventHandler(_Handler(counter))
+    threads.append(thr)
+  for thr in threads:
+    hub.AddListener(thr)
+    thr.start()
+
+  start = time.time()
+  for i in xrange(NUM_EVENTS):
+    hub.PublishEvent(kbevent.LatchRequest(gate_name=gate_names[i % num_gates]))
+  counter.done.wait(60)
+  elapsed = time.time() - start
+
+  for thr in threads:
+    thr.Quit()
+  for thr in threads:
+    thr.join()
+  return NUM_EVENTS / elapsed
+
+
+def main():
+  print '%-8s %18s %18s' % ('gates', 'single (events/s)', 'sharded (events/s)')
+  for num_gates in GATE_COUNTS:
+    print '%-8i %18.0f %18.0f' % (num_gates, _Run(num_gates, False),
+        _Run(num_gates, True))
+
+if __name__ == '__main__':
+  gflags.FLAGS(sys.argv)
+  main()
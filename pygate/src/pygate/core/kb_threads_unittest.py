@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""Unittest for kb_threads module"""
+
+import threading
+import time
+import unittest
+
+from pygate.core import alarm
+from pygate.core import kbevent
+from pygate.core import kb_threads
+from pygate.core.net import gatenet
+
+class _RecordingHandler(object):
+  """Minimal stand-in for a manager.Manager event handler."""
+  def __init__(self):
+    self.events = []
+    self.got_event = threading.Event()
+
+  def GetEventHandlers(self):
+    return {
+      kbevent.Ping: set([self._HandleEvent]),
+      kbevent.HeartbeatSecondEvent: set([self._HandleEvent]),
+    }
+
+  def GetStatus(self):
+    return []
+
+  def _HandleEvent(self, event):
+    self.events.append(event)
+    self.got_event.set()
+
+
+class _FakeEnv(object):
+  def __init__(self):
+    self._event_hub = kbevent.EventHub()
+    self._alarm_manager = alarm.AlarmManager()
+    self._gatenet_server = gatenet.GatenetServer(name='gatenet', kb_env=self,
+        addr='localhost:0')
+
+  def GetEventHub(self):
+    return self._event_hub
+
+  def GetAlarmManager(self):
+    return self._alarm_manager
+
+  def GetGatenetServer(self):
+    return self._gatenet_server
+
+
+class CoreEventLoopThreadTestCase(unittest.TestCase):
+  def setUp(self):
+    self.env = _FakeEnv()
+    self.manager = _RecordingHandler()
+    self.thread = kb_threads.CoreEventLoopThread(self.env, 'core-loop-thread')
+    self.thread.AddEventHandler(self.manager)
+    self.env.GetEventHub().AddListener(self.thread)
+    self.thread.start()
+
+  def tearDown(self):
+    self.env.GetEventHub().PublishEvent(kbevent.QuitEvent())
+    self.thread.join(2.0)
+    self.assert_(not self.thread.isAlive())
+
+  def _WaitForEvent(self, timeout=2.0):
+    self.assert_(self.manager.got_event.wait(timeout))
+    self.manager.got_event.clear()
+    return self.manager.events[-1]
+
+  def testCrossThreadPublish(self):
+    # Give the loop a moment to block in select.
+    time.sleep(0.1)
+    ping = kbevent.Ping()
+    start = time.time()
+    self.env.GetEventHub().PublishEvent(ping)
+    self.assertEqual(self._WaitForEvent(), ping)
+    self.assert_(time.time() - start < 0.5)
+
+  def testAlarmAndHeartbeat(self):
+    ping = kbevent.Ping()
+    self.env.GetAlarmManager().AddAlarm('ping', time.time() + 0.1, ping)
+    self.assertEqual(self._WaitForEvent(), ping)
+    event = self._WaitForEvent()
+    self.assert_(isinstance(event, kbevent.HeartbeatSecondEvent))
+
+class EventHandlerThreadTestCase(unittest.TestCase):
+  def testStats(self):
+    env = _FakeEnv()
+    handler = _RecordingHandler()
+    thr = kb_threads.EventHandlerThread(env, 'service-thread')
+    thr.AddEventHandler(handler)
+    for i in xrange(3):
+      thr.PostEvent(kbevent.Ping())
+    thr.PostEvent(kbevent.HeartbeatSecondEvent())
+    self.assertEqual(len(thr._Step(timeout=0)), 4)
+    self.assertEqual(len(handler.events), 4)
+
+    stats = thr.GetStats()
+    self.assertEqual(stats['queue']['residence']['count'], 4)
+    calls = dict((h['event'], h['calls']) for h in stats['handlers'])
+    self.assertEqual(calls, {'Ping': 3, 'HeartbeatSecondEvent': 1})
+    self.assertEqual(stats['handlers'][0]['handler'],
+        '_RecordingHandler._HandleEvent')
+    self.assert_([l for l in thr.GetStatus() if l.startswith('Ping ')])
+
+    hub = env.GetEventHub()
+    hub.PublishEvent(kbevent.Ping())
+    self.assertEqual(hub.DispatchEvents(timeout=0), 1)
+    self.assertEqual(hub.GetStats()['residence']['count'], 1)
+
+  def testPendingAck(self):
+    env = _FakeEnv()
+    thr = kb_threads.EventHandlerThread(env, 'service-thread')
+    thr.AddEventHandler(_RecordingHandler())
+    hub = env.GetEventHub()
+    hub.AddListener(thr)
+    acks = []
+    event = kbevent.Ping()
+    event.pending_ack = kbevent.PendingAck(lambda: acks.append(event))
+    hub.PublishEvent(event)
+    hub.DispatchEvents(timeout=0)
+    # Acknowledged only once the thread has handled it.
+    self.assertEqual(acks, [])
+    thr._Step(timeout=0)
+    self.assertEqual(acks, [event])
+
+
+class _FakeGateManager(object):
+  def __init__(self, gate_names, groups):
+    self._index = {}
+    for name in gate_names:
+      self._index[name] = (name,)
+    for group, members in groups.iteritems():
+      self._index[group] = tuple(m for m in members if m in gate_names)
+
+  def GetGatesForName(self, name):
+    return self._index.get(name, ())
+
+
+class GateShardThreadTestCase(unittest.TestCase):
+  def testShardForGate(self):
+    names = ['gate%i' % i for i in xrange(100)]
+    shards = [kb_threads.ShardForGate(n, 4) for n in names]
+    self.assertEqual(shards, [kb_threads.ShardForGate(n, 4) for n in names])
+    self.assertEqual(sorted(set(shards)), [0, 1, 2, 3])
+    self.assertEqual(kb_threads.ShardForGate('gate0', 1), 0)
+
+  def testRouting(self):
+    gate_manager = _FakeGateManager(['gate0', 'gate2'],
+        {'bar': ['gate1', 'gate2'], 'patio': ['gate1']})
+    thr = kb_threads.GateShardThread(_FakeEnv(), 'shard-0-thread',
+        gate_manager)
+    posted = [
+      kbevent.LatchRequest(gate_name='gate0'),
+      kbevent.LatchRequest(gate_name='gate1'),
+      kbevent.TokenAuthEvent(gate_name='bar'),
+      kbevent.TokenAuthEvent(gate_name='patio'),
+      kbevent.MeterUpdate(gate_name='gate2'),
+      kbevent.HeartbeatSecondEvent(),
+    ]
+    for event in posted:
+      thr.PostEvent(event)
+    queued = []
+    while not thr._event_queue.empty():
+      queued_at, event = thr._event_queue.get()
+      queued.append(event)
+    self.assertEqual(queued, [posted[0], posted[2], posted[4], posted[5]])
+    self.assertEqual(thr.skipped, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
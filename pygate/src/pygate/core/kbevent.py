@@ -24,28 +24,54 @@ This module implements a very simple inter-process event passing system
 
 import logging
 import Queue
+import threading
+import time
 
 import gflags
 
 from pygate.core import kbjson
+from pygate.core import tracing
 from pygate.core import util
 
 FLAGS = gflags.FLAGS
 
+_logger = logging.getLogger('kbevent')
+
 gflags.DEFINE_boolean('debug_events', False,
     'If true, logs debugging information about internal events.')
 
-class Event(util.BaseMessage):
+gflags.DEFINE_integer('event_batch_size', 64,
+    'Maximum number of queued events drained and dispatched in a single pass '
+    'by the event hub and event handler threads.  Set to 1 to dispatch one '
+    'event at a time.',
+    lower_bound=1)
+
+class Event(util.SlotsMessage):
+  # Not sent on the wire: the PendingAck of an event whose sender wants to
+  # know it has been handled.
+  __slots__ = ('pending_ack',)
+
+  # Latency trace; see the tracing module.  Unset unless the event is traced.
+  trace_id = util.BaseField()
+  trace = util.BaseField()
+  # Set by a gatenet client on events sent from its journal; the core answers
+  # with an EventAck carrying the same value once the event is handled.
+  journal_seq = util.BaseField()
+
   def __init__(self, initial=None, encoded=None, **kwargs):
-    util.BaseMessage.__init__(self, initial, **kwargs)
+    self.pending_ack = None
+    util.SlotsMessage.__init__(self, initial, **kwargs)
     if encoded is not None:
       self.DecodeFromString(encoded)
 
   def ToDict(self):
-    data = {}
-    for field_name, value in self._values.iteritems():
-      data[field_name] = value
-
+    data = self.AsDict()
+    # Keep untraced and unjournaled events as they were on the wire.
+    if self.trace_id is None:
+      del data['trace_id']
+      del data['trace']
+    if self.journal_seq is None:
+      del data['journal_seq']
     ret = {
       'event': self.__class__.__name__,
       'data': data,
@@ -53,10 +79,13 @@ class Event(util.BaseMessage):
     return ret
 
   def ToJson(self, indent=2):
-    return kbjson.dumps(self.ToDict(), indent=indent)
+    return _JSON_CODEC.dumps(self.ToDict(), indent=indent)
 
 EventField = util.BaseField
 
+class DatetimeField(EventField):
+  """An EventField holding a datetime.datetime, in local time."""
+
 class Ping(Event):
   pass
 
@@ -81,18 +110,23 @@ class LatchUpdate(Event):
   gate_name = EventField()
   state = EventField()
   username = EventField()
-  start_time = EventField()
-  last_activity_time = EventField()
+  start_time = DatetimeField()
+  last_activity_time = DatetimeField()
 
 class GateIdleEvent(Event):
   gate_name = EventField()
 
+class LatchIdleEvent(Event):
+  """Posted by an alarm when a latch's idle deadline has passed."""
+  latch_id = EventField()
+  gate_name = EventField()
+
 class EntryCreatedEvent(Event):
   latch_id = EventField()
   entry_id = EventField()
   gate_name = EventField()
-  start_time = EventField()
-  end_time = EventField()
+  start_time = DatetimeField()
+  end_time = DatetimeField()
   username = EventField()
 
 class TokenAuthEvent(Event):
@@ -103,6 +137,24 @@ class TokenAuthEvent(Event):
   auth_device_name = EventField()
   token_value = EventField()
   status = EventField()
+  # When the token was seen, as time.time() on the sender.
+  seen_at = EventField()
+  # Set on events sent from a client's journal: seconds from seen_at to the
+  # send, on the sender's clock.  Unset events are live.
+  age = EventField()
+
+class AuthTokenChangedEvent(Event):
+  """Tells the core that a token, or with no fields set every token, may
+  have changed, so that any cached copy is dropped."""
+  auth_device = EventField()
+  token_value = EventField()
+
+class BackendCallCompleteEvent(Event):
+  """Result of a call made through an asyncbackend.AsyncBackend.  Only
+  published within the core."""
+  call_id = EventField()
+  result = EventField()
+  error = EventField()
 
 class ThermoEvent(Event):
   sensor_name = EventField()
@@ -116,6 +168,31 @@ class LatchRequest(Event):
   gate_name = EventField()
   request = EventField()
 
+class SubscriptionRequest(Event):
+  """Sent by a gatenet client to limit the events the core pushes to it.
+
+  Both fields are lists; an empty or missing list matches everything.
+  |event_types| holds event class names, and |gate_names| holds shell-style
+  patterns (as for fnmatch) matched against each event's gate_name.
+  """
+  event_types = EventField()
+  gate_names = EventField()
+
+class EventAck(Event):
+  """Sent by the core once it has handled the event a gatenet client sent
+  with journal_seq |seq|."""
+  seq = EventField()
+
+class EncodingRequest(Event):
+  """Negotiates the encoding of messages on a gatenet connection.
+
+  A client sends |encoding| ("json" or "binary") and the binary
+  |schema_version| it was built with; the core answers with the encoding it
+  will use from then on.  See pygate.core.net.binproto.
+  """
+  encoding = EventField()
+  schema_version = EventField()
+
 class HeartbeatSecondEvent(Event):
   pass
 
@@ -130,63 +207,200 @@ for cls in Event.__subclasses__():
   name = cls.__name__
   EVENT_NAME_TO_CLASS[name] = cls
 
+_JSON_CODEC = kbjson.Codec(datetime_fields=set(name
+    for cls in EVENT_NAME_TO_CLASS.itervalues()
+    for name, field in cls.class_fields.iteritems()
+    if isinstance(field, DatetimeField)))
+
 def DecodeEvent(msg):
+  if isinstance(msg, Event):
+    return msg
   if isinstance(msg, basestring):
-    msg = kbjson.loads(msg)
+    msg = _JSON_CODEC.loads(msg)
+  if not isinstance(msg, dict):
+    raise ValueError, "Malformed event: not an object"
   event_name = msg.get('event')
   if event_name not in EVENT_NAME_TO_CLASS:
     raise ValueError, "Unknown event: %s" % event_name
+  data = msg.get('data')
+  if not isinstance(data, dict):
+    raise ValueError, "Malformed event: %s has no data" % event_name
   inst = EVENT_NAME_TO_CLASS[event_name]()
-  for k, v in msg['data'].iteritems():
+  fields = inst.class_fields
+  for k, v in data.iteritems():
+    if k not in fields:
+      # Sent by a newer peer, or an older version of the event; events have
+      # no __dict__ to hold it.
+      _logger.warning('Ignoring unknown field %s of %s' % (k, event_name))
+      continue
     setattr(inst, k, v)
   return inst
 
+class PendingAck(object):
+  """Calls |callback| once every holder of an event has released it.
+
+  Whatever queues such an event for later handling holds it until the
+  event has been handled; see EventHub._DispatchEvent.
+  """
+  def __init__(self, callback):
+    self._callback = callback
+    self._holds = 0
+    self._lock = threading.Lock()
+
+  @util.synchronized
+  def Hold(self):
+    self._holds += 1
+
+  def Release(self):
+    self._lock.acquire()
+    try:
+      self._holds -= 1
+      done = not self._holds
+    finally:
+      self._lock.release()
+    if done:
+      self._callback()
+
+# Sentinel accepted by EventHub.AddListener: subscribe to every event.
+ALL_EVENTS = (Event,)
+
 class EventHub(object):
-  """Central sink and publish of events."""
+  """Central sink and publish of events.
+
+  Listeners subscribe to one or more Event classes.  The hub keeps an index
+  mapping each concrete event class to the listeners interested in it, so
+  dispatching an event only touches those listeners.
+  """
   def __init__(self):
-    self._event_listeners = set()
+    self._event_listeners = {}
+    self._dispatch_index = {}
     self._event_queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._stats = util.QueueStats('hub')
+    self._wakeup_callback = None
     self._logger = logging.getLogger('eventhub')
 
-  def AddListener(self, listener):
+  @util.synchronized
+  def AddListener(self, listener, event_types=None):
     """Attach a listener, to be notified on receipt of a new event.
 
     The listener must implement the PostEvent(event) method.
-    """
-    if listener not in self._event_listeners:
-      self._event_listeners.add(listener)
 
+    |event_types| is a sequence of Event classes the listener is interested
+    in; events which are instances of any of them (including subclasses) will
+    be delivered.  If not given, the listener's GetEventTypes() method is used
+    when it has one.  Pass ALL_EVENTS to receive every event; listeners which
+    declare no types at all are treated the same way.
+
+    Adding an already-attached listener replaces its subscription.
+    """
+    if event_types is None:
+      get_types = getattr(listener, 'GetEventTypes', None)
+      if get_types is not None:
+        event_types = get_types()
+      else:
+        event_types = ALL_EVENTS
+    self._event_listeners[listener] = tuple(event_types)
+    self._dispatch_index = {}
+
+  @util.synchronized
   def RemoveListener(self, listener):
     """Remove (by reference) an already-listening listener."""
     if listener in self._event_listeners:
-      self._event_listeners.remove(listener)
+      del self._event_listeners[listener]
+      self._dispatch_index = {}
+
+  def SetWakeupCallback(self, callback):
+    """Sets a function to be called whenever an event is published.
+
+    This lets a dispatcher which is not blocked on the event queue (such as
+    the core event loop) learn about new events immediately.
+    """
+    self._wakeup_callback = callback
 
   def PublishEvent(self, event):
     """Add a new event to the queue of events to publish.
 
     Events are dispatched to listeners in the DispatchNextEvent method.
     """
-    self._event_queue.put(event)
+    self._event_queue.put((time.time(), event))
+    # Read once: the callback may be cleared by another thread.
+    callback = self._wakeup_callback
+    if callback is not None:
+      callback()
 
   def _IterEventListeners(self):
     """Iterate through all listeners."""
-    for listener in self._event_listeners:
+    for listener in self._event_listeners.keys():
       yield listener
 
+  @util.synchronized
+  def _BuildListenersForClass(self, event_cls):
+    """Computes and caches the listeners for the event class |event_cls|."""
+    listeners = tuple(listener for listener, event_types
+        in self._event_listeners.iteritems()
+        if issubclass(event_cls, event_types))
+    self._dispatch_index[event_cls] = listeners
+    return listeners
+
+  def GetListenersForEvent(self, event):
+    """Returns the listeners subscribed to |event|."""
+    event_cls = event.__class__
+    listeners = self._dispatch_index.get(event_cls)
+    if listeners is None:
+      listeners = self._BuildListenersForClass(event_cls)
+    return listeners
+
   def _WaitForEvent(self, timeout=None):
     """Wait for a new event to be enqueued."""
     try:
-      ev = self._event_queue.get(block=True, timeout=timeout)
+      queued_at, ev = self._event_queue.get(block=True, timeout=timeout)
     except Queue.Empty:
-      ev = None
+      return None
+    self._stats.RecordResidence(time.time() - queued_at)
     return ev
 
   def DispatchNextEvent(self, timeout=None):
-    """Wait for an event, and dispatch it to all listeners."""
+    """Wait for an event, and dispatch it to all interested listeners."""
     ev = self._WaitForEvent(timeout)
     if ev:
-      if FLAGS.debug_events:
-        self._logger.debug('Publishing event: %s ' % ev)
-      for listener in self._IterEventListeners():
-        listener.PostEvent(ev)
+      self._DispatchEvent(ev)
 
+  def DispatchEvents(self, timeout=None, max_events=None):
+    """Wait for an event, then dispatch it and any others already queued.
+
+    At most |max_events| (default: --event_batch_size) events are dispatched.
+    Returns the number of events dispatched.
+    """
+    if max_events is None:
+      max_events = FLAGS.event_batch_size
+    batch = util.GetQueueBatch(self._event_queue, max_events, timeout)
+    if batch:
+      self._stats.Record(len(batch), self._event_queue.qsize())
+      now = time.time()
+      for queued_at, ev in batch:
+        self._stats.RecordResidence(now - queued_at)
+      for queued_at, ev in batch:
+        self._DispatchEvent(ev)
+    return len(batch)
+
+  def _DispatchEvent(self, ev):
+    if FLAGS.debug_events:
+      self._logger.debug('Publishing event: %s ' % ev)
+    tracing.Stamp(ev, 'hub_dispatch')
+    # Held while dispatching, so that listeners which handle |ev| right away
+    # do not need to; listeners which queue it hold it themselves.
+    ack = ev.pending_ack
+    if ack is not None:
+      ack.Hold()
+    for listener in self.GetListenersForEvent(ev):
+      listener.PostEvent(ev)
+    if ack is not None:
+      ack.Release()
+
+  def GetStatus(self):
+    return self._stats.GetStatus(self._event_queue)
+
+  def GetStats(self):
+    """Returns the queue counters as a dict."""
+    return self._stats.AsDict(self._event_queue)
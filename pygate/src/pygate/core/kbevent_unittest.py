@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Unittest for kbevent module"""
+
+import unittest
+
+from pygate.core import kbevent
+
+class _Listener(object):
+  def __init__(self, event_types=None):
+    self.events = []
+    if event_types is not None:
+      self.GetEventTypes = lambda: event_types
+
+  def PostEvent(self, event):
+    self.events.append(event)
+
+
+class DecodeEventTestCase(unittest.TestCase):
+  def testUnknownField(self):
+    event = kbevent.DecodeEvent(
+        '{"event": "Ping", "data": {"x": 1}}')
+    self.assert_(isinstance(event, kbevent.Ping))
+    event = kbevent.DecodeEvent('{"event": "LatchRequest", '
+        '"data": {"gate_name": "gate0", "new_field": true}}')
+    self.assertEqual(event.gate_name, 'gate0')
+
+
+class EventHubTestCase(unittest.TestCase):
+  def setUp(self):
+    self.hub = kbevent.EventHub()
+
+  def _Dispatch(self, event):
+    self.hub.PublishEvent(event)
+    self.hub.DispatchNextEvent(timeout=0)
+
+  def testTypedDispatch(self):
+    quit_listener = _Listener((kbevent.QuitEvent,))
+    latch_listener = _Listener()
+    self.hub.AddListener(quit_listener)
+    self.hub.AddListener(latch_listener, (kbevent.LatchUpdate,))
+
+    self._Dispatch(kbevent.HeartbeatSecondEvent())
+    self.assertEqual(quit_listener.events, [])
+    self.assertEqual(latch_listener.events, [])
+
+    latch_update = kbevent.LatchUpdate()
+    self._Dispatch(latch_update)
+    self.assertEqual(latch_listener.events, [latch_update])
+    self.assertEqual(quit_listener.events, [])
+
+    quit_event = kbevent.QuitEvent()
+    self._Dispatch(quit_event)
+    self.assertEqual(quit_listener.events, [quit_event])
+    self.assertEqual(latch_listener.events, [latch_update])
+
+  def testWildcard(self):
+    explicit = _Listener()
+    legacy = _Listener()
+    self.hub.AddListener(explicit, kbevent.ALL_EVENTS)
+    self.hub.AddListener(legacy)
+
+    ping = kbevent.Ping()
+    self._Dispatch(ping)
+    self.assertEqual(explicit.events, [ping])
+    self.assertEqual(legacy.events, [ping])
+
+  def testIndexInvalidation(self):
+    listener = _Listener((kbevent.Ping,))
+    self.hub.AddListener(listener)
+    self._Dispatch(kbevent.Ping())
+    self.assertEqual(len(listener.events), 1)
+
+    # Re-adding replaces the subscription.
+    self.hub.AddListener(listener, (kbevent.QuitEvent,))
+    self._Dispatch(kbevent.Ping())
+    self.assertEqual(len(listener.events), 1)
+
+    self.hub.RemoveListener(listener)
+    self._Dispatch(kbevent.QuitEvent())
+    self.assertEqual(len(listener.events), 1)
+
+  def testBatchDispatch(self):
+    listener = _Listener()
+    self.hub.AddListener(listener)
+    for i in xrange(5):
+      self.hub.PublishEvent(kbevent.Ping())
+    self.assertEqual(self.hub.DispatchEvents(timeout=0, max_events=3), 3)
+    self.assertEqual(len(listener.events), 3)
+    self.assertEqual(self.hub.DispatchEvents(timeout=0, max_events=3), 2)
+    self.assertEqual(self.hub.DispatchEvents(timeout=0, max_events=3), 0)
+    self.assertEqual(len(listener.events), 5)
+    self.assert_(self.hub.GetStatus())
+
+if __name__ == '__main__':
+  unittest.main()
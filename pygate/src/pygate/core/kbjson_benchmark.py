@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""Compares kbjson's loads/dumps with a schema-aware kbjson.Codec.
+
+Run with DJANGO_SETTINGS_MODULE set, or with no Django settings at all (the
+local timezone then defaults to UTC).
+"""
+
+import datetime
+import os
+import timeit
+
+from django.conf import settings
+if not os.environ.get('DJANGO_SETTINGS_MODULE') and not settings.configured:
+  settings.configure(TIME_ZONE='UTC')
+
+from pygate.core import kbjson
+
+NUM_ITERATIONS = 20000
+
+_NOW = datetime.datetime(2010, 7, 4, 12, 30, 45)
+SAMPLE = {
+  'event': 'LatchUpdate',
+  'data': {
+    'latch_id': 1234,
+    'gate_name': 'building1.front',
+    'state': 'active',
+    'username': 'someone',
+    'start_time': _NOW,
+    'last_activity_time': _NOW,
+  },
+}
+
+CODEC = kbjson.Codec(datetime_fields=['start_time', 'last_activity_time'])
+ENCODED = kbjson.dumps(SAMPLE, indent=None)
+
+def _Time(stmt):
+  total = timeit.Timer(stmt, 'from __main__ import kbjson, CODEC, SAMPLE, '
+      'ENCODED').timeit(NUM_ITERATIONS)
+  return total / NUM_ITERATIONS * 1e6
+
+def main():
+  print 'json library: %s' % kbjson._fast_json.__name__
+  print '%-8s %12s %12s' % ('', 'legacy (us)', 'codec (us)')
+  print '%-8s %12.2f %12.2f' % ('dumps',
+      _Time('kbjson.dumps(SAMPLE, indent=None)'),
+      _Time('CODEC.dumps(SAMPLE, indent=None)'))
+  print '%-8s %12.2f %12.2f' % ('loads',
+      _Time('kbjson.loads(ENCODED)'),
+      _Time('CODEC.loads(ENCODED)'))
+
+if __name__ == '__main__':
+  main()
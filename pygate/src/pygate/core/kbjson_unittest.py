@@ -44,6 +44,28 @@ class JsonTestCase(unittest.TestCase):
     self.assertEqual(obj.iso_time, expected_date)
     self.assertEqual(obj.bad_time, "123-45")  # fails strptime
 
+  def testCodec(self):
+    codec = kbjson.Codec(datetime_fields=['iso_time', 'bad_time'])
+    obj = codec.loads(SAMPLE_INPUT)
+    self.assertEqual(obj['event'], "my-event")
+    self.assertEqual(obj['sub']['list'], [1,2,3])
+    self.assertEqual(obj['iso_time'], kbjson.loads(SAMPLE_INPUT).iso_time)
+    self.assertEqual(obj['bad_time'], "123-45")
+
+    # Undeclared fields are left alone.
+    obj = kbjson.Codec().loads(SAMPLE_INPUT)
+    self.assertEqual(obj['iso_time'], "2010-06-11T23:01:01Z")
+
+    # Output matches dumps, and nested declared fields are decoded.
+    now = datetime.datetime(2010, 7, 4, 12, 30, 45)
+    value = {'iso_time': now, 'items': [{'iso_time': now}]}
+    encoded = codec.dumps(value, indent=None)
+    self.assertEqual(encoded, kbjson.dumps(value, indent=None))
+    decoded = codec.loads(encoded)
+    self.assertEqual(decoded['iso_time'], now)
+    self.assertEqual(decoded['items'][0]['iso_time'], now)
+    self.assertRaises(TypeError, codec.dumps, object())
+
 if __name__ == '__main__':
   unittest.main()
 
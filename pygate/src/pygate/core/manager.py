@@ -20,15 +20,29 @@
 
 import datetime
 import inspect
+import itertools
 import time
 import threading
 import logging
+import Queue
+
+import gflags
 
 from pygate.core import backend
 from pygate.core import kb_common
 from pygate.core import kbevent
+from pygate.core import tokencache
+from pygate.core import tracing
 from pygate.core import util
 
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('entry_write_queue_size', 1000,
+    'Maximum number of completed latches waiting to be recorded.  When the '
+    'queue is full, latch handling waits for the entry writer.')
+
+gflags.DEFINE_integer('entry_write_batch_size', 50,
+    'Maximum number of entries recorded in one backend transaction.')
 
 
 class GateManagerError(Exception):
@@ -91,14 +105,18 @@ class GateManager(Manager):
   def __init__(self, name, event_hub):
     Manager.__init__(self, name, event_hub)
     self._gates = {}
+    # Maps group name to the names of its member gates.
+    self._groups = {}
+    # Maps gate or group name to the tuple of registered Gates it names.
+    # Rebuilt whenever gates or groups change, which is rare.
+    self._gate_index = {}
+    self._RebuildIndex()
 
   def GetStatus(self):
     ret = []
-    for gate in self.GetAllGates():
-      meter = gate.GetMeter()
+    for gate in sorted(self.GetAllGates(), key=Gate.GetName):
       ret.append('Gate "%s"' % gate.GetName())
-      ret.append('  last activity: %s' % (meter.GetLastActivity(),))
-      ret.append('')
+    return ret
 
   def GateExists(self, name):
     return name in self._gates
@@ -115,11 +133,42 @@ class GateManager(Manager):
     if self.GateExists(name):
       raise AlreadyRegisteredError
     self._gates[name] = Gate(name)
+    self._RebuildIndex()
 
   def UnregisterGate(self, name):
     self._logger.info('Unregistering gate: %s' % name)
     self._CheckGateExists(name)
     del self._gates[name]
+    self._RebuildIndex()
+
+  def SetGateGroup(self, group_name, gate_names):
+    """Defines a named group of gates; an empty list removes the group.
+
+    Gates in the group need not be registered yet.  A group name hides any
+    gate with the same name.
+    """
+    if group_name == kb_common.ALIAS_ALL_GATES:
+      raise GateManagerError('%s is reserved' % group_name)
+    if gate_names:
+      self._groups[group_name] = tuple(gate_names)
+    else:
+      self._groups.pop(group_name, None)
+    self._RebuildIndex()
+
+  def _RebuildIndex(self):
+    index = {}
+    for name, gate in self._gates.iteritems():
+      index[name] = (gate,)
+    for group_name, gate_names in self._groups.iteritems():
+      index[group_name] = tuple(self._gates[n] for n in gate_names
+          if n in self._gates)
+    index[kb_common.ALIAS_ALL_GATES] = tuple(self._gates.values())
+    self._gate_index = index
+
+  def GetGatesForName(self, name):
+    """Returns the gates named by a gate name, group name or
+    kb_common.ALIAS_ALL_GATES, or an empty tuple."""
+    return self._gate_index.get(name, ())
 
   def GetGate(self, name):
     self._CheckGateExists(name)
@@ -131,7 +180,8 @@ class GateManager(Manager):
     return delta
 
 class Latch:
-  def __init__(self, gate, latch_id, username=None, max_idle_secs=10):
+  def __init__(self, gate, latch_id, username=None, max_idle_secs=10,
+      trace=None):
     self._gate = gate
     self._latch_id = latch_id
     self._bound_username = username
@@ -140,6 +190,7 @@ class Latch:
     self._start_time = datetime.datetime.now()
     self._end_time = None
     self._last_log_time = None
+    self._trace = trace
 
   def __str__(self):
     return '<Latch 0x%08x: gate=%s username=%s max_idle=%s>' % (self._latch_id,
@@ -161,6 +212,8 @@ class Latch:
       end = self._end_time
     event.last_activity_time = end
 
+    if self._trace is not None:
+      self._trace.ApplyTo(event)
     return event
 
   def GetId(self):
@@ -199,6 +252,18 @@ class Latch:
   def GetGate(self):
     return self._gate
 
+  def GetTrace(self):
+    return self._trace
+
+  def RecordActivity(self):
+    self._end_time = datetime.datetime.now()
+
+  def GetIdleDeadline(self):
+    """Returns the time.time() at which this latch becomes idle."""
+    remaining = self.GetMaxIdleTime() - self.GetIdleTime()
+    return time.time() + remaining.days * 86400 + remaining.seconds + (
+        remaining.microseconds / 1e6)
+
   def IsIdle(self):
     return self.GetIdleTime() > self.GetMaxIdleTime()
 
@@ -213,13 +278,23 @@ class LatchManager(Manager):
   Gates can be started in multiple ways:
     - Explicitly, by a call to OpenLatch
     - Implicitly, by a call to HandleGateActivity
+
+  Each latch has one alarm, on |alarm_manager|, set for when it becomes idle
+  and moved whenever the latch sees activity.
+
+  LatchManagers sharing an alarm manager must share |latch_ids|, an
+  iterator of latch identifiers, so that their ids never collide.
   """
-  def __init__(self, name, event_hub, gate_manager):
+  def __init__(self, name, event_hub, gate_manager, alarm_manager,
+      latch_ids=None):
     Manager.__init__(self, name, event_hub)
     self._gate_manager = gate_manager
+    self._alarm_manager = alarm_manager
     self._latch_map = {}
     self._logger = logging.getLogger("latchmanager")
-    self._next_latch_id = int(time.time())
+    if latch_ids is None:
+      latch_ids = itertools.count(int(time.time()))
+    self._latch_ids = latch_ids
     self._lock = threading.Lock()
 
   @util.synchronized
@@ -228,9 +303,7 @@ class LatchManager(Manager):
 
     Latch IDs are simply sequence numbers, used around the core to disambiguate
     latches."""
-    ret = self._next_latch_id
-    self._next_latch_id += 1
-    return ret
+    return self._latch_ids.next()
 
   def GetStatus(self):
     ret = []
@@ -254,7 +327,12 @@ class LatchManager(Manager):
   def GetLatch(self, gate_name):
     return self._latch_map.get(gate_name)
 
-  def OpenLatch(self, gate_name, username='', max_idle_secs=10):
+  def OpenLatch(self, gate_name, username='', max_idle_secs=10, trace=None):
+    """Starts a latch on |gate_name|, or renews the user's existing one.
+
+    |trace| is the tracing.Trace of the token which opened the latch, if any;
+    a new latch carries a copy of it through to its entry.
+    """
     try:
       gate = self._gate_manager.GetGate(gate_name)
     except UnknownGateError:
@@ -277,14 +355,20 @@ class LatchManager(Manager):
     if current and current.GetUsername() == username:
       # Existing latch owned by this username.  Just poke it.
       current.SetMaxIdle(max_idle_secs)
+      current.RecordActivity()
+      self._ScheduleIdleAlarm(current)
       self._PublishUpdate(current)
       return current
     else:
       # No existing latch; start a new one.
+      if trace is not None:
+        trace = trace.Copy()
+        trace.Stamp('latch_open')
       new_latch = Latch(gate, latch_id=self._GetNextLatchId(), username=username,
-          max_idle_secs=max_idle_secs)
+          max_idle_secs=max_idle_secs, trace=trace)
       self._latch_map[gate_name] = new_latch
       self._logger.info('Opening latch: %s' % new_latch)
+      self._ScheduleIdleAlarm(new_latch)
       self._PublishUpdate(new_latch)
       """self.UpdateLatch(gate_name, 10)"""
       return new_latch
@@ -304,6 +388,9 @@ class LatchManager(Manager):
     self._logger.info('Closing latch: %s' % latch)
     gate = latch.GetGate()
     del self._latch_map[gate_name]
+    self._alarm_manager.CancelAlarm(self._IdleAlarmName(latch))
+    if latch.GetTrace() is not None:
+      latch.GetTrace().Stamp('latch_close')
     self._StateChange(latch, kbevent.LatchUpdate.LatchState.COMPLETED)
     return latch
 
@@ -325,6 +412,8 @@ class LatchManager(Manager):
 
     is_new = False
     latch = self.GetLatch(gate_name)
+    latch.RecordActivity()
+    self._ScheduleIdleAlarm(latch)
 
     if latch.GetState() != kbevent.LatchUpdate.LatchState.ACTIVE:
       self._StateChange(latch, kbevent.LatchUpdate.LatchState.ACTIVE)
@@ -341,13 +430,28 @@ class LatchManager(Manager):
     event = latch.GetUpdateEvent()
     self._PublishEvent(event)
 
-  @EventHandler(kbevent.HeartbeatSecondEvent)
-  def _HandleHeartbeatEvent(self, event):
-    for latch in self.GetActiveLatches():
-      if latch.IsIdle():
-        self._logger.info('Latch has become too idle, ending: %s' % latch)
-        self._StateChange(latch, kbevent.LatchUpdate.LatchState.IDLE)
-        self.CloseLatch(latch.GetGate().GetName())
+  def _IdleAlarmName(self, latch):
+    return 'latch-idle-%i' % latch.GetId()
+
+  def _ScheduleIdleAlarm(self, latch):
+    event = kbevent.LatchIdleEvent(latch_id=latch.GetId(),
+        gate_name=latch.GetGate().GetName())
+    self._alarm_manager.SetAlarm(self._IdleAlarmName(latch),
+        latch.GetIdleDeadline(), event)
+
+  @EventHandler(kbevent.LatchIdleEvent)
+  def _HandleLatchIdleEvent(self, event):
+    latch = self.GetLatch(event.gate_name)
+    if not latch or latch.GetId() != event.latch_id:
+      # Closed, or replaced, since the alarm was set.
+      return
+    if not latch.IsIdle():
+      # Activity raced with the alarm firing.
+      self._ScheduleIdleAlarm(latch)
+      return
+    self._logger.info('Latch has become too idle, ending: %s' % latch)
+    self._StateChange(latch, kbevent.LatchUpdate.LatchState.IDLE)
+    self.CloseLatch(latch.GetGate().GetName())
 
   @EventHandler(kbevent.LatchRequest)
   def _HandleLatchRequestEvent(self, event):
@@ -357,14 +461,26 @@ class LatchManager(Manager):
       self.CloseLatch(event.gate_name)
 
 class EntryManager(Manager):
+  """Records completed latches as entries.
+
+  Entries are written behind: the service thread only queues them, and
+  WriteEntries(), called from the entry writer thread, records them in
+  batches.  EntryCreatedEvent is published once an entry is committed.
+  """
   def __init__(self, name, event_hub, backend):
     Manager.__init__(self, name, event_hub)
     self._backend = backend
     self._last_entry = None
+    self._queue = Queue.Queue(FLAGS.entry_write_queue_size)
+    self._queue_stats = util.QueueStats('entry')
+    self._write_lock = threading.Lock()
+    self.failed = 0
 
   def GetStatus(self):
     ret = []
     ret.append('Last entry: %s' % self._last_entry)
+    ret.extend(self._queue_stats.GetStatus(self._queue))
+    ret.append('entry failures: %i' % self.failed)
     return ret
 
   @EventHandler(kbevent.LatchUpdate)
@@ -376,21 +492,77 @@ class EntryManager(Manager):
   def _HandleLatchEnded(self, event):
     self._logger.info('Latch completed: latch_id=0x%08x' % event.latch_id)
 
-    username = event.username
-    gate_name = event.gate_name
-    pour_time = event.last_activity_time
-    duration = (event.last_activity_time - event.start_time).seconds
-    latch_id = event.latch_id
-
     # TODO: add to latch event
     auth_token = None
 
     # Log the entry.  If the username is empty or invalid, the backend will
     # assign it to the default (anonymous) user.  The backend will assign the
     # entry to a gate.
-    d = self._backend.RecordEntry(gate_name, username=username,
-        pour_time=pour_time, duration=duration, auth_token=auth_token)
+    entry = {
+      'gate_name': event.gate_name,
+      'username': event.username,
+      'pour_time': event.last_activity_time,
+      'duration': (event.last_activity_time - event.start_time).seconds,
+      'auth_token': auth_token,
+    }
+    if self._queue.full():
+      self._logger.warning('Entry queue full, waiting for the entry writer.')
+    self._queue.put((event.latch_id, entry,
+        tracing.Fork(event, 'entry_queued')))
+
+  def WriteEntries(self, timeout=None):
+    """Waits up to |timeout| for queued entries and records a batch of them.
+
+    Returns the number of entries taken from the queue.
+    """
+    self._write_lock.acquire()
+    try:
+      batch = util.GetQueueBatch(self._queue, FLAGS.entry_write_batch_size,
+          timeout)
+      if not batch:
+        return 0
+      self._queue_stats.Record(len(batch), self._queue.qsize())
+      traces = [trace for _, _, trace in batch if trace is not None]
+      for trace in traces:
+        trace.Stamp('entry_write')
+      results = self._RecordBatch([e for _, e, _ in batch])
+      for trace in traces:
+        trace.Stamp('entry_recorded')
+      for (latch_id, entry, trace), d in zip(batch, results):
+        if isinstance(d, Exception):
+          self.failed += 1
+          self._logger.error('Could not record entry %s: %s' % (entry, d))
+          continue
+        self._EntryRecorded(latch_id, entry['gate_name'], d, trace)
+      return len(batch)
+    finally:
+      self._write_lock.release()
+
+  def FlushEntries(self):
+    """Records every queued entry.  Called on shutdown."""
+    while self.WriteEntries(timeout=0):
+      pass
 
+  def _RecordBatch(self, entries):
+    """Returns, for each of |entries|, the recorded entry or the exception
+    which prevented recording it."""
+    try:
+      return self._backend.RecordEntries(entries)
+    except backend.BackendError, e:
+      if len(entries) == 1:
+        return [e]
+      # The backend recorded none of the batch; don't let one bad entry cost
+      # the rest of it.
+      self._logger.warning('Batch of %i entries failed (%s); recording '
+          'them one at a time.' % (len(entries), e))
+      return [self._RecordBatch([entry])[0] for entry in entries]
+    except Exception, e:
+      # Database errors and the like must not kill the entry writer.
+      self._logger.error('Recording %i entries failed:' % len(entries))
+      util.LogTraceback(self._logger.error)
+      return [e] * len(entries)
+
+  def _EntryRecorded(self, latch_id, gate_name, d, trace=None):
     if not d:
       self._logger.warning('No entry recorded (spillage?).')
       return
@@ -411,6 +583,9 @@ class EntryManager(Manager):
     created.end_time = d.pour_time
     if d.user_id:
       created.username = d.user_id
+    if trace is not None:
+      trace.ApplyTo(created)
+      tracing.GetTracer().Finish(created)
     self._PublishEvent(created)
 
 class TokenRecord:
@@ -456,24 +631,61 @@ class TokenRecord:
 
 
 class AuthenticationManager(Manager):
-  def __init__(self, name, event_hub, latch_manager, gate_manager, backend):
+  def __init__(self, name, event_hub, latch_manager, gate_manager,
+      async_backend):
     Manager.__init__(self, name, event_hub)
     self._latch_manager = latch_manager;
     self._gate_manager = gate_manager
-    self._backend = backend
+    self._backend = async_backend
     self._tokens = {}  # maps gate name to currently active token
     self._lock = threading.RLock()
+    self._token_cache = tokencache.TokenCache()
+    self._backend.GetBackend().WatchTokens(self._token_cache.Invalidate)
+
+  def GetStatus(self):
+    return self._token_cache.GetStatus()
 
   @EventHandler(kbevent.TokenAuthEvent)
   def HandleAuthTokenEvent(self, event):
-    for gate in self._GetGatesForGateName(event.gate_name):
-      record = self._GetRecord(event.auth_device_name, event.token_value,
-          gate.GetName())
-      if event.status == event.TokenState.ADDED:
+    if event.status == event.TokenState.ADDED and self._IsStale(event):
+      self._logger.info('Ignoring token event replayed %.1fs late' %
+          event.age)
+      return
+    gates = self._gate_manager.GetGatesForName(event.gate_name)
+    records = [self._GetRecord(event.auth_device_name, event.token_value,
+        gate.GetName()) for gate in gates]
+    if event.status == event.TokenState.ADDED:
+      for record in records:
         self._TokenAdded(record)
-      else:
+      if records:
+        # Resolve the token once, however many gates it applies to.
+        self._ResolveToken(event.auth_device_name, event.token_value, records,
+            tracing.Fork(event, 'auth_handle'), event.pending_ack)
+    else:
+      for record in records:
         self._TokenRemoved(record)
 
+  def _IsStale(self, event):
+    """Returns True if a replayed token is too old to open a latch.
+
+    Only events sent through a client's journal carry an age; it is
+    measured on the client, so clock skew cannot reject live reads.
+    """
+    if event.age is None:
+      return False
+    max_idle = kb_common.AUTH_DEVICE_MAX_IDLE_SECS.get(event.auth_device_name)
+    if max_idle is None:
+      max_idle = kb_common.AUTH_DEVICE_MAX_IDLE_SECS['default']
+    return event.age > max_idle
+
+  @EventHandler(kbevent.HeartbeatSecondEvent)
+  def _HandleHeartbeatEvent(self, event):
+    self._backend.Call(None, 'FlushUnknownTokens')
+
+  @EventHandler(kbevent.AuthTokenChangedEvent)
+  def HandleAuthTokenChangedEvent(self, event):
+    self._token_cache.Invalidate(event.auth_device, event.token_value)
+
   def _GetRecord(self, auth_device, token_value, gate_name):
     new_rec = TokenRecord(auth_device, token_value, gate_name)
     existing = self._tokens.get(gate_name)
@@ -481,18 +693,59 @@ class AuthenticationManager(Manager):
       return existing
     return new_rec
 
-  def _MaybeOpenLatch(self, record):
-    """Called when the given token has been added.
+  def _ResolveToken(self, auth_device, token_value, records, trace=None,
+      pending_ack=None):
+    """Opens latches for |records| once the token's user is known.
 
-    This will either start or renew a latch on the LatchManager."""
+    Tokens not in the cache are looked up by a backend worker; the event's
+    |pending_ack|, if any, is held until then.
+    """
+    token = self._token_cache.Get(auth_device, token_value)
+    if token is not None:
+      self._OpenLatches(records, token, trace)
+      return
+
+    # Not cached if the token is invalidated during the lookup.
+    generation = self._token_cache.generation
+    def _Resolved(token, error):
+      try:
+        if isinstance(error, backend.NoTokenError):
+          token = tokencache.NO_TOKEN
+          self._token_cache.PutMissing(auth_device, token_value,
+              generation=generation)
+        elif error:
+          self._logger.warning('Could not look up token %s=%s: %s' %
+              (auth_device, token_value, error))
+          return
+        else:
+          self._token_cache.Put(auth_device, token_value, token,
+              generation=generation)
+        self._OpenLatches(records, token, trace)
+      finally:
+        if pending_ack is not None:
+          pending_ack.Release()
+
+    if pending_ack is not None:
+      pending_ack.Hold()
+    self._backend.Call(_Resolved, 'GetAuthToken', auth_device, token_value)
+
+  @util.synchronized
+  def _OpenLatches(self, records, token, trace=None):
+    if trace is not None:
+      trace.Stamp('token_resolved')
     username = None
-    gate_name = record.gate_name
-    try:
-      token = self._backend.GetAuthToken(record.auth_device, record.token_value)
+    if token is not tokencache.NO_TOKEN:
       username = token.username
-    except backend.NoTokenError:
-      pass
+    for record in records:
+      # The token may have been removed while it was being looked up.
+      if self._tokens.get(record.gate_name) is record:
+        self._MaybeOpenLatch(record, username, trace)
 
+  def _MaybeOpenLatch(self, record, username, trace=None):
+    """Called when the given token has been added.
+
+    This will either start or renew a latch on the LatchManager."""
+    gate_name = record.gate_name
     if not username:
       self._logger.info('Token not assigned: %s' % record)
       return
@@ -501,7 +754,7 @@ class AuthenticationManager(Manager):
     if max_idle is None:
       max_idle = kb_common.AUTH_DEVICE_MAX_IDLE_SECS['default']
     self._latch_manager.OpenLatch(gate_name, username=username,
-        max_idle_secs=max_idle)
+        max_idle_secs=max_idle, trace=trace)
 
   def _MaybeCloseLatch(self, record):
     """Called when the given token has been removed.
@@ -528,7 +781,6 @@ class AuthenticationManager(Manager):
       self._TokenRemoved(existing)
 
     self._tokens[record.gate_name] = record
-    self._MaybeOpenLatch(record)
 
   @util.synchronized
   def _TokenRemoved(self, record):
@@ -541,15 +793,6 @@ class AuthenticationManager(Manager):
     del self._tokens[record.gate_name]
     self._MaybeCloseLatch(record)
 
-  def _GetGatesForGateName(self, gate_name):
-    if gate_name == kb_common.ALIAS_ALL_GATES:
-      return self._gate_manager.GetAllGates()
-    else:
-      if self._gate_manager.GateExists(gate_name):
-        return [self._gate_manager.GetGate(gate_name)]
-      else:
-        return []
-
 
 class SubscriptionManager(Manager):
   def __init__(self, name, event_hub, server):
@@ -24,10 +24,12 @@ import random
 from django.conf import settings
 from django.core import urlresolvers
 from django.db import models
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_save
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
+from django.dispatch import Signal
 
 from autoslug import AutoSlugField
 
@@ -231,6 +233,20 @@ class AuthenticationToken(models.Model):
 
 pre_save.connect(_set_seqn_pre_save, sender=AuthenticationToken)
 
+# Sent when a token, or a user (auth_device and token_value None), changes.
+auth_token_changed = Signal(providing_args=['auth_device', 'token_value'])
+
+def _token_changed(sender, instance, **kwargs):
+  auth_token_changed.send(sender=AuthenticationToken,
+      auth_device=instance.auth_device, token_value=instance.token_value)
+post_save.connect(_token_changed, sender=AuthenticationToken)
+post_delete.connect(_token_changed, sender=AuthenticationToken)
+
+def _user_changed(sender, instance, **kwargs):
+  auth_token_changed.send(sender=User, auth_device=None, token_value=None)
+post_save.connect(_user_changed, sender=User)
+post_delete.connect(_user_changed, sender=User)
+
 
 class RelayLog(models.Model):
   """ A log from an IRelay device of relay events/ """
@@ -0,0 +1,219 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact binary encoding of gatenet events.
+
+A binary frame is FRAME_MARKER, a 32-bit big-endian payload length, and the
+payload.  The payload is a 16-bit event class id followed by (tag, value)
+pairs for every field that is set.
+
+Class ids and field tags are derived from the Event subclasses in kbevent:
+classes are numbered in name order, and each class's EventFields in name
+order.  Both ends of a connection must agree on this schema, which is
+summarized by SCHEMA_VERSION; it is exchanged when the encoding is
+negotiated (see gatenet.EncodingRequest handling).
+
+Values carry a one-byte type code.  Datetimes are sent as integer
+microseconds since the epoch, in UTC.
+"""
+
+import datetime
+import struct
+import zlib
+
+import pytz
+
+from pygate.core import kbevent
+from pygate.core import kbjson
+
+# Binary frames start with a NUL, which can never start a JSON message.
+FRAME_MARKER = '\x00'
+
+_FRAME_HEADER = struct.Struct('>cI')
+FRAME_HEADER_SIZE = _FRAME_HEADER.size
+
+_CLASS_ID = struct.Struct('>H')
+_TAG = struct.Struct('>B')
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+_LENGTH = struct.Struct('>I')
+
+_TYPE_NONE = '\x00'
+_TYPE_FALSE = '\x01'
+_TYPE_TRUE = '\x02'
+_TYPE_INT = '\x03'
+_TYPE_FLOAT = '\x04'
+_TYPE_STRING = '\x05'
+_TYPE_DATETIME = '\x06'
+_TYPE_LIST = '\x07'
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class _ClassSchema(object):
+  def __init__(self, class_id, cls):
+    self.class_id = class_id
+    self.cls = cls
+    self.fields = sorted(cls.class_fields.keys())
+    self.name_to_tag = dict((name, i + 1) for i, name in enumerate(self.fields))
+    self.tag_to_name = dict((i + 1, name) for i, name in enumerate(self.fields))
+    self.header = _CLASS_ID.pack(class_id)
+
+
+def _BuildSchema():
+  by_class = {}
+  by_id = {}
+  for i, name in enumerate(sorted(kbevent.EVENT_NAME_TO_CLASS.keys())):
+    schema = _ClassSchema(i + 1, kbevent.EVENT_NAME_TO_CLASS[name])
+    by_class[schema.cls] = schema
+    by_id[schema.class_id] = schema
+  desc = ';'.join('%s:%s' % (s.cls.__name__, ','.join(s.fields))
+      for s in sorted(by_id.values(), key=lambda s: s.class_id))
+  version = '%08x' % (zlib.crc32(desc) & 0xffffffff)
+  return by_class, by_id, version
+
+_SCHEMA_BY_CLASS, _SCHEMA_BY_ID, SCHEMA_VERSION = _BuildSchema()
+
+
+### Values
+
+def _DatetimeToMicros(dt):
+  if dt.tzinfo is None:
+    try:
+      dt = kbjson.local_to_utc(dt)
+    except pytz.UnknownTimeZoneError:
+      pass
+  else:
+    dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+  delta = dt - _EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _MicrosToDatetime(micros):
+  dt = _EPOCH + datetime.timedelta(microseconds=micros)
+  try:
+    dt = kbjson.utc_to_local(dt)
+  except pytz.UnknownTimeZoneError:
+    pass
+  return dt
+
+def _EncodeValue(value, out):
+  if value is None:
+    out.append(_TYPE_NONE)
+  elif value is True:
+    out.append(_TYPE_TRUE)
+  elif value is False:
+    out.append(_TYPE_FALSE)
+  elif isinstance(value, (int, long)):
+    out.append(_TYPE_INT)
+    out.append(_INT.pack(value))
+  elif isinstance(value, float):
+    out.append(_TYPE_FLOAT)
+    out.append(_FLOAT.pack(value))
+  elif isinstance(value, basestring):
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    out.append(_TYPE_STRING)
+    out.append(_LENGTH.pack(len(value)))
+    out.append(value)
+  elif isinstance(value, datetime.datetime):
+    out.append(_TYPE_DATETIME)
+    out.append(_INT.pack(_DatetimeToMicros(value)))
+  elif isinstance(value, (list, tuple)):
+    out.append(_TYPE_LIST)
+    out.append(_LENGTH.pack(len(value)))
+    for item in value:
+      _EncodeValue(item, out)
+  else:
+    raise ValueError('Cannot encode value of type %s' % type(value))
+
+def _DecodeValue(data, pos):
+  """Decodes the value at data[pos]; returns (value, next position)."""
+  type_code = data[pos]
+  pos += 1
+  if type_code == _TYPE_NONE:
+    return None, pos
+  elif type_code == _TYPE_TRUE:
+    return True, pos
+  elif type_code == _TYPE_FALSE:
+    return False, pos
+  elif type_code == _TYPE_INT:
+    return _INT.unpack_from(data, pos)[0], pos + _INT.size
+  elif type_code == _TYPE_FLOAT:
+    return _FLOAT.unpack_from(data, pos)[0], pos + _FLOAT.size
+  elif type_code == _TYPE_STRING:
+    length = _LENGTH.unpack_from(data, pos)[0]
+    pos += _LENGTH.size
+    value = data[pos:pos + length]
+    if len(value) != length:
+      raise ValueError('Truncated string')
+    return value.decode('utf-8'), pos + length
+  elif type_code == _TYPE_DATETIME:
+    micros = _INT.unpack_from(data, pos)[0]
+    return _MicrosToDatetime(micros), pos + _INT.size
+  elif type_code == _TYPE_LIST:
+    count = _LENGTH.unpack_from(data, pos)[0]
+    pos += _LENGTH.size
+    ret = []
+    for i in xrange(count):
+      value, pos = _DecodeValue(data, pos)
+      ret.append(value)
+    return ret, pos
+  raise ValueError('Unknown value type: %r' % type_code)
+
+
+### Events
+
+def EncodeEvent(event):
+  """Returns the complete binary frame for |event|."""
+  schema = _SCHEMA_BY_CLASS.get(event.__class__)
+  if schema is None:
+    raise ValueError('Unknown event: %s' % event.__class__.__name__)
+  out = [schema.header]
+  for name in schema.fields:
+    value = getattr(event, name)
+    if value is None:
+      continue
+    out.append(_TAG.pack(schema.name_to_tag[name]))
+    _EncodeValue(value, out)
+  payload = ''.join(out)
+  return _FRAME_HEADER.pack(FRAME_MARKER, len(payload)) + payload
+
+def DecodeEvent(payload):
+  """Decodes a frame payload (without its header) into an Event."""
+  try:
+    class_id = _CLASS_ID.unpack_from(payload, 0)[0]
+    schema = _SCHEMA_BY_ID.get(class_id)
+    if schema is None:
+      raise ValueError('Unknown event class id: %i' % class_id)
+    inst = schema.cls()
+    pos = _CLASS_ID.size
+    end = len(payload)
+    while pos < end:
+      tag = ord(payload[pos])
+      value, pos = _DecodeValue(payload, pos + 1)
+      name = schema.tag_to_name.get(tag)
+      # Ignore unknown tags.
+      if name is not None:
+        setattr(inst, name, value)
+    return inst
+  except (struct.error, IndexError), e:
+    raise ValueError('Malformed binary event: %s' % e)
+
+def GetFrameLength(data, pos=0):
+  """Returns the payload length of the frame header at data[pos]."""
+  return _FRAME_HEADER.unpack_from(data, pos)[1]
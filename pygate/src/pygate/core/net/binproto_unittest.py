@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""Unittest for binproto module"""
+
+import datetime
+import unittest
+
+from pygate.core import kbevent
+from pygate.core.net import binproto
+from pygate.core.net import gatenet
+
+class BinprotoTestCase(unittest.TestCase):
+  def _RoundTrip(self, event):
+    frame = binproto.EncodeEvent(event)
+    self.assertEqual(frame[0], binproto.FRAME_MARKER)
+    self.assertEqual(binproto.GetFrameLength(frame),
+        len(frame) - binproto.FRAME_HEADER_SIZE)
+    return binproto.DecodeEvent(frame[binproto.FRAME_HEADER_SIZE:])
+
+  def testRoundTrip(self):
+    now = datetime.datetime(2010, 6, 1, 12, 30, 15, 250000)
+    event = kbevent.LatchUpdate(latch_id=12, gate_name=u'building1.front',
+        state='active', username=None, start_time=now, last_activity_time=now)
+    decoded = self._RoundTrip(event)
+    self.assert_(isinstance(decoded, kbevent.LatchUpdate))
+    self.assertEqual(decoded.latch_id, 12)
+    self.assertEqual(decoded.gate_name, u'building1.front')
+    self.assertEqual(decoded.state, 'active')
+    self.assertEqual(decoded.username, None)
+    self.assert_(isinstance(decoded.start_time, datetime.datetime))
+    self.assertEqual(decoded.start_time, decoded.last_activity_time)
+
+    request = kbevent.SubscriptionRequest(event_types=['LatchUpdate'],
+        gate_names=[u'caf\xe9.*'])
+    decoded = self._RoundTrip(request)
+    self.assertEqual(decoded.event_types, ['LatchUpdate'])
+    self.assertEqual(decoded.gate_names, [u'caf\xe9.*'])
+
+    meter = self._RoundTrip(kbevent.MeterUpdate(gate_name='g', reading=1.5))
+    self.assertEqual(meter.reading, 1.5)
+    self.assert_(isinstance(self._RoundTrip(kbevent.Ping()), kbevent.Ping))
+
+  def testSmallerThanJson(self):
+    event = kbevent.TokenAuthEvent(gate_name='gate0',
+        auth_device_name='core.onewire', token_value='0000111122223333',
+        status='added')
+    self.assert_(len(binproto.EncodeEvent(event)) <
+        len(gatenet.EncodeEvent(event)))
+
+  def testMalformed(self):
+    frame = binproto.EncodeEvent(kbevent.GateIdleEvent(gate_name='gate0'))
+    payload = frame[binproto.FRAME_HEADER_SIZE:]
+    self.assertRaises(ValueError, binproto.DecodeEvent, payload[:-2])
+    self.assertRaises(ValueError, binproto.DecodeEvent, '\xff\xff')
+    self.assertRaises(ValueError, binproto.EncodeEvent,
+        kbevent.GateIdleEvent(gate_name=object()))
+
+
+class MessageSplitterTestCase(unittest.TestCase):
+  def testInterleaved(self):
+    ping = kbevent.Ping()
+    idle = kbevent.GateIdleEvent(gate_name='gate0\n\n')
+    data = (gatenet.EncodeEvent(ping) + binproto.EncodeEvent(idle) +
+        gatenet.EncodeEvent(idle) + binproto.EncodeEvent(ping))
+
+    # All at once, and one byte at a time.
+    for chunk_size in (len(data), 1):
+      splitter = gatenet.MessageSplitter()
+      messages = []
+      for i in xrange(0, len(data), chunk_size):
+        messages.extend(splitter.Feed(data[i:i + chunk_size]))
+      self.assertEqual(len(splitter), 0)
+      self.assertEqual([m[0] for m in messages], [False, True, False, True])
+      events = [gatenet.DecodeMessage(*m) for m in messages]
+      self.assertEqual([e.__class__ for e in events],
+          [kbevent.Ping, kbevent.GateIdleEvent, kbevent.GateIdleEvent,
+           kbevent.Ping])
+      self.assertEqual(events[1].gate_name, 'gate0\n\n')
+      self.assertEqual(events[2].gate_name, 'gate0\n\n')
+
+if __name__ == '__main__':
+  unittest.main()
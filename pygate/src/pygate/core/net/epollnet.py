@@ -0,0 +1,475 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Non-blocking Gatenet server for large numbers of clients.
+
+EpollGatenetServer speaks exactly the same wire protocol as
+gatenet.GatenetServer (JSON messages separated by MESSAGE_TERMINATOR, or
+negotiated binary frames), so existing GatenetClients work unchanged.  It
+multiplexes all connections on a single epoll object (falling back to poll
+where epoll is unavailable), and gives every connection a bounded write
+buffer:
+
+  - a client whose outgoing queue is full (by bytes, or by message count) is
+    handled according to --gatenet_slow_client_policy, without affecting
+    delivery to any other client;
+  - while a client's write buffer is more than half full, the server stops
+    reading from it, so a client that does not read cannot keep generating
+    work for the core.
+"""
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+import gflags
+
+from pygate.core import kbevent
+from pygate.core import tracing
+from pygate.core import util
+from pygate.core.net import binproto
+from pygate.core.net import gatenet
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('gatenet_max_write_buffer', 256 * 1024,
+    'Maximum number of bytes buffered for sending to a single gatenet '
+    'client.  Messages which would exceed this are not queued.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('gatenet_max_read_buffer', 64 * 1024,
+    'Maximum size of a single incoming gatenet message.  Clients sending '
+    'larger messages are disconnected.',
+    lower_bound=1)
+
+_RECV_SIZE = 64 * 1024
+
+
+def _SetNonBlocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Poller(object):
+  """Thin wrapper hiding the differences between epoll and poll."""
+  def __init__(self):
+    if hasattr(select, 'epoll'):
+      self.is_epoll = True
+      self._poll = select.epoll()
+      self.READ = select.EPOLLIN
+      self.WRITE = select.EPOLLOUT
+      self.ERROR = select.EPOLLERR | select.EPOLLHUP
+    else:
+      self.is_epoll = False
+      self._poll = select.poll()
+      self.READ = select.POLLIN
+      self.WRITE = select.POLLOUT
+      self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+  def register(self, fd, mask):
+    self._poll.register(fd, mask)
+
+  def modify(self, fd, mask):
+    self._poll.modify(fd, mask)
+
+  def unregister(self, fd):
+    self._poll.unregister(fd)
+
+  def poll(self, timeout=None):
+    """Waits up to |timeout| seconds; returns a list of (fd, mask)."""
+    try:
+      if self.is_epoll:
+        if timeout is None:
+          timeout = -1
+        return self._poll.poll(timeout)
+      if timeout is not None:
+        timeout = int(timeout * 1000)
+      return self._poll.poll(timeout)
+    except (IOError, select.error), e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+
+  def close(self):
+    if self.is_epoll:
+      self._poll.close()
+
+
+class _Connection(object):
+  """A single client connection of an EpollGatenetServer."""
+  def __init__(self, server, sock, addr):
+    self._server = server
+    self.sock = sock
+    self.addr = addr
+    self.fd = sock.fileno()
+    self.mask = 0
+    self.closed = False
+    self._lock = threading.Lock()
+    self._splitter = gatenet.MessageSplitter()
+    self.encoding = gatenet.ENCODING_JSON
+    # Outgoing (message, time queued) pairs.  Messages are shared between
+    # every connection they are sent to, and never copied.
+    self._outbuf = collections.deque()
+    self._out_offset = 0
+    self.out_bytes = 0
+    self.bytes_sent = 0
+    self.messages_sent = 0
+    self.drops = 0
+    self.consecutive_drops = 0
+    self.max_lag = 0.0
+    self.subscription = None
+
+  def __str__(self):
+    return '%s:%i' % self.addr
+
+  def Push(self, data):
+    """Queues |data| for sending.
+
+    Returns False, without queueing anything, if the connection is closed or
+    its outgoing queue cannot take |data|; the latter counts as a drop.
+    """
+    self._lock.acquire()
+    try:
+      if self.closed:
+        return False
+      if (len(self._outbuf) >= FLAGS.gatenet_client_max_queue or
+          self.out_bytes + len(data) > FLAGS.gatenet_max_write_buffer):
+        self.drops += 1
+        self.consecutive_drops += 1
+        return False
+      self.consecutive_drops = 0
+      was_empty = not self._outbuf
+      self._outbuf.append((data, time.time()))
+      self.out_bytes += len(data)
+      if was_empty:
+        # Try to send right away; only involve the poller if the socket
+        # could not take everything.
+        self._FlushLocked()
+    finally:
+      self._lock.release()
+    self._server._UpdateInterest(self)
+    return True
+
+  def Shutdown(self):
+    """Disconnects the client; the poll thread then cleans up."""
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+
+  def GetLag(self, now=None):
+    """Returns how long the oldest queued message has been waiting."""
+    if now is None:
+      now = time.time()
+    try:
+      return now - self._outbuf[0][1]
+    except IndexError:
+      return 0.0
+
+  def GetStatus(self, now=None):
+    return ['%s: %s sent=%i msgs/%i bytes queued=%i drops=%i lag=%.3fs '
+        '(max %.3fs)' % (self, self.encoding, self.messages_sent,
+        self.bytes_sent, len(self._outbuf), self.drops, self.GetLag(now),
+        self.max_lag)]
+
+  def WantsRead(self):
+    return self.out_bytes * 2 <= FLAGS.gatenet_max_write_buffer
+
+  def WantsWrite(self):
+    return bool(self._outbuf)
+
+  def HandleWrite(self):
+    self._lock.acquire()
+    try:
+      self._FlushLocked()
+    finally:
+      self._lock.release()
+    self._server._UpdateInterest(self)
+
+  def _FlushLocked(self):
+    while self._outbuf:
+      chunk, queued_time = self._outbuf[0]
+      try:
+        sent = self.sock.send(buffer(chunk, self._out_offset))
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          return
+        self._server._logger.warning('Error sending to %s: %s' % (self, e))
+        self._outbuf.clear()
+        self.out_bytes = 0
+        self.closed = True
+        return
+      self.out_bytes -= sent
+      self.bytes_sent += sent
+      self._out_offset += sent
+      if self._out_offset < len(chunk):
+        return
+      self._outbuf.popleft()
+      self._out_offset = 0
+      self.messages_sent += 1
+      self.max_lag = max(self.max_lag, time.time() - queued_time)
+
+  def HandleRead(self):
+    """Reads available data; returns complete (is_binary, payload) messages."""
+    try:
+      data = self.sock.recv(_RECV_SIZE)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return []
+      data = ''
+    if not data:
+      self.closed = True
+      return []
+
+    messages = self._splitter.Feed(data)
+    if len(self._splitter) > FLAGS.gatenet_max_read_buffer:
+      self._server._logger.warning('Message from %s too large, closing '
+          'connection' % self)
+      self.closed = True
+    return messages
+
+
+class EpollGatenetServer(object):
+  """epoll server implementation for Gatenet protocol"""
+  def __init__(self, name, kb_env, addr='', port=0, qsize=128):
+    self._name = name
+    self._kb_env = kb_env
+    self._logger = logging.getLogger(self._name)
+    self._bind_address = util.str_to_addr(addr)
+    self._qsize = qsize
+    self._connections = {}
+    self._lock = threading.Lock()
+    self._poller = None
+    self._socket = None
+    self._wake_read_fd = None
+    self._wake_write_fd = None
+    self._poll_thread = None
+
+  def StartServer(self):
+    self._logger.info("Starting server on %s" % str(self._bind_address,))
+    self._poller = _Poller()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(self._bind_address)
+    sock.listen(self._qsize)
+    sock.setblocking(0)
+    self._socket = sock
+    self._poller.register(sock.fileno(), self._poller.READ)
+
+    self._wake_read_fd, self._wake_write_fd = os.pipe()
+    _SetNonBlocking(self._wake_read_fd)
+    _SetNonBlocking(self._wake_write_fd)
+    self._poller.register(self._wake_read_fd, self._poller.READ)
+
+  def StopServer(self):
+    self._logger.info("Stopping server")
+    for conn in self._GetConnections():
+      self._CloseConnection(conn)
+    if self._socket:
+      self._poller.unregister(self._socket.fileno())
+      self._socket.close()
+      self._socket = None
+    if self._wake_read_fd is not None:
+      os.close(self._wake_read_fd)
+      os.close(self._wake_write_fd)
+      self._wake_read_fd = self._wake_write_fd = None
+    if self._poller:
+      self._poller.close()
+      self._poller = None
+
+  def GetAddress(self):
+    """Returns the (host, port) the server is listening on."""
+    return self._socket.getsockname()
+
+  def GetStatus(self):
+    conns = self._GetConnections()
+    now = time.time()
+    ret = []
+    ret.append('Clients: %i' % len(conns))
+    ret.append('Buffered bytes: %i' % sum(c.out_bytes for c in conns))
+    for conn in conns:
+      ret.extend(conn.GetStatus(now))
+    return ret
+
+  @util.synchronized
+  def _GetConnections(self):
+    return self._connections.values()
+
+  def Wakeup(self):
+    """Interrupts a Poll in progress on another thread."""
+    try:
+      os.write(self._wake_write_fd, 'x')
+    except OSError, e:
+      # A full pipe already guarantees a wakeup.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def Poll(self, timeout=None):
+    """Waits up to |timeout| seconds for socket activity, and services it."""
+    self._poll_thread = threading.currentThread()
+    poller = self._poller
+    for fd, mask in poller.poll(timeout):
+      if self._socket and fd == self._socket.fileno():
+        self._Accept()
+        continue
+      if fd == self._wake_read_fd:
+        self._DrainWakeup()
+        continue
+      conn = self._connections.get(fd)
+      if conn is None:
+        continue
+      if mask & (poller.READ | poller.ERROR):
+        try:
+          for is_binary, payload in conn.HandleRead():
+            self._HandleMessage(conn, is_binary, payload)
+        except Exception, e:
+          # As asyncore does, give up on just this client.
+          self._logger.error('Error handling message from %s, closing '
+              'connection:' % conn)
+          util.LogTraceback(self._logger.error)
+          conn.closed = True
+      if mask & poller.WRITE and not conn.closed:
+        conn.HandleWrite()
+      if conn.closed:
+        self._CloseConnection(conn)
+      else:
+        self._UpdateInterest(conn)
+
+  def _DrainWakeup(self):
+    try:
+      while os.read(self._wake_read_fd, 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _Accept(self):
+    while True:
+      try:
+        sock, addr = self._socket.accept()
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          return
+        if e.args[0] in (errno.EMFILE, errno.ENFILE):
+          self._logger.warning('Out of file descriptors, cannot accept')
+          return
+        raise
+      sock.setblocking(0)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      conn = _Connection(self, sock, addr)
+      self.ChannelOpened(conn)
+
+  @util.synchronized
+  def ChannelOpened(self, conn):
+    self._logger.info('Remote host connected: %s:%i' % conn.addr)
+    self._connections[conn.fd] = conn
+    conn.mask = self._poller.READ
+    self._poller.register(conn.fd, conn.mask)
+
+  @util.synchronized
+  def ChannelClosed(self, conn):
+    self._logger.info('Remote host closed: %s:%i' % conn.addr)
+    # The fd may already belong to a newer connection.
+    if self._connections.get(conn.fd) is conn:
+      del self._connections[conn.fd]
+      self._poller.unregister(conn.fd)
+
+  def _CloseConnection(self, conn):
+    conn.closed = True
+    self.ChannelClosed(conn)
+    conn.sock.close()
+
+  def _UpdateInterest(self, conn):
+    poller = self._poller
+    if conn.closed:
+      if self._poll_thread is not threading.currentThread():
+        # Let the poll thread notice the error and clean up.
+        self.Wakeup()
+      return
+    # The poll thread and a sending thread may both get here after changing
+    # the connection's buffer; computing the mask under the lock means the
+    # last of them installs a mask for the buffer as it now is.
+    self._lock.acquire()
+    try:
+      if self._connections.get(conn.fd) is not conn:
+        # Closed, and its fd possibly reused by a newer connection.
+        return
+      mask = 0
+      if conn.WantsRead():
+        mask |= poller.READ
+      if conn.WantsWrite():
+        mask |= poller.WRITE
+      if mask == conn.mask:
+        return
+      conn.mask = mask
+      poller.modify(conn.fd, mask)
+    finally:
+      self._lock.release()
+    # Registration changes made to epoll take effect immediately, even for a
+    # poll in progress; plain poll must be restarted.
+    if (not poller.is_epoll and
+        self._poll_thread is not threading.currentThread()):
+      self.Wakeup()
+
+  def _HandleMessage(self, conn, is_binary, payload):
+    if not payload:
+      self._logger.warning('Received empty message')
+      return
+    try:
+      event = gatenet.DecodeMessage(is_binary, payload)
+    except ValueError, e:
+      self._logger.warning('Received malformed message from %s, dropping: %s'
+          % (conn, e))
+      return
+    self._logger.debug('Received notification: %s' % event)
+    if isinstance(event, kbevent.EncodingRequest):
+      encoding = gatenet.NegotiateEncoding(self._logger, conn, event)
+      # The reply is the last message sent with the old encoding.
+      reply = gatenet.EncodeEvent(kbevent.EncodingRequest(encoding=encoding,
+          schema_version=binproto.SCHEMA_VERSION), conn.encoding)
+      conn.encoding = encoding
+      conn.Push(reply)
+      return
+    if isinstance(event, kbevent.SubscriptionRequest):
+      conn.subscription = gatenet.ParseSubscription(self._logger, conn, event)
+      return
+    tracing.Stamp(event, 'core_receive')
+    gatenet.ExpectAck(event, conn)
+    self._kb_env.GetEventHub().PublishEvent(event)
+
+  def SendEventToClients(self, event):
+    conns = self._GetConnections()
+    if not conns:
+      return
+    # Encode at most once per encoding; every outbox shares the same string.
+    messages = {}
+    for conn in conns:
+      if conn.subscription and not conn.subscription.Matches(event):
+        continue
+      str_message = messages.get(conn.encoding)
+      if str_message is None:
+        str_message = gatenet.EncodeEvent(event, conn.encoding)
+        messages[conn.encoding] = str_message
+      if not conn.Push(str_message) and not conn.closed:
+        gatenet.HandleSlowClient(self._logger, conn)
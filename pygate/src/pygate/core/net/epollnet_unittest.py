@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""Unittest for epollnet module"""
+
+import asyncore
+import datetime
+import errno
+import socket
+import threading
+import time
+import unittest
+
+import gflags
+
+from pygate.core import kbevent
+from pygate.core.net import epollnet
+from pygate.core.net import gatenet
+
+FLAGS = gflags.FLAGS
+
+class _FakeEnv(object):
+  def __init__(self):
+    self._event_hub = kbevent.EventHub()
+
+  def GetEventHub(self):
+    return self._event_hub
+
+
+class _StalledSocket(object):
+  """A socket whose peer never reads: accepts |capacity| bytes, then EAGAIN."""
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.sent = ''
+
+  def fileno(self):
+    return -1
+
+  def send(self, data):
+    if not self.capacity:
+      raise socket.error(errno.EAGAIN, 'would block')
+    data = str(data)[:self.capacity]
+    self.capacity -= len(data)
+    self.sent += data
+    return len(data)
+
+
+class _NullServer(object):
+  _logger = None
+  def _UpdateInterest(self, conn):
+    pass
+
+
+class _SlowConnection(object):
+  """Connection stand-in whose outgoing queue is always full."""
+  closed = False
+  consecutive_drops = 1
+  subscription = None
+  encoding = gatenet.ENCODING_JSON
+  def __init__(self):
+    self.shut_down = False
+  def Push(self, data):
+    return False
+  def Shutdown(self):
+    self.shut_down = True
+
+
+class ConnectionTestCase(unittest.TestCase):
+  def setUp(self):
+    self.old_max = FLAGS.gatenet_max_write_buffer
+    self.old_queue = FLAGS.gatenet_client_max_queue
+    FLAGS.gatenet_max_write_buffer = 100
+
+  def tearDown(self):
+    FLAGS.gatenet_max_write_buffer = self.old_max
+    FLAGS.gatenet_client_max_queue = self.old_queue
+
+  def testBoundedWriteBuffer(self):
+    sock = _StalledSocket(capacity=10)
+    conn = epollnet._Connection(_NullServer(), sock, ('127.0.0.1', 1))
+
+    self.assert_(conn.Push('x' * 40))
+    self.assertEqual(sock.sent, 'x' * 10)
+    self.assertEqual(conn.out_bytes, 30)
+    self.assert_(conn.WantsWrite())
+    self.assert_(conn.WantsRead())
+
+    self.assert_(conn.Push('y' * 40))
+    self.assertEqual(conn.out_bytes, 70)
+    # More than half full: stop reading from this client.
+    self.assert_(not conn.WantsRead())
+    # Over the limit: refused, and nothing queued.
+    self.assert_(not conn.Push('z' * 40))
+    self.assertEqual(conn.out_bytes, 70)
+
+    sock.capacity = 1000
+    conn.HandleWrite()
+    self.assertEqual(sock.sent, 'x' * 40 + 'y' * 40)
+    self.assertEqual(conn.out_bytes, 0)
+    self.assert_(not conn.WantsWrite())
+    self.assert_(conn.WantsRead())
+
+  def testQueueDepthAndCounters(self):
+    FLAGS.gatenet_client_max_queue = 2
+    sock = _StalledSocket(capacity=0)
+    conn = epollnet._Connection(_NullServer(), sock, ('127.0.0.1', 1))
+    message = 'm' * 10
+
+    self.assert_(conn.Push(message))
+    self.assert_(conn.Push(message))
+    self.assert_(not conn.Push(message))
+    self.assert_(not conn.Push(message))
+    self.assertEqual(conn.drops, 2)
+    self.assertEqual(conn.consecutive_drops, 2)
+    self.assert_(conn.GetLag() >= 0)
+
+    sock.capacity = 15
+    conn.HandleWrite()
+    self.assertEqual(conn.messages_sent, 1)
+    self.assertEqual(conn.bytes_sent, 15)
+    self.assert_(conn.Push(message))
+    self.assertEqual(conn.consecutive_drops, 0)
+    self.assertEqual(len(conn.GetStatus()), 1)
+
+
+class SubscriptionFilterTestCase(unittest.TestCase):
+  def testMatches(self):
+    latch = kbevent.LatchUpdate(gate_name='building1.front')
+    other_latch = kbevent.LatchUpdate(gate_name='building2.front')
+    entry = kbevent.EntryCreatedEvent(gate_name='building1.back')
+    ping = kbevent.Ping()
+
+    match_all = gatenet.SubscriptionFilter()
+    for event in (latch, other_latch, entry, ping):
+      self.assert_(match_all.Matches(event))
+
+    by_type = gatenet.SubscriptionFilter(event_types=['LatchUpdate'])
+    self.assert_(by_type.Matches(latch))
+    self.assert_(not by_type.Matches(entry))
+
+    by_gate = gatenet.SubscriptionFilter(gate_names=['building1.*'])
+    self.assert_(by_gate.Matches(latch))
+    self.assert_(by_gate.Matches(entry))
+    self.assert_(not by_gate.Matches(other_latch))
+    # Events without a gate are not filtered by gate.
+    self.assert_(by_gate.Matches(ping))
+
+    both = gatenet.SubscriptionFilter(['EntryCreatedEvent'], ['*.back'])
+    self.assert_(both.Matches(entry))
+    self.assert_(not both.Matches(latch))
+
+    self.assertRaises(ValueError, gatenet.SubscriptionFilter, ['NoSuchEvent'])
+
+
+class EpollGatenetServerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.env = _FakeEnv()
+    self.server = epollnet.EpollGatenetServer(name='gatenet', kb_env=self.env,
+        addr='localhost:0')
+    self.server.StartServer()
+    self.addr = '%s:%i' % self.server.GetAddress()
+    self._quit = False
+    self.thread = threading.Thread(target=self._PollLoop)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def _PollLoop(self):
+    while not self._quit:
+      self.server.Poll(0.1)
+
+  def tearDown(self):
+    self._quit = True
+    self.server.Wakeup()
+    self.thread.join(2.0)
+    self.server.StopServer()
+
+  def testGatenetClientCompatibility(self):
+    client = gatenet.GatenetClient(addr=self.addr)
+    self.assert_(client.Reconnect())
+    client.SendAuthTokenAdd('gate0', 'core.onewire', '0000111122223333')
+
+    event = None
+    for i in xrange(20):
+      asyncore.loop(timeout=0.1, count=1)
+      event = self.env.GetEventHub()._WaitForEvent(timeout=0.1)
+      if event:
+        break
+    self.assert_(isinstance(event, kbevent.TokenAuthEvent))
+    self.assertEqual(event.token_value, '0000111122223333')
+    self.assertEqual(event.status, event.TokenState.ADDED)
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    update = kbevent.LatchUpdate(gate_name='gate0', state='active',
+        start_time=now, last_activity_time=now)
+    self.server.SendEventToClients(update)
+    for i in xrange(20):
+      asyncore.loop(timeout=0.1, count=1)
+      if not client._in_notifications.empty():
+        break
+    received = client.PopNotification(timeout=0)
+    self.assert_(isinstance(received, kbevent.LatchUpdate))
+    self.assertEqual(received.gate_name, 'gate0')
+    client.close()
+
+  def testSubscription(self):
+    client = gatenet.GatenetClient(addr=self.addr)
+    self.assert_(client.Reconnect())
+    client.SendSubscribe(event_types=[kbevent.LatchUpdate],
+        gate_names=['gate1'])
+    for i in xrange(20):
+      asyncore.loop(timeout=0.1, count=1)
+      if [c for c in self.server._GetConnections() if c.subscription]:
+        break
+
+    now = datetime.datetime.now()
+    for gate_name in ('gate0', 'gate1'):
+      self.server.SendEventToClients(kbevent.LatchUpdate(gate_name=gate_name,
+          start_time=now, last_activity_time=now))
+    self.server.SendEventToClients(kbevent.EntryCreatedEvent(
+        gate_name='gate1', start_time=now, end_time=now))
+    for i in xrange(10):
+      asyncore.loop(timeout=0.1, count=1)
+
+    received = client.PopNotification(timeout=0)
+    self.assertEqual(received.gate_name, 'gate1')
+    self.assert_(isinstance(received, kbevent.LatchUpdate))
+    self.assert_(client._in_notifications.empty())
+    # Subscriptions are not published to the core.
+    self.assertEqual(self.env.GetEventHub()._WaitForEvent(timeout=0), None)
+    client.close()
+
+  def testBinaryEncoding(self):
+    old_encoding = FLAGS.gatenet_encoding
+    FLAGS.gatenet_encoding = 'binary'
+    try:
+      client = gatenet.GatenetClient(addr=self.addr)
+      self.assert_(client.Reconnect())
+    finally:
+      FLAGS.gatenet_encoding = old_encoding
+    for i in xrange(20):
+      asyncore.loop(timeout=0.1, count=1)
+      if client.encoding == gatenet.ENCODING_BINARY:
+        break
+    self.assertEqual(client.encoding, gatenet.ENCODING_BINARY)
+    self.assertEqual(self.server._GetConnections()[0].encoding,
+        gatenet.ENCODING_BINARY)
+
+    client.SendOpenLatch('gate0')
+    event = None
+    for i in xrange(20):
+      asyncore.loop(timeout=0.1, count=1)
+      event = self.env.GetEventHub()._WaitForEvent(timeout=0.1)
+      if event:
+        break
+    self.assert_(isinstance(event, kbevent.LatchRequest))
+    self.assertEqual(event.request, event.Action.OPEN_LATCH)
+
+    now = datetime.datetime.now()
+    self.server.SendEventToClients(kbevent.LatchUpdate(gate_name='gate0',
+        start_time=now, last_activity_time=now))
+    for i in xrange(20):
+      asyncore.loop(timeout=0.1, count=1)
+      if not client._in_notifications.empty():
+        break
+    received = client.PopNotification(timeout=0)
+    self.assert_(isinstance(received, kbevent.LatchUpdate))
+    self.assertEqual(received.gate_name, 'gate0')
+    client.close()
+
+  def testSlowClientPolicy(self):
+    old_policy = FLAGS.gatenet_slow_client_policy
+    slow = _SlowConnection()
+    self.server._connections[-1] = slow
+    try:
+      self.server.SendEventToClients(kbevent.Ping())
+      self.assert_(not slow.shut_down)
+      FLAGS.gatenet_slow_client_policy = 'disconnect'
+      self.server.SendEventToClients(kbevent.Ping())
+      self.assert_(slow.shut_down)
+    finally:
+      FLAGS.gatenet_slow_client_policy = old_policy
+      del self.server._connections[-1]
+
+  def testStaleConnection(self):
+    client = gatenet.GatenetClient(addr=self.addr)
+    self.assert_(client.Reconnect())
+    for i in xrange(20):
+      conns = self.server._GetConnections()
+      if conns:
+        break
+      time.sleep(0.05)
+    live = conns[0]
+
+    # A closed connection whose fd the kernel gave to |live|.
+    stale = epollnet._Connection(self.server, _StalledSocket(0), live.addr)
+    stale.fd = live.fd
+    stale._outbuf.append(('data', time.time()))
+    self.server._UpdateInterest(stale)
+    self.assertEqual(stale.mask, 0)
+    self.server.ChannelClosed(stale)
+    self.assertEqual(self.server._GetConnections(), [live])
+    client.close()
+
+  def testMalformedMessages(self):
+    hub = self.env.GetEventHub()
+    for data in ('[1]', '{"event":"Ping"}', '{"event":"Ping","data":5}'):
+      sock = socket.create_connection(self.server.GetAddress())
+      sock.sendall(data + gatenet.MESSAGE_TERMINATOR)
+      sock.sendall(kbevent.Ping().ToJson(indent=None) +
+          gatenet.MESSAGE_TERMINATOR)
+      # The malformed message is dropped; the next one still arrives.
+      self.assert_(isinstance(hub._WaitForEvent(timeout=2.0), kbevent.Ping))
+      self.assertEqual(hub._WaitForEvent(timeout=0), None)
+      sock.close()
+    self.assert_(self.thread.isAlive())
+
+  def testSendEvent(self):
+    gatenet.SendEvent(kbevent.AuthTokenChangedEvent(
+        auth_device='core.onewire', token_value='01'), self.addr)
+    event = self.env.GetEventHub()._WaitForEvent(timeout=2.0)
+    self.assert_(isinstance(event, kbevent.AuthTokenChangedEvent))
+    self.assertEqual(event.token_value, '01')
+
+  def testFragmentedMessages(self):
+    sock = socket.create_connection(self.server.GetAddress())
+    message = kbevent.Ping().ToJson(indent=None) + gatenet.MESSAGE_TERMINATOR
+    data = message * 2
+    sock.sendall(data[:5])
+    sock.sendall(data[5:len(message) + 1])
+    sock.sendall(data[len(message) + 1:])
+    hub = self.env.GetEventHub()
+    self.assert_(isinstance(hub._WaitForEvent(timeout=2.0), kbevent.Ping))
+    self.assert_(isinstance(hub._WaitForEvent(timeout=2.0), kbevent.Ping))
+    sock.close()
+
+if __name__ == '__main__':
+  unittest.main()
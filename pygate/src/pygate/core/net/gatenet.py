@@ -25,9 +25,13 @@
 
 import asyncore
 import asynchat
-import cStringIO
+import errno
+import fcntl
+import fnmatch
 import logging
+import os
 import Queue
+import re
 import socket
 import struct
 import sys
@@ -37,9 +41,10 @@ import time
 import gflags
 
 from pygate.core import kbevent
-from pygate.core import kbjson
 from pygate.core import kb_common
+from pygate.core import tracing
 from pygate.core import util
+from pygate.core.net import binproto
 
 FLAGS = gflags.FLAGS
 
@@ -54,20 +59,123 @@ gflags.DEFINE_string('kb_core_bind_addr', kb_common.KB_CORE_DEFAULT_ADDR,
 gflags.DEFINE_string('gate_name', 'gateboard.latch0',
     'Default tap name.')
 
+gflags.DEFINE_integer('gatenet_client_max_queue', 1000,
+    'Maximum number of outgoing messages queued for a single gatenet client '
+    'before --gatenet_slow_client_policy is applied.',
+    lower_bound=1)
+
+gflags.DEFINE_enum('gatenet_slow_client_policy', 'drop', ['drop', 'disconnect'],
+    'What to do with a message for a gatenet client whose outgoing queue is '
+    'full: "drop" the message for that client, or "disconnect" the client.')
+
+gflags.DEFINE_enum('gatenet_encoding', 'json', ['json', 'binary'],
+    'Message encoding a gatenet client asks the core to use.  "binary" is '
+    'more compact and cheaper to encode and decode; the connection stays on '
+    'JSON if the core does not agree to it.')
+
 MESSAGE_TERMINATOR = '\n\n'
 
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+
+
+def EncodeEvent(event, encoding=ENCODING_JSON):
+  """Returns |event| as it is sent on the wire with |encoding|."""
+  if encoding == ENCODING_BINARY:
+    return binproto.EncodeEvent(event)
+  return event.ToJson(indent=None) + MESSAGE_TERMINATOR
+
+
+def DecodeMessage(is_binary, payload):
+  """Decodes a message returned by MessageSplitter into an Event.
+
+  Raises ValueError if the message is malformed or of an unknown type.
+  """
+  if is_binary:
+    return binproto.DecodeEvent(payload)
+  return kbevent.DecodeEvent(payload)
+
+
+def SendEvent(event, addr=None, timeout=2.0):
+  """Sends |event| to the core at |addr| over a new connection, and closes
+  it.  For processes that do not run a GatenetClient.
+
+  Raises socket.error if the core cannot be reached.
+  """
+  if not addr:
+    addr = FLAGS.kb_core_addr
+  sock = socket.create_connection(util.str_to_addr(addr), timeout)
+  try:
+    sock.sendall(EncodeEvent(event))
+  finally:
+    sock.close()
+
+
+class MessageSplitter(object):
+  """Splits a gatenet byte stream into complete messages.
+
+  JSON messages (terminated by MESSAGE_TERMINATOR) and binary frames may be
+  freely interleaved, so a peer may switch encodings at any message boundary.
+  """
+  def __init__(self):
+    self._buf = ''
+    # Offset in _buf from which to resume searching for a terminator.
+    self._search_from = 0
+
+  def __len__(self):
+    return len(self._buf)
+
+  def Feed(self, data):
+    """Adds |data|, and returns a list of (is_binary, payload) messages."""
+    buf = self._buf + data
+    end = len(buf)
+    pos = 0
+    ret = []
+    while pos < end:
+      if buf[pos] == binproto.FRAME_MARKER:
+        start = pos + binproto.FRAME_HEADER_SIZE
+        if start > end:
+          break
+        stop = start + binproto.GetFrameLength(buf, pos)
+        if stop > end:
+          break
+        ret.append((True, buf[start:stop]))
+        pos = stop
+      else:
+        idx = buf.find(MESSAGE_TERMINATOR, max(pos, self._search_from))
+        if idx < 0:
+          self._search_from = end - len(MESSAGE_TERMINATOR) + 1
+          break
+        ret.append((False, buf[pos:idx]))
+        pos = idx + len(MESSAGE_TERMINATOR)
+    self._buf = buf[pos:]
+    self._search_from = max(0, self._search_from - pos)
+    return ret
+
+
+def NegotiateEncoding(logger, client, request):
+  """Returns the encoding to use for a client's EncodingRequest."""
+  if request.encoding == ENCODING_BINARY:
+    if request.schema_version == binproto.SCHEMA_VERSION:
+      logger.info('Client %s using binary encoding' % client)
+      return ENCODING_BINARY
+    logger.warning('Client %s has binary schema %s, expected %s; using json' %
+        (client, request.schema_version, binproto.SCHEMA_VERSION))
+  return ENCODING_JSON
+
 
 class GatenetProtocolHandler(asynchat.async_chat):
   """A general purpose request handler for the Gatenet protocol.
 
   This async_chat subclass can be used for client and server implementations.
-  The handler will call _HandleGatenetMessage on receipt of a complete gatenet
-  message.
+  The handler will call HandleNotification on receipt of a complete gatenet
+  message.  Outgoing messages use |encoding|; incoming messages may use
+  either encoding.
   """
   def __init__(self, sock=None):
     asynchat.async_chat.__init__(self, sock)
-    self.set_terminator(MESSAGE_TERMINATOR)
-    self._ibuffer = cStringIO.StringIO()
+    self.encoding = ENCODING_JSON
+    self._splitter = MessageSplitter()
     self._logger = logging.getLogger('gatenet')
     self._in_notifications = Queue.Queue()
     self._lock = threading.Lock()
@@ -83,41 +191,53 @@ class GatenetProtocolHandler(asynchat.async_chat):
   def initiate_send(self):
     return asynchat.async_chat.initiate_send(self)
 
-  def collect_incoming_data(self, data):
-    self._ibuffer.write(data)
-
-  def found_terminator(self):
-    strbuf = self._ibuffer.getvalue()
-    self._ibuffer.seek(0)
-    self._ibuffer.truncate()
+  def handle_read(self):
+    # Replaces async_chat's terminator-based framing, which cannot handle
+    # binary frames.
+    try:
+      data = self.recv(self.ac_in_buffer_size)
+    except socket.error:
+      self.handle_error()
+      return
+    for is_binary, payload in self._splitter.Feed(data):
+      self._HandleMessage(is_binary, payload)
 
-    if not strbuf:
+  def _HandleMessage(self, is_binary, payload):
+    if not payload:
       self._logger.warning('Received empty message')
       return
 
     try:
-      message_dict = kbjson.loads(strbuf)
-    except ValueError:
-      self._logger.warning('Received malformed message, dropping.')
+      event = DecodeMessage(is_binary, payload)
+    except ValueError, e:
+      self._logger.warning('Received malformed message, dropping: %s' % e)
       return
 
-    # Distinguish between requests, responses, and notifications, using JSON-RPC
-    # v2.0 rules
-    # (http://groups.google.com/group/json-rpc/web/json-rpc-1-2-proposal):
-
-    self._logger.debug('Received message: %s' % message_dict)
-    self.HandleNotification(message_dict)
+    self._logger.debug('Received message: %s' % event)
+    if isinstance(event, kbevent.EncodingRequest):
+      self.HandleEncodingRequest(event)
+      return
+    if isinstance(event, kbevent.EventAck):
+      self.HandleAck(event)
+      return
+    self.HandleNotification(event)
 
   def handle_close(self):
     asynchat.async_chat.handle_close(self)
     #self._server.ChannelClosed(self)
 
   ### GatenetProtocolHandler methods
-  def HandleNotification(self, message_dict):
-    self._logger.debug('Received notification: %s' % message_dict)
-    message = kbevent.DecodeEvent(message_dict)
+  def HandleNotification(self, message):
+    self._logger.debug('Received notification: %s' % message)
+    message = kbevent.DecodeEvent(message)
     self._in_notifications.put(message)
 
+  def HandleEncodingRequest(self, request):
+    self._logger.warning('Unexpected encoding request, ignoring.')
+
+  def HandleAck(self, ack):
+    self._logger.warning('Unexpected event ack, ignoring.')
+
   def PopNotification(self, timeout=None):
     return self._in_notifications.get(timeout=timeout)
 
@@ -125,8 +245,82 @@ class GatenetProtocolHandler(asynchat.async_chat):
     return asynchat.async_chat.push(self, data)
 
   def SendMessage(self, msg):
-    str_message = msg.ToJson(indent=None)
-    self.push(str_message + MESSAGE_TERMINATOR)
+    self.push(EncodeEvent(msg, self.encoding))
+
+
+class SubscriptionFilter(object):
+  """Precompiled form of a client's SubscriptionRequest."""
+  def __init__(self, event_types=None, gate_names=None):
+    self._event_classes = None
+    if event_types:
+      classes = set()
+      for name in event_types:
+        cls = kbevent.EVENT_NAME_TO_CLASS.get(name)
+        if cls is None:
+          raise ValueError('Unknown event type: %s' % name)
+        classes.add(cls)
+      self._event_classes = frozenset(classes)
+    self._gate_re = None
+    if gate_names:
+      pattern = '|'.join('(?:%s)' % fnmatch.translate(g) for g in gate_names)
+      self._gate_re = re.compile(pattern)
+    self._gate_matches = {}
+
+  @classmethod
+  def FromRequest(cls, request):
+    return cls(request.event_types, request.gate_names)
+
+  def Matches(self, event):
+    if (self._event_classes is not None and
+        event.__class__ not in self._event_classes):
+      return False
+    if self._gate_re is None or 'gate_name' not in event.class_fields:
+      return True
+    gate_name = event.gate_name
+    matches = self._gate_matches.get(gate_name)
+    if matches is None:
+      matches = bool(self._gate_re.match(gate_name or ''))
+      self._gate_matches[gate_name] = matches
+    return matches
+
+
+def ParseSubscription(logger, client, request):
+  """Returns the SubscriptionFilter for a client's |request|.
+
+  A bad request is logged and leaves the client's current subscription (its
+  |subscription| attribute) in place.
+  """
+  try:
+    subscription = SubscriptionFilter.FromRequest(request)
+  except (ValueError, re.error), e:
+    logger.warning('Bad subscription from %s, ignoring: %s' % (client, e))
+    return client.subscription
+  logger.info('Client %s subscribed: event_types=%s gate_names=%s' %
+      (client, request.event_types, request.gate_names))
+  return subscription
+
+
+def ExpectAck(event, client):
+  """Arranges for an EventAck to be pushed to |client| once the core has
+  handled |event|, if the client sent it from its journal."""
+  seq = event.journal_seq
+  if seq is None:
+    return
+  def SendAck():
+    client.Push(EncodeEvent(kbevent.EventAck(seq=seq), client.encoding))
+  event.pending_ack = kbevent.PendingAck(SendAck)
+
+
+def HandleSlowClient(logger, client):
+  """Applies --gatenet_slow_client_policy to a client that refused a message.
+
+  |client| must provide a consecutive_drops count and a Shutdown method.
+  """
+  if FLAGS.gatenet_slow_client_policy == 'disconnect':
+    logger.warning('Outgoing queue full for %s, disconnecting' % client)
+    client.Shutdown()
+  elif client.consecutive_drops == 1:
+    logger.warning('Outgoing queue full for %s, dropping events' % client)
 
 
 class GatenetServerHandler(GatenetProtocolHandler):
@@ -134,8 +328,43 @@ class GatenetServerHandler(GatenetProtocolHandler):
   def __init__(self, sock, server):
     GatenetProtocolHandler.__init__(self, sock)
     self._server = server
+    self.bytes_sent = 0
+    self.drops = 0
+    self.consecutive_drops = 0
+    self.subscription = None
     self._server.ChannelOpened(self)
 
+  def __str__(self):
+    return '%s:%i' % self.addr
+
+  def send(self, data):
+    sent = GatenetProtocolHandler.send(self, data)
+    self.bytes_sent += sent
+    return sent
+
+  def Push(self, data):
+    """Queues |data| unless the outgoing queue is full; returns success."""
+    # asynchat may split a message into several queue entries, so this is an
+    # upper bound on the number of queued messages.
+    if len(self.producer_fifo) >= FLAGS.gatenet_client_max_queue:
+      self.drops += 1
+      self.consecutive_drops += 1
+      return False
+    self.consecutive_drops = 0
+    self.push(data)
+    return True
+
+  def Shutdown(self):
+    """Disconnects a client; safe to call from outside the asyncore loop."""
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+
+  def GetStatus(self):
+    return ['%s: %s sent=%i bytes queued=%i drops=%i' % (self, self.encoding,
+        self.bytes_sent, len(self.producer_fifo), self.drops)]
+
   def handle_close(self):
     GatenetProtocolHandler.handle_close(self)
     self._logger.info('Closing down...')
@@ -148,20 +377,49 @@ class GatenetServerHandler(GatenetProtocolHandler):
     self._server.ChannelClosed(self)
     self.close()
 
-  def HandleNotification(self, message_dict):
-    GatenetProtocolHandler.HandleNotification(self, message_dict)
+  def HandleEncodingRequest(self, request):
+    encoding = NegotiateEncoding(self._server._logger, self, request)
+    # The reply is the last message sent with the old encoding.
+    reply = EncodeEvent(kbevent.EncodingRequest(encoding=encoding,
+        schema_version=binproto.SCHEMA_VERSION), self.encoding)
+    self.encoding = encoding
+    self.push(reply)
+
+  def HandleNotification(self, message):
+    GatenetProtocolHandler.HandleNotification(self, message)
+    event = self.PopNotification()
+    if isinstance(event, kbevent.SubscriptionRequest):
+      self.subscription = ParseSubscription(self._server._logger, self, event)
+      return
+    tracing.Stamp(event, 'core_receive')
+    ExpectAck(event, self)
     event_hub = self._server._kb_env.GetEventHub()
-    event_hub.PublishEvent(self.PopNotification())
+    event_hub.PublishEvent(event)
 
 
 class GatenetClient(GatenetProtocolHandler):
+  """Gatenet client.
+
+  If given a journal.EventJournal, events of JOURNALED_EVENTS types are
+  recorded there before sending, and replayed in order after a reconnect.
+  Each is sent with a journal_seq, and counts as delivered once the core
+  answers with an EventAck for it, after handling it.  Events the core had
+  not handled when a connection was lost are sent again, so the core may
+  see an event twice.
+  """
   RECONNECT_BACKOFF = [5, 5, 10, 10, 20, 20, 60]
-  def __init__(self, addr=None):
+  JOURNALED_EVENTS = (kbevent.TokenAuthEvent, kbevent.MeterUpdate)
+
+  def __init__(self, addr=None, journal=None):
     if not addr:
       addr = FLAGS.kb_core_addr
     self._addr = util.str_to_addr(addr)
     self._last_reconnect = 0
     self._num_retries = 0
+    self._journal = journal
+    # Reentrant: a send error while pushing from _SendJournal closes the
+    # connection.
+    self._journal_lock = threading.RLock()
     GatenetProtocolHandler.__init__(self)
 
   def Reconnect(self, force=False):
@@ -179,8 +437,19 @@ class GatenetClient(GatenetProtocolHandler):
     try:
       sock.connect(self._addr)
       self.set_socket(sock)
+      # The socket is connected synchronously above; newer asyncore versions
+      # only detect connection completion after a non-blocking connect().
+      self.connected = True
+      self.encoding = ENCODING_JSON
+      self._splitter = MessageSplitter()
+      if FLAGS.gatenet_encoding != ENCODING_JSON:
+        self.SendMessage(kbevent.EncodingRequest(
+            encoding=FLAGS.gatenet_encoding,
+            schema_version=binproto.SCHEMA_VERSION))
       self.onConnected()
       self._num_retries = 0
+      if self._journal is not None:
+        self._SendJournal()
       return True
     except socket.error:
       self._num_retries += 1
@@ -198,6 +467,57 @@ class GatenetClient(GatenetProtocolHandler):
       return amt - prev_wait
     return 0
 
+  def SendMessage(self, msg):
+    if self._journal is None or not isinstance(msg, self.JOURNALED_EVENTS):
+      return GatenetProtocolHandler.SendMessage(self, msg)
+    self._journal.Append(msg)
+    self._SendJournal()
+
+  def _SendJournal(self):
+    """Pushes every journaled event not yet sent on this connection."""
+    with self._journal_lock:
+      if not self.connected:
+        return
+      records = self._journal.TakeUnsent()
+      if not records:
+        return
+      now = time.time()
+      parts = []
+      for seq, record in records:
+        event = kbevent.DecodeEvent(record)
+        event.journal_seq = seq
+        if getattr(event, 'seen_at', None) is not None:
+          # Measured here, so that the core need not trust our clock.
+          event.age = max(0.0, now - event.seen_at)
+        parts.append(EncodeEvent(event, self.encoding))
+      self.push(''.join(parts))
+
+  def HandleAck(self, ack):
+    if self._journal is not None:
+      self._journal.Ack(ack.seq)
+
+  def close(self):
+    GatenetProtocolHandler.close(self)
+    if self._journal is not None:
+      with self._journal_lock:
+        # Anything not yet acknowledged is resent, from the journal, on
+        # reconnect.
+        self.discard_buffers()
+        self._journal.Rewind()
+
+  def GetStatus(self):
+    if self._journal is None:
+      return []
+    return self._journal.GetStatus()
+
+  def HandleEncodingRequest(self, reply):
+    if (reply.encoding == ENCODING_BINARY and
+        reply.schema_version == binproto.SCHEMA_VERSION):
+      self.encoding = ENCODING_BINARY
+    else:
+      self.encoding = ENCODING_JSON
+    self._logger.info('Using %s encoding' % self.encoding)
+
   ### convenience functions
   def SendPing(self):
     message = kbevent.Ping()
@@ -227,6 +547,30 @@ class GatenetClient(GatenetProtocolHandler):
     message.auth_device_name = auth_device_name
     message.token_value = token_value
     message.status = message.TokenState.ADDED
+    message.seen_at = time.time()
+    if FLAGS.trace_events:
+      tracing.StartTrace(message, 'client_send')
+    return self.SendMessage(message)
+
+  def SendAuthTokenChanged(self, auth_device=None, token_value=None):
+    """Tells the core to drop its cached copy of a token (or of all tokens,
+    if none is given)."""
+    message = kbevent.AuthTokenChangedEvent()
+    message.auth_device = auth_device
+    message.token_value = token_value
+    return self.SendMessage(message)
+
+  def SendSubscribe(self, event_types=None, gate_names=None):
+    """Asks the core to only send events matching the given filters.
+
+    |event_types| may contain Event classes or class names; |gate_names| are
+    shell-style patterns.  Either may be omitted to match everything.
+    """
+    message = kbevent.SubscriptionRequest()
+    if event_types:
+      message.event_types = [getattr(t, '__name__', t) for t in event_types]
+    if gate_names:
+      message.gate_names = list(gate_names)
     return self.SendMessage(message)
 
   def SendAuthTokenRemove(self, gate_name, auth_device_name, token_value):
@@ -235,6 +579,7 @@ class GatenetClient(GatenetProtocolHandler):
     message.auth_device_name = auth_device_name
     message.token_value = token_value
     message.status = message.TokenState.REMOVED
+    message.seen_at = time.time()
     return self.SendMessage(message)
 
   def onConnected(self):
@@ -249,15 +594,25 @@ class SimpleGatenetClient(GatenetClient):
   def serve_forever(self):
     self.Reconnect()
     while not self._quit:
+      if self._journal is not None:
+        self._journal.Sync()
       if not asyncore.socket_map:
+        # Wait out the reconnect backoff here, rather than in Reconnect(), so
+        # that the journal keeps being synced.
+        backoff_secs = self._ReconnectTimeout()
+        if backoff_secs:
+          time.sleep(min(backoff_secs, 0.5))
+          continue
         self.onDisconnected()
         self.Reconnect()
         continue
       asyncore.loop(timeout=0.5, count=1)
+    if self._journal is not None:
+      self._journal.Sync(force=True)
 
-  def HandleNotification(self, message_dict):
-    self._logger.debug('Received notification: %s' % message_dict)
-    event = kbevent.DecodeEvent(message_dict)
+  def HandleNotification(self, message):
+    self._logger.debug('Received notification: %s' % message)
+    event = kbevent.DecodeEvent(message)
     if isinstance(event, kbevent.LatchUpdate):
       self.onLatchUpdate(event)
     elif isinstance(event, kbevent.EntryCreatedEvent):
@@ -284,6 +639,34 @@ class GatenetClientThread(util.GatebotThread):
     self._client.serve_forever()
 
 
+class _WakeupDispatcher(asyncore.file_dispatcher):
+  """Self-pipe used to interrupt an asyncore loop from another thread."""
+  def __init__(self):
+    self._read_fd, self._write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self._read_fd)
+    os.close(self._read_fd)
+    flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+    fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    self.recv(4096)
+
+  def Wakeup(self):
+    try:
+      os.write(self._write_fd, 'x')
+    except OSError, e:
+      # A full pipe already guarantees a wakeup.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self._write_fd)
+
+
 class GatenetServer(asyncore.dispatcher):
   """asyncore server implementation for Gatenet protocol"""
   def __init__(self, name, kb_env, addr='', port=0, qsize=5):
@@ -294,6 +677,7 @@ class GatenetServer(asyncore.dispatcher):
     self._qsize = qsize
     self._clients = set()
     self._lock = threading.Lock()
+    self._wakeup = None
     asyncore.dispatcher.__init__(self)
 
   def StartServer(self):
@@ -302,10 +686,28 @@ class GatenetServer(asyncore.dispatcher):
     self.set_reuse_addr()
     self.bind(self._bind_address)
     self.listen(self._qsize)
+    self._wakeup = _WakeupDispatcher()
 
   def StopServer(self):
     self._logger.info("Stopping server")
     self.close()
+    if self._wakeup:
+      self._wakeup.close()
+      self._wakeup = None
+
+  def GetAddress(self):
+    """Returns the (host, port) the server is listening on."""
+    return self.socket.getsockname()
+
+  def Poll(self, timeout=None):
+    """Waits up to |timeout| seconds for socket activity, and services it."""
+    asyncore.loop(timeout=timeout, count=1)
+
+  def Wakeup(self):
+    """Interrupts a Poll in progress on another thread."""
+    wakeup = self._wakeup
+    if wakeup:
+      wakeup.Wakeup()
 
   @util.synchronized
   def ChannelOpened(self, channel):
@@ -318,20 +720,32 @@ class GatenetServer(asyncore.dispatcher):
     self._clients.remove(channel)
 
   @util.synchronized
+  def _GetClients(self):
+    return list(self._clients)
+
+  def GetStatus(self):
+    clients = self._GetClients()
+    ret = ['Clients: %i' % len(clients)]
+    for client in clients:
+      ret.extend(client.GetStatus())
+    return ret
+
   def SendEventToClients(self, event):
-    # TODO(mikey): filter events -- should be based on subscriptions & exclude
-    # internal events.
-    if not self._clients:
+    # TODO(mikey): exclude internal events.
+    clients = self._GetClients()
+    if not clients:
       return
-    #self._logger.info('Sending event to %i client(s): %s' %
-    #  (len(self._clients), ProtoMessageToShortStr(event)))
-    str_message = event.ToJson(indent=None)
-    for client in self._clients:
-      try:
-        client.push(str_message + MESSAGE_TERMINATOR)
-      except IndexError:
-        self._logger.warning('Exception sending to %s' % client)
-        util.LogTraceback(self._logger.warning)
+    # Encode at most once per encoding in use.
+    messages = {}
+    for client in clients:
+      if client.subscription and not client.subscription.Matches(event):
+        continue
+      str_message = messages.get(client.encoding)
+      if str_message is None:
+        str_message = EncodeEvent(event, client.encoding)
+        messages[client.encoding] = str_message
+      if not client.Push(str_message):
+        HandleSlowClient(self._logger, client)
 
   ### asyncore.dispatcher methods
 
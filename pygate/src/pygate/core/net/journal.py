@@ -0,0 +1,268 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Durable store-and-forward journal of outbound gatenet events.
+
+The journal file starts with a header holding the offset of the first
+undelivered record, followed by records appended in order.  Each record is
+a 32-bit length, the crc32 of the record's data, and the event's JSON.
+Appends are written immediately and fsync'd in batches by Sync(), which also
+rewrites the file without its delivered records once it grows past
+--gatenet_journal_max_bytes.
+
+Undelivered events are also kept in memory, so replaying them does not read
+the file.  A client takes events with TakeUnsent(), each with a sequence
+number, and confirms them with Ack() as the core acknowledges them; after a
+disconnect, Rewind() returns unacknowledged events to the unsent set.  Only
+the oldest events are ever removed, so an acknowledged event is kept until
+every event before it has been acknowledged too.
+"""
+
+import collections
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import gflags
+
+from pygate.core import util
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('gatenet_journal_max_bytes', 8 * 1024 * 1024,
+    'Maximum size of the outbound event journal.  If undelivered events '
+    'exceed this size, the oldest are discarded.')
+
+gflags.DEFINE_float('gatenet_journal_sync_interval', 0.5,
+    'Maximum time, in seconds, between journal fsyncs while there are '
+    'unsynced events.')
+
+_MAGIC = 'GBJ1'
+_FILE_HEADER = struct.Struct('>4sQ')
+_RECORD_HEADER = struct.Struct('>II')
+
+
+class JournalError(Exception):
+  """The journal file is not usable."""
+
+
+class EventJournal(object):
+  def __init__(self, path):
+    self._path = path
+    self._logger = logging.getLogger('journal')
+    self._lock = threading.Lock()
+    # Undelivered record data, oldest first; the first _num_taken have been
+    # handed out by TakeUnsent().  Records are numbered from _first_seq, and
+    # _acked holds the numbers of those acknowledged out of order.
+    self._records = collections.deque()
+    self._num_taken = 0
+    self._first_seq = 0
+    self._acked = set()
+    self._pending_bytes = 0
+    self._dirty = False
+    self._last_sync = 0
+    self.appended = 0
+    self.delivered = 0
+    self.dropped = 0
+    self._Open()
+
+  def _Open(self):
+    if not os.path.exists(self._path):
+      self._fd = open(self._path, 'w+b')
+      self._Reset()
+      return
+    self._fd = open(self._path, 'r+b')
+    data = self._fd.read()
+    if len(data) < _FILE_HEADER.size:
+      self._Reset()
+      return
+    magic, offset = _FILE_HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+      raise JournalError('%s is not an event journal' % self._path)
+    offset = max(offset, _FILE_HEADER.size)
+    end = offset
+    while end + _RECORD_HEADER.size <= len(data):
+      length, crc = _RECORD_HEADER.unpack_from(data, end)
+      record = data[end + _RECORD_HEADER.size:end + _RECORD_HEADER.size + length]
+      if len(record) != length or zlib.crc32(record) & 0xffffffff != crc:
+        break
+      self._records.append(record)
+      self._pending_bytes += _RECORD_HEADER.size + length
+      end += _RECORD_HEADER.size + length
+    if end < len(data):
+      # A write torn by a crash; everything after it is garbage.
+      self._logger.warning('Discarding %i bytes of partial record(s)' %
+          (len(data) - end))
+    self._committed = offset
+    self._end = max(end, offset)
+    self._fd.truncate(self._end)
+    if self._records:
+      self._logger.info('Loaded %i undelivered event(s)' % len(self._records))
+
+  def _Reset(self):
+    """Empties the journal file.  Called when nothing is undelivered."""
+    self._fd.seek(0)
+    self._fd.truncate()
+    self._committed = self._end = _FILE_HEADER.size
+    self._WriteHeader()
+
+  def _WriteHeader(self):
+    self._fd.seek(0)
+    self._fd.write(_FILE_HEADER.pack(_MAGIC, self._committed))
+    self._dirty = True
+
+  @util.synchronized
+  def Append(self, event):
+    """Records |event| for delivery.  Does not wait for the disk."""
+    record = event.ToJson(indent=None)
+    size = _RECORD_HEADER.size + len(record)
+    if (_FILE_HEADER.size + self._pending_bytes + size >
+        FLAGS.gatenet_journal_max_bytes):
+      self._DropOldest(size)
+    self._fd.seek(self._end)
+    self._fd.write(_RECORD_HEADER.pack(len(record),
+        zlib.crc32(record) & 0xffffffff))
+    self._fd.write(record)
+    self._end += size
+    self._records.append(record)
+    self._pending_bytes += size
+    self._dirty = True
+    self.appended += 1
+
+  def _DropOldest(self, needed):
+    """Discards the oldest undelivered records, so that the rest and
+    |needed| more bytes fit in --gatenet_journal_max_bytes."""
+    # Leave some headroom, so that the next appends do not discard again.
+    limit = FLAGS.gatenet_journal_max_bytes * 3 / 4
+    dropped = 0
+    while (self._records and
+        _FILE_HEADER.size + self._pending_bytes + needed > limit):
+      self._committed += self._PopRecord()
+      dropped += 1
+    self.dropped += dropped
+    self._logger.warning('Journal full, discarded %i oldest event(s)' %
+        dropped)
+    if not self._records:
+      self._Reset()
+    else:
+      self._WriteHeader()
+
+  def _Compact(self):
+    """Rewrites the journal with only its undelivered records."""
+    tmp_path = self._path + '.tmp'
+    tmp = open(tmp_path, 'wb')
+    tmp.write(_FILE_HEADER.pack(_MAGIC, _FILE_HEADER.size))
+    for record in self._records:
+      tmp.write(_RECORD_HEADER.pack(len(record),
+          zlib.crc32(record) & 0xffffffff))
+      tmp.write(record)
+    tmp.flush()
+    os.fsync(tmp.fileno())
+    tmp.close()
+    os.rename(tmp_path, self._path)
+    self._fd.close()
+    self._fd = open(self._path, 'r+b')
+    self._committed = _FILE_HEADER.size
+    self._end = self._committed + self._pending_bytes
+    self._dirty = False
+    self._last_sync = time.time()
+
+  def _PopRecord(self):
+    """Removes the oldest record; returns its size in the file."""
+    record = self._records.popleft()
+    size = _RECORD_HEADER.size + len(record)
+    self._pending_bytes -= size
+    self._acked.discard(self._first_seq)
+    self._first_seq += 1
+    if self._num_taken:
+      self._num_taken -= 1
+    return size
+
+  @util.synchronized
+  def TakeUnsent(self):
+    """Returns (sequence number, JSON) of the events not yet handed out and
+    not acknowledged, oldest first."""
+    ret = []
+    seq = self._first_seq + self._num_taken
+    for record in itertools.islice(self._records, self._num_taken, None):
+      if seq not in self._acked:
+        ret.append((seq, record))
+      seq += 1
+    self._num_taken = len(self._records)
+    return ret
+
+  @util.synchronized
+  def Ack(self, seq):
+    """Marks the event numbered |seq| as delivered."""
+    if not self._first_seq <= seq < self._first_seq + self._num_taken:
+      self._logger.warning('Ignoring ack of unknown event %s' % seq)
+      return
+    self._acked.add(seq)
+    delivered = 0
+    while self._first_seq in self._acked:
+      self._committed += self._PopRecord()
+      delivered += 1
+    if not delivered:
+      return
+    self.delivered += delivered
+    if not self._records:
+      self._Reset()
+    else:
+      self._WriteHeader()
+
+  @util.synchronized
+  def Rewind(self):
+    """Returns events handed out but not acknowledged to the unsent set."""
+    self._num_taken = 0
+
+  def HasUnsent(self):
+    return len(self._records) > self._num_taken
+
+  @util.synchronized
+  def Sync(self, force=False):
+    """Flushes the journal to disk, if it has unsynced changes and
+    --gatenet_journal_sync_interval has passed since the last sync.
+
+    Compacts the journal first, if it has grown too large.
+    """
+    if self._end > FLAGS.gatenet_journal_max_bytes:
+      self._Compact()
+      return
+    if not self._dirty:
+      return
+    now = time.time()
+    if not force and now - self._last_sync < FLAGS.gatenet_journal_sync_interval:
+      return
+    self._fd.flush()
+    os.fsync(self._fd.fileno())
+    self._dirty = False
+    self._last_sync = now
+
+  def Close(self):
+    self.Sync(force=True)
+    self._fd.close()
+
+  def GetStatus(self):
+    return ['journal %s: undelivered=%i unacked=%i bytes=%i appended=%i '
+        'delivered=%i dropped=%i' % (self._path, len(self._records),
+        self._num_taken - len(self._acked), self._end, self.appended,
+        self.delivered, self.dropped)]
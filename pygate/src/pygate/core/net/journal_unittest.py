@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""Unittest for journal module"""
+
+import asyncore
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import gflags
+
+from pygate.core import kbevent
+from pygate.core.net import epollnet
+from pygate.core.net import gatenet
+from pygate.core.net import journal
+
+FLAGS = gflags.FLAGS
+
+
+def _Token(value):
+  return kbevent.TokenAuthEvent(gate_name='gate0',
+      auth_device_name='core.onewire', token_value=value,
+      status=kbevent.TokenAuthEvent.TokenState.ADDED)
+
+
+def _Values(records):
+  return [kbevent.DecodeEvent(r).token_value for seq, r in records]
+
+
+def _AckAll(j, records):
+  for seq, record in records:
+    j.Ack(seq)
+
+
+class EventJournalTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'journal')
+    self.old_max = FLAGS.gatenet_journal_max_bytes
+
+  def tearDown(self):
+    FLAGS.gatenet_journal_max_bytes = self.old_max
+    shutil.rmtree(self.tmpdir)
+
+  def testDelivery(self):
+    j = journal.EventJournal(self.path)
+    for value in ('a', 'b', 'c'):
+      j.Append(_Token(value))
+    records = j.TakeUnsent()
+    self.assertEqual(_Values(records), ['a', 'b', 'c'])
+    self.assertEqual(j.TakeUnsent(), [])
+    j.Append(_Token('d'))
+    # An event acknowledged before an older one is kept until the older one
+    # is acknowledged, but is not sent again.
+    j.Ack(records[1][0])
+    self.assertEqual(j.delivered, 0)
+    # Taken but unacknowledged events come back after a rewind.
+    j.Rewind()
+    records = j.TakeUnsent()
+    self.assertEqual(_Values(records), ['a', 'c', 'd'])
+    _AckAll(j, records)
+    self.assert_(not j.HasUnsent())
+    self.assertEqual(j.delivered, 4)
+    j.Close()
+    self.assertEqual(os.path.getsize(self.path), journal._FILE_HEADER.size)
+
+  def testReopen(self):
+    j = journal.EventJournal(self.path)
+    for value in ('a', 'b', 'c'):
+      j.Append(_Token(value))
+    _AckAll(j, j.TakeUnsent())
+    j.Append(_Token('d'))
+    j.Append(_Token('e'))
+    j.Close()
+
+    # A write torn by a crash is discarded.
+    fd = open(self.path, 'ab')
+    fd.write('\x00\x00\x01\x00partial')
+    fd.close()
+
+    j = journal.EventJournal(self.path)
+    self.assertEqual(_Values(j.TakeUnsent()), ['d', 'e'])
+    j.Append(_Token('f'))
+    self.assertEqual(_Values(j.TakeUnsent()), ['f'])
+    j.Close()
+
+  def testBoundedSize(self):
+    record_size = len(_Token('0000').ToJson(indent=None)) + 8
+    FLAGS.gatenet_journal_max_bytes = record_size * 10
+    j = journal.EventJournal(self.path)
+    for i in xrange(5):
+      j.Append(_Token('%04i' % i))
+    _AckAll(j, j.TakeUnsent())
+    # Delivered events are compacted away before anything is discarded.
+    for i in xrange(5, 13):
+      j.Append(_Token('%04i' % i))
+    self.assertEqual(j.dropped, 0)
+    for i in xrange(13, 20):
+      j.Append(_Token('%04i' % i))
+    self.assert_(j.dropped > 0)
+    values = _Values(j.TakeUnsent())
+    self.assertEqual(values[-1], '0019')
+    self.assertEqual(len(values), 15 - j.dropped)
+    self.assertEqual(values, sorted(values))
+    # Discarded events are only rewritten out of the file by Sync().
+    j.Sync(force=True)
+    self.assert_(os.path.getsize(self.path) <= FLAGS.gatenet_journal_max_bytes)
+    j.Close()
+    j = journal.EventJournal(self.path)
+    self.assertEqual(_Values(j.TakeUnsent()), values)
+    j.Close()
+
+
+class ReplayTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.hub = kbevent.EventHub()
+    self.events = []
+    self.hub.AddListener(self, [kbevent.TokenAuthEvent])
+    self.server = epollnet.EpollGatenetServer(name='gatenet', kb_env=self,
+        addr='localhost:0')
+    self.server.StartServer()
+    self._quit = False
+    self.thread = threading.Thread(target=self._PollLoop)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def GetEventHub(self):
+    return self.hub
+
+  def PostEvent(self, event):
+    self.events.append(event)
+
+  def _Dispatch(self, j, count):
+    """Runs the client and the core until |count| events are delivered."""
+    for i in xrange(40):
+      asyncore.loop(timeout=0.05, count=1)
+      self.hub.DispatchEvents(timeout=0.05)
+      if j.delivered == count:
+        break
+
+  def _PollLoop(self):
+    while not self._quit:
+      self.server.Poll(0.1)
+
+  def tearDown(self):
+    self._quit = True
+    self.server.Wakeup()
+    self.thread.join(2.0)
+    self.server.StopServer()
+    shutil.rmtree(self.tmpdir)
+
+  def testReplayAfterOutage(self):
+    j = journal.EventJournal(os.path.join(self.tmpdir, 'journal'))
+    client = gatenet.GatenetClient(addr='%s:%i' % self.server.GetAddress(),
+        journal=j)
+    # Not connected: events are only journaled.
+    for value in ('a', 'b', 'c'):
+      client.SendAuthTokenAdd('gate0', 'core.onewire', value)
+    self.assert_(j.HasUnsent())
+
+    self.assert_(client.Reconnect())
+    client.SendAuthTokenRemove('gate0', 'core.onewire', 'c')
+    self._Dispatch(j, 4)
+    events = self.events
+    self.assertEqual([e.token_value for e in events], ['a', 'b', 'c', 'c'])
+    self.assertEqual(events[-1].status, kbevent.TokenAuthEvent.TokenState.REMOVED)
+    # The age of each event is measured by the client when it is sent.
+    for event in events:
+      self.assert_(event.seen_at <= time.time())
+      self.assert_(0 <= event.age < 5)
+    self.assert_(not j.HasUnsent())
+    self.assertEqual(j.delivered, 4)
+    client.close()
+    j.Close()
+
+  def testReplayedAge(self):
+    j = journal.EventJournal(os.path.join(self.tmpdir, 'journal'))
+    # A token seen an hour ago, journaled before the core went away.
+    j.Append(kbevent.TokenAuthEvent(gate_name='gate0',
+        auth_device_name='core.onewire', token_value='a',
+        status=kbevent.TokenAuthEvent.TokenState.ADDED,
+        seen_at=time.time() - 3600))
+    client = gatenet.GatenetClient(addr='%s:%i' % self.server.GetAddress(),
+        journal=j)
+    self.assert_(client.Reconnect())
+    self._Dispatch(j, 1)
+    self.assert_(3600 <= self.events[0].age < 3605)
+    client.close()
+    j.Close()
+
+  def testUnhandledEventsAreResent(self):
+    j = journal.EventJournal(os.path.join(self.tmpdir, 'journal'))
+    addr = '%s:%i' % self.server.GetAddress()
+    client = gatenet.GatenetClient(addr=addr, journal=j)
+    self.assert_(client.Reconnect())
+    client.SendAuthTokenAdd('gate0', 'core.onewire', 'a')
+    # Received by the core, but lost with it before being handled.
+    event = None
+    for i in xrange(40):
+      asyncore.loop(timeout=0.05, count=1)
+      event = self.hub._WaitForEvent(timeout=0.05)
+      if event:
+        break
+    self.assertEqual(event.token_value, 'a')
+    client.close()
+    self.assertEqual(j.delivered, 0)
+    self.assert_(j.HasUnsent())
+
+    client = gatenet.GatenetClient(addr=addr, journal=j)
+    self.assert_(client.Reconnect())
+    self._Dispatch(j, 1)
+    self.assertEqual([e.token_value for e in self.events], ['a'])
+    self.assert_(not j.HasUnsent())
+    client.close()
+    j.Close()
+
+if __name__ == '__main__':
+  unittest.main()
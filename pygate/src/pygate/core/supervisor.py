@@ -0,0 +1,414 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs the gatebot core as a front process and several worker processes.
+
+With --core_workers=N, gate_core starts N copies of itself as workers.  Each
+worker is a complete core which only registers the gates WorkerForGate()
+assigns to it, and serves gatenet on a local port.  The front process
+accepts the gatenet clients.  It routes their events to the worker owning
+the event's gate, or to every worker for group and global events.  Worker
+output (LatchUpdate and EntryCreatedEvent) is passed back to the front's
+subscribers.
+
+Token and meter events, which gatenet clients journal, are kept by the
+front until the worker acknowledges them, and sent again if the worker
+reconnects first; the front only acknowledges them to the client after
+that.  Other events for a worker that is not connected, such as while it
+starts, are dropped and counted.  Dead workers are restarted.
+"""
+
+import collections
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import gflags
+
+from pygate.core import kb_app
+from pygate.core import kb_common
+from pygate.core import kb_threads
+from pygate.core import kbevent
+from pygate.core import util
+from pygate.core.net import gatenet
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('core_workers', 1,
+    'If greater than 1, runs the core as a front process and this many '
+    'worker processes, each owning a share of the gates.',
+    lower_bound=1)
+
+gflags.DEFINE_integer('core_worker_index', -1,
+    'Set by the front process on the workers it starts; not for use on the '
+    'command line.')
+
+gflags.DEFINE_integer('core_worker_base_port', 0,
+    'First local port for worker gatenet servers; worker i listens on this '
+    'port plus i.  Default is the port after --kb_core_bind_addr.')
+
+gflags.DEFINE_float('core_worker_restart_delay', 5.0,
+    'Seconds to wait before restarting a worker process that died.')
+
+gflags.DEFINE_integer('core_worker_backlog', 1000,
+    'Maximum number of token and meter events the front process keeps for '
+    'a worker until the worker acknowledges them.  Beyond this, the oldest '
+    'are discarded.',
+    lower_bound=1)
+
+# Seed for WorkerForGate, so that its partitioning is independent of the
+# --service_shards partitioning within each worker.
+WORKER_SEED = 0x1d
+
+# Front process events which are not passed on to the workers.
+_LOCAL_EVENTS = (
+  kbevent.QuitEvent,
+  kbevent.StartCompleteEvent,
+  kbevent.SubscriptionRequest,
+  kbevent.EncodingRequest,
+)
+
+
+def IsFront():
+  return FLAGS.core_workers > 1 and FLAGS.core_worker_index < 0
+
+
+def IsWorker():
+  return FLAGS.core_worker_index >= 0
+
+
+def WorkerForGate(gate_name, num_workers):
+  """Returns the index of the worker which owns |gate_name|."""
+  return kb_threads.ShardForGate(gate_name, num_workers, seed=WORKER_SEED)
+
+
+def GetWorkerAddresses(num_workers):
+  host, port = util.str_to_addr(FLAGS.kb_core_bind_addr)
+  base_port = FLAGS.core_worker_base_port or port + 1
+  return ['127.0.0.1:%i' % (base_port + i) for i in xrange(num_workers)]
+
+
+class WorkerLink(gatenet.GatenetClient):
+  """The front process's connection to one worker.
+
+  Events of JOURNALED_EVENTS types are kept until the worker acknowledges
+  them, holding the client's acknowledgement, and are sent again after a
+  reconnect.
+  """
+  def __init__(self, index, addr, server):
+    gatenet.GatenetClient.__init__(self, addr=addr)
+    self._index = index
+    self._server = server
+    self._logger = logging.getLogger('worker-link-%i' % index)
+    # Maps journal_seq to the unacknowledged events, oldest first.
+    self._pending = collections.OrderedDict()
+    self._next_seq = 0
+    self._link_lock = threading.Lock()
+    self.sent = 0
+    self.received = 0
+    self.dropped = 0
+
+  def MaybeReconnect(self):
+    """Reconnects, unless connected or waiting out the reconnect backoff."""
+    if self.connected or self._ReconnectTimeout():
+      return
+    self.Reconnect()
+
+  def Forward(self, event):
+    if isinstance(event, self.JOURNALED_EVENTS):
+      self._ForwardJournaled(event)
+      return
+    if not self.connected:
+      self.dropped += 1
+      return
+    self.SendMessage(event)
+    self.sent += 1
+
+  def _ForwardJournaled(self, event):
+    # A copy, since the event may be forwarded to other workers with other
+    # journal_seqs.
+    copy = kbevent.DecodeEvent(event.ToDict())
+    copy.pending_ack = event.pending_ack
+    if copy.pending_ack is not None:
+      copy.pending_ack.Hold()
+    self._link_lock.acquire()
+    try:
+      self._next_seq += 1
+      copy.journal_seq = self._next_seq
+      self._pending[copy.journal_seq] = copy
+      if len(self._pending) > FLAGS.core_worker_backlog:
+        seq, oldest = self._pending.popitem(last=False)
+        self.dropped += 1
+        self._logger.warning('Backlog for worker %i full, discarding %s' %
+            (self._index, oldest))
+        self._Release(oldest)
+      if self.connected:
+        self.SendMessage(copy)
+        self.sent += 1
+    finally:
+      self._link_lock.release()
+
+  def _Release(self, event):
+    if event.pending_ack is not None:
+      event.pending_ack.Release()
+
+  def onConnected(self):
+    gatenet.GatenetClient.onConnected(self)
+    self._link_lock.acquire()
+    try:
+      if self._pending:
+        self._logger.info('Resending %i event(s) to worker %i' %
+            (len(self._pending), self._index))
+      for event in self._pending.itervalues():
+        self.SendMessage(event)
+        self.sent += 1
+    finally:
+      self._link_lock.release()
+
+  def HandleAck(self, ack):
+    self._link_lock.acquire()
+    try:
+      event = self._pending.pop(ack.seq, None)
+    finally:
+      self._link_lock.release()
+    if event is not None:
+      self._Release(event)
+
+  def HandleNotification(self, message):
+    gatenet.GatenetClient.HandleNotification(self, message)
+    event = self.PopNotification()
+    self.received += 1
+    self._server.SendEventToClients(event)
+
+  def handle_close(self):
+    self._logger.warning('Worker %i disconnected' % self._index)
+    self.close()
+
+  def GetStatus(self):
+    return ['worker %i %s:%i: connected=%s sent=%i received=%i dropped=%i '
+        'unacked=%i' % ((self._index,) + self._addr + (self.connected,
+        self.sent, self.received, self.dropped, len(self._pending)))]
+
+
+class EventRouter(object):
+  """Event hub listener passing client events to the owning workers."""
+  def __init__(self, links, gate_groups):
+    self._links = links
+    self._broadcast_names = set(gate_groups)
+    self._broadcast_names.add(kb_common.ALIAS_ALL_GATES)
+
+  def GetEventTypes(self):
+    return kbevent.ALL_EVENTS
+
+  def PostEvent(self, event):
+    # Called from the event hub thread.
+    if isinstance(event, _LOCAL_EVENTS):
+      return
+    for link in self._LinksForEvent(event):
+      link.Forward(event)
+
+  def _LinksForEvent(self, event):
+    if isinstance(event, kb_threads.GATE_EVENTS):
+      gate_name = event.gate_name
+      if gate_name not in self._broadcast_names:
+        return (self._links[WorkerForGate(gate_name, len(self._links))],)
+    return self._links
+
+
+class WorkerProcess(object):
+  """A worker core, run as a child process."""
+  def __init__(self, index, num_workers, addr):
+    self._index = index
+    self._num_workers = num_workers
+    self._addr = addr
+    self._proc = None
+    self._stopped = False
+    self._logger = logging.getLogger('worker-%i' % index)
+    self.started_at = 0
+    self.restarts = 0
+
+  def GetArgv(self):
+    argv = [sys.executable] + sys.argv + [
+      '--core_worker_index=%i' % self._index,
+      '--core_workers=%i' % self._num_workers,
+      '--kb_core_bind_addr=%s' % self._addr,
+      '--nodaemon',
+      '--pidfile=',
+    ]
+    if FLAGS.log_to_file:
+      argv.append('--logfile=%s.worker%i' % (FLAGS.logfile, self._index))
+    for flag in ('trace_histogram_file', 'handler_stats_file'):
+      path = getattr(FLAGS, flag)
+      if path:
+        argv.append('--%s=%s.worker%i' % (flag, path, self._index))
+    return argv
+
+  def Start(self):
+    self._logger.info('Starting worker on %s' % self._addr)
+    # In its own process group, so that a ^C reaches only the front process,
+    # which stops the workers itself.
+    self._proc = subprocess.Popen(self.GetArgv(), close_fds=True,
+        preexec_fn=os.setpgrp)
+    self.started_at = time.time()
+
+  def IsAlive(self):
+    return self._proc is not None and self._proc.poll() is None
+
+  def MaybeRestart(self):
+    """Restarts the worker if it has died, at most every
+    --core_worker_restart_delay seconds."""
+    if self._proc is None or self._stopped or self.IsAlive():
+      return
+    if time.time() - self.started_at < FLAGS.core_worker_restart_delay:
+      return
+    self._logger.error('Worker exited with status %s, restarting' %
+        self._proc.returncode)
+    self.restarts += 1
+    self.Start()
+
+  def DumpStatus(self):
+    """Asks the worker to dump its status, as for SIGUSR1."""
+    if self.IsAlive():
+      self._proc.send_signal(signal.SIGUSR1)
+
+  def Stop(self):
+    """Asks the worker to quit.  It will not be restarted."""
+    self._stopped = True
+    if self.IsAlive():
+      self._proc.send_signal(signal.SIGTERM)
+
+  def Wait(self, deadline):
+    """Waits for a stopped worker to exit, killing it at |deadline|."""
+    if self._proc is None:
+      return
+    while self.IsAlive() and time.time() < deadline:
+      time.sleep(0.1)
+    if self.IsAlive():
+      self._logger.error('Worker did not quit, killing it')
+      self._proc.kill()
+    self._proc.wait()
+
+  def GetStatus(self):
+    if self._proc is None:
+      state = 'not started'
+    elif self.IsAlive():
+      state = 'pid %i' % self._proc.pid
+    else:
+      state = 'exited (%s)' % self._proc.returncode
+    return ['worker %i: %s restarts=%i' % (self._index, state, self.restarts)]
+
+
+class SupervisorEnv(object):
+  """Front process counterpart of gatebot.GatebotEnv."""
+  def __init__(self, num_workers=None):
+    if num_workers is None:
+      num_workers = FLAGS.core_workers
+    self._event_hub = kbevent.EventHub()
+    self._gatenet_server = gatenet.GatenetServer(name='gatenet', kb_env=self,
+        addr=FLAGS.kb_core_bind_addr)
+    addrs = GetWorkerAddresses(num_workers)
+    self._workers = [WorkerProcess(i, num_workers, addr)
+        for i, addr in enumerate(addrs)]
+    self._links = [WorkerLink(i, addr, self._gatenet_server)
+        for i, addr in enumerate(addrs)]
+    self._event_hub.AddListener(EventRouter(self._links,
+        kb_threads.GetGateGroups()))
+
+    self._threads = set()
+    self.AddThread(kb_threads.EventHubServiceThread(self, 'eventhub-thread'))
+    self.AddThread(kb_threads.NetProtocolThread(self, 'net-thread'))
+
+  def AddThread(self, thr):
+    self._threads.add(thr)
+    self._event_hub.AddListener(thr)
+
+  def GetEventHub(self):
+    return self._event_hub
+
+  def GetGatenetServer(self):
+    return self._gatenet_server
+
+  def GetThreads(self):
+    return self._threads
+
+  def GetWorkers(self):
+    return self._workers
+
+  def GetLinks(self):
+    return self._links
+
+  def GetStatus(self):
+    ret = []
+    for worker, link in zip(self._workers, self._links):
+      ret.extend(worker.GetStatus())
+      ret.extend(link.GetStatus())
+    return ret
+
+
+class GatebotSupervisorApp(kb_app.App):
+  def __init__(self, name='core'):
+    kb_app.App.__init__(self, name)
+    self._env = SupervisorEnv()
+
+  def _Setup(self):
+    kb_app.App._Setup(self)
+    for thr in self._env.GetThreads():
+      self._AddAppThread(thr)
+
+  def _MainLoop(self):
+    for worker in self._env.GetWorkers():
+      worker.Start()
+    while not self._do_quit:
+      for worker, link in zip(self._env.GetWorkers(), self._env.GetLinks()):
+        worker.MaybeRestart()
+        if worker.IsAlive():
+          link.MaybeReconnect()
+      self._quit_event.wait(1.0)
+
+  def _DumpStatus(self):
+    kb_app.App._DumpStatus(self)
+    for line in self._env.GetStatus():
+      self._logger.info(line)
+    for worker in self._env.GetWorkers():
+      worker.DumpStatus()
+    if FLAGS.handler_stats_file:
+      try:
+        kb_threads.DumpStats(FLAGS.handler_stats_file,
+            self._env.GetEventHub(), self._env.GetThreads())
+      except IOError, e:
+        self._logger.warning('Could not write %s: %s' % (
+            FLAGS.handler_stats_file, e))
+
+  def Quit(self):
+    self._do_quit = True
+    self._quit_event.set()
+    # Workers record their queued entries before they exit.
+    self._logger.info('Stopping workers')
+    for worker in self._env.GetWorkers():
+      worker.Stop()
+    deadline = time.time() + 10.0
+    for worker in self._env.GetWorkers():
+      worker.Wait(deadline)
+    self._env.GetEventHub().PublishEvent(kbevent.QuitEvent())
+    self._StopThreads()
+    self._logger.info('Gatebot stopped.')
+    self._TeardownLogging()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""Unittest for supervisor module"""
+
+import threading
+import time
+import unittest
+
+import gflags
+
+from pygate.core import kb_common
+from pygate.core import kbevent
+from pygate.core import supervisor
+from pygate.core.net import gatenet
+
+FLAGS = gflags.FLAGS
+
+
+class _FakeLink(object):
+  def __init__(self):
+    self.events = []
+
+  def Forward(self, event):
+    self.events.append(event)
+
+
+class EventRouterTestCase(unittest.TestCase):
+  def testRouting(self):
+    links = [_FakeLink() for i in xrange(3)]
+    router = supervisor.EventRouter(links, {'bar': ['gate1', 'gate2']})
+    for i in xrange(20):
+      router.PostEvent(kbevent.LatchRequest(gate_name='gate%i' % i))
+    for i, link in enumerate(links):
+      for event in link.events:
+        self.assertEqual(supervisor.WorkerForGate(event.gate_name, 3), i)
+    self.assertEqual(sum(len(link.events) for link in links), 20)
+    self.assert_(all(link.events for link in links))
+
+    # Groups, aliases and global events go to every worker.
+    for link in links:
+      del link.events[:]
+    router.PostEvent(kbevent.TokenAuthEvent(gate_name='bar'))
+    router.PostEvent(kbevent.TokenAuthEvent(
+        gate_name=kb_common.ALIAS_ALL_GATES))
+    router.PostEvent(kbevent.AuthTokenChangedEvent())
+    router.PostEvent(kbevent.QuitEvent())
+    for link in links:
+      self.assertEqual(len(link.events), 3)
+
+  def testWorkerArgv(self):
+    worker = supervisor.WorkerProcess(1, 4, '127.0.0.1:9807')
+    argv = worker.GetArgv()
+    self.assert_('--core_worker_index=1' in argv)
+    self.assert_('--kb_core_bind_addr=127.0.0.1:9807' in argv)
+
+
+class _FakeFrontServer(object):
+  def __init__(self):
+    self.events = []
+    self.got_event = threading.Event()
+
+  def SendEventToClients(self, event):
+    self.events.append(event)
+    self.got_event.set()
+
+
+class WorkerLinkTestCase(unittest.TestCase):
+  def setUp(self):
+    self.hub = kbevent.EventHub()
+    self.worker = gatenet.GatenetServer(name='gatenet', kb_env=self,
+        addr='localhost:0')
+    self.worker.StartServer()
+    self._quit = False
+    self.thread = threading.Thread(target=self._PollLoop)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def GetEventHub(self):
+    return self.hub
+
+  def _PollLoop(self):
+    while not self._quit:
+      self.worker.Poll(0.05)
+
+  def tearDown(self):
+    self._quit = True
+    self.worker.Wakeup()
+    self.thread.join(2.0)
+    self.worker.StopServer()
+
+  def testForwarding(self):
+    front = _FakeFrontServer()
+    link = supervisor.WorkerLink(0, '%s:%i' % self.worker.GetAddress(), front)
+    link.Forward(kbevent.Ping())
+    self.assertEqual(link.dropped, 1)
+
+    link.MaybeReconnect()
+    self.assert_(link.connected)
+    link.Forward(kbevent.LatchRequest(gate_name='gate0'))
+    event = self.hub._WaitForEvent(timeout=2.0)
+    self.assertEqual(event.gate_name, 'gate0')
+
+    # Worker output is passed to the front's clients.
+    deadline = time.time() + 2.0
+    while not self.worker._GetClients() and time.time() < deadline:
+      time.sleep(0.01)
+    self.worker.SendEventToClients(kbevent.LatchUpdate(gate_name='gate0',
+        latch_id=7))
+    self.assert_(front.got_event.wait(2.0))
+    self.assertEqual(front.events[0].latch_id, 7)
+    self.assertEqual(len(link.GetStatus()), 1)
+    link.close()
+
+  def testJournaledEvents(self):
+    front = _FakeFrontServer()
+    link = supervisor.WorkerLink(0, '%s:%i' % self.worker.GetAddress(), front)
+    acks = []
+    event = kbevent.TokenAuthEvent(gate_name='gate0', token_value='a')
+    event.pending_ack = kbevent.PendingAck(lambda: acks.append(event))
+    # Held by the front's event hub while it dispatches the event.
+    event.pending_ack.Hold()
+    link.Forward(event)
+    event.pending_ack.Release()
+    self.assertEqual(link.dropped, 0)
+    self.assertEqual(acks, [])
+
+    # Sent once the worker is connected, and acknowledged to the client once
+    # the worker has handled it.
+    link.MaybeReconnect()
+    self.assertEqual(self.hub.DispatchEvents(timeout=2.0), 1)
+    deadline = time.time() + 2.0
+    while not acks and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(acks, [event])
+    self.assertEqual(link._pending, {})
+    link.close()
+
+if __name__ == '__main__':
+  unittest.main()
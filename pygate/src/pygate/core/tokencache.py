@@ -0,0 +1,202 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""LRU cache of auth tokens resolved by the backend."""
+
+import collections
+import threading
+import time
+
+import gflags
+
+from pygate.core import util
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('auth_token_cache_size', 1024,
+    'Maximum number of auth tokens the core keeps cached.  Set to 0 to '
+    'disable the cache.')
+
+gflags.DEFINE_integer('auth_token_cache_ttl', 300,
+    'Seconds an auth token may be cached before it is fetched from the '
+    'backend again.')
+
+gflags.DEFINE_integer('auth_token_negative_cache_size', 1024,
+    'Maximum number of unknown or unassigned auth tokens the core remembers, '
+    'so that repeated scans of them do not hit the backend.')
+
+gflags.DEFINE_integer('auth_token_negative_ttl', 30,
+    'Seconds an unknown auth token is remembered.  Tokens assigned by a '
+    'process which does not tell the core about changes (the web app does) '
+    'may be ignored by the core for this long.')
+
+gflags.DEFINE_integer('unknown_token_log_size', 1024,
+    'Maximum number of distinct unknown auth tokens kept between flushes '
+    'to the backend.')
+
+# Returned by TokenCache.Get() for a token known not to be assigned.
+NO_TOKEN = object()
+
+
+def _ToTimestamp(dt):
+  return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class TokenCache(object):
+  """Maps (auth_device, token_value) to the token returned by the backend.
+
+  Entries expire after |ttl| seconds, or at the token's own expire_time if
+  that is sooner, and the least recently used entry is evicted when the
+  cache is full.
+
+  Tokens the backend does not know (or which are unassigned) are kept
+  separately, for a shorter time, so that a flood of them cannot evict
+  real tokens.
+
+  Every Invalidate() bumps |generation|.  A caller looking a token up in the
+  backend passes the generation it saw before the lookup to Put() or
+  PutMissing(), so that a result made stale by an invalidation during the
+  lookup is not cached.
+  """
+  def __init__(self, max_size=None, ttl=None, negative_size=None,
+      negative_ttl=None):
+    if max_size is None:
+      max_size = FLAGS.auth_token_cache_size
+    if ttl is None:
+      ttl = FLAGS.auth_token_cache_ttl
+    if negative_size is None:
+      negative_size = FLAGS.auth_token_negative_cache_size
+    if negative_ttl is None:
+      negative_ttl = FLAGS.auth_token_negative_ttl
+    self._max_size = max_size
+    self._ttl = ttl
+    self._negative_size = negative_size
+    self._negative_ttl = negative_ttl
+    # Maps key to (token, expires at), least recently used first.
+    self._entries = collections.OrderedDict()
+    # Maps key to expires at, for tokens known to be missing.
+    self._missing = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.negative_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+    self.generation = 0
+
+  @util.synchronized
+  def Get(self, auth_device, token_value, now=None):
+    """Returns the cached token, NO_TOKEN, or None if not cached."""
+    key = (auth_device, token_value)
+    if now is None:
+      now = time.time()
+    entry = self._entries.pop(key, None)
+    if entry is not None and entry[1] > now:
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[0]
+    expires = self._missing.pop(key, None)
+    if expires is not None and expires > now:
+      self._missing[key] = expires
+      self.negative_hits += 1
+      return NO_TOKEN
+    self.misses += 1
+    return None
+
+  @util.synchronized
+  def PutMissing(self, auth_device, token_value, now=None, generation=None):
+    """Remembers that the backend has no assigned token for this key."""
+    if self._negative_size <= 0 or not self._IsCurrent(generation):
+      return
+    if now is None:
+      now = time.time()
+    key = (auth_device, token_value)
+    self._missing.pop(key, None)
+    self._missing[key] = now + self._negative_ttl
+    while len(self._missing) > self._negative_size:
+      self._missing.popitem(last=False)
+
+  @util.synchronized
+  def Put(self, auth_device, token_value, token, now=None, generation=None):
+    if self._max_size <= 0 or not self._IsCurrent(generation):
+      return
+    if now is None:
+      now = time.time()
+    expires = now + self._ttl
+    expire_time = token.get('expire_time')
+    if expire_time:
+      expires = min(expires, _ToTimestamp(expire_time))
+    key = (auth_device, token_value)
+    self._entries.pop(key, None)
+    self._entries[key] = (token, expires)
+    while len(self._entries) > self._max_size:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  @util.synchronized
+  def Invalidate(self, auth_device=None, token_value=None):
+    """Drops a token from the cache; with no arguments, drops everything."""
+    self.invalidations += 1
+    self.generation += 1
+    if auth_device is None and token_value is None:
+      self._entries.clear()
+      self._missing.clear()
+    else:
+      key = (auth_device, token_value)
+      self._entries.pop(key, None)
+      self._missing.pop(key, None)
+
+  def _IsCurrent(self, generation):
+    return generation is None or generation == self.generation
+
+  def GetStatus(self):
+    return ['Token cache: size=%i/%i missing=%i/%i hits=%i negative_hits=%i '
+        'misses=%i evictions=%i invalidations=%i' % (len(self._entries),
+        self._max_size, len(self._missing), self._negative_size, self.hits,
+        self.negative_hits, self.misses, self.evictions, self.invalidations)]
+
+
+class UnknownTokenLog(object):
+  """Collects unknown tokens seen between flushes, once each."""
+  def __init__(self, max_size=None):
+    if max_size is None:
+      max_size = FLAGS.unknown_token_log_size
+    self._max_size = max_size
+    # Maps (auth_device, token_value) to the number of times it was seen.
+    self._pending = {}
+    self._lock = threading.Lock()
+    self.dropped = 0
+
+  @util.synchronized
+  def Record(self, auth_device, token_value):
+    key = (auth_device, token_value)
+    count = self._pending.get(key)
+    if count is None and len(self._pending) >= self._max_size:
+      self.dropped += 1
+      return
+    self._pending[key] = (count or 0) + 1
+
+  @util.synchronized
+  def TakeBatch(self):
+    """Returns, and forgets, a {(auth_device, token_value): count} dict."""
+    ret = self._pending
+    self._pending = {}
+    return ret
+
+  def __len__(self):
+    return len(self._pending)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""Unittest for tokencache module"""
+
+import datetime
+import time
+import unittest
+
+from pygate.core import tokencache
+from pygate.core import util
+
+def _Token(username, expire_time=None):
+  token = util.AttrDict(username=username)
+  if expire_time:
+    token.expire_time = expire_time
+  return token
+
+class TokenCacheTestCase(unittest.TestCase):
+  def testHitsAndMisses(self):
+    cache = tokencache.TokenCache(max_size=10, ttl=60)
+    self.assertEqual(cache.Get('core.onewire', '01'), None)
+    cache.Put('core.onewire', '01', _Token('bob'))
+    self.assertEqual(cache.Get('core.onewire', '01').username, 'bob')
+    self.assertEqual(cache.Get('core.rfid', '01'), None)
+    self.assertEqual((cache.hits, cache.misses), (1, 2))
+    self.assertEqual(len(cache.GetStatus()), 1)
+
+  def testExpiry(self):
+    cache = tokencache.TokenCache(max_size=10, ttl=60)
+    now = time.time()
+    cache.Put('core.onewire', '01', _Token('bob'), now=now)
+    self.assert_(cache.Get('core.onewire', '01', now=now + 59))
+    self.assertEqual(cache.Get('core.onewire', '01', now=now + 61), None)
+    # An expired entry is gone for good.
+    self.assertEqual(cache.Get('core.onewire', '01', now=now), None)
+
+    # The token's own expiry wins if it is sooner.
+    expire_time = datetime.datetime.fromtimestamp(now + 10)
+    cache.Put('core.onewire', '02', _Token('amy', expire_time), now=now)
+    self.assert_(cache.Get('core.onewire', '02', now=now + 9))
+    self.assertEqual(cache.Get('core.onewire', '02', now=now + 11), None)
+
+  def testLeastRecentlyUsedEviction(self):
+    cache = tokencache.TokenCache(max_size=2, ttl=60)
+    cache.Put('core.onewire', '01', _Token('bob'))
+    cache.Put('core.onewire', '02', _Token('amy'))
+    cache.Get('core.onewire', '01')
+    cache.Put('core.onewire', '03', _Token('joe'))
+    self.assertEqual(cache.evictions, 1)
+    self.assert_(cache.Get('core.onewire', '01'))
+    self.assertEqual(cache.Get('core.onewire', '02'), None)
+    self.assert_(cache.Get('core.onewire', '03'))
+
+  def testInvalidate(self):
+    cache = tokencache.TokenCache(max_size=10, ttl=60)
+    cache.Put('core.onewire', '01', _Token('bob'))
+    cache.Put('core.onewire', '02', _Token('amy'))
+    cache.Invalidate('core.onewire', '01')
+    self.assertEqual(cache.Get('core.onewire', '01'), None)
+    self.assert_(cache.Get('core.onewire', '02'))
+    cache.Invalidate()
+    self.assertEqual(cache.Get('core.onewire', '02'), None)
+
+  def testInvalidateDuringLookup(self):
+    cache = tokencache.TokenCache(max_size=10, ttl=60)
+    generation = cache.generation
+    # The token is disabled while the backend is looking it up.
+    cache.Invalidate('core.onewire', '01')
+    cache.Put('core.onewire', '01', _Token('bob'), generation=generation)
+    cache.PutMissing('core.onewire', '02', generation=generation)
+    self.assertEqual(cache.Get('core.onewire', '01'), None)
+    self.assertEqual(cache.Get('core.onewire', '02'), None)
+    cache.Put('core.onewire', '01', _Token('bob'),
+        generation=cache.generation)
+    self.assert_(cache.Get('core.onewire', '01'))
+
+  def testDisabled(self):
+    cache = tokencache.TokenCache(max_size=0, ttl=60)
+    cache.Put('core.onewire', '01', _Token('bob'))
+    self.assertEqual(cache.Get('core.onewire', '01'), None)
+
+  def testNegativeEntries(self):
+    cache = tokencache.TokenCache(max_size=10, ttl=60, negative_size=2,
+        negative_ttl=5)
+    now = time.time()
+    cache.PutMissing('core.onewire', '01', now=now)
+    self.assert_(cache.Get('core.onewire', '01', now=now + 4) is
+        tokencache.NO_TOKEN)
+    self.assertEqual(cache.Get('core.onewire', '01', now=now + 6), None)
+    self.assertEqual(cache.negative_hits, 1)
+
+    # Unknown tokens never evict real ones.
+    cache.Put('core.onewire', '02', _Token('bob'), now=now)
+    for value in ('03', '04', '05'):
+      cache.PutMissing('core.onewire', value, now=now)
+    self.assertEqual(cache.evictions, 0)
+    self.assertEqual(cache.Get('core.onewire', '02', now=now).username, 'bob')
+    self.assertEqual(cache.Get('core.onewire', '03', now=now), None)
+    self.assert_(cache.Get('core.onewire', '05', now=now) is
+        tokencache.NO_TOKEN)
+
+    # Assigning a token must clear its negative entry.
+    cache.Invalidate('core.onewire', '05')
+    self.assertEqual(cache.Get('core.onewire', '05', now=now), None)
+
+
+class UnknownTokenLogTestCase(unittest.TestCase):
+  def testBatching(self):
+    log = tokencache.UnknownTokenLog(max_size=2)
+    for value in ('01', '01', '02', '03', '01'):
+      log.Record('core.onewire', value)
+    self.assertEqual(len(log), 2)
+    self.assertEqual(log.dropped, 1)
+    self.assertEqual(log.TakeBatch(),
+        {('core.onewire', '01'): 3, ('core.onewire', '02'): 1})
+    self.assertEqual(len(log), 0)
+    self.assertEqual(log.TakeBatch(), {})
+
+if __name__ == '__main__':
+  unittest.main()
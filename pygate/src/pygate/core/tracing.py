@@ -0,0 +1,176 @@
+# Copyright 2010 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pygate package of the Gatebot project.
+# For more information on Pygate or Gatebot, see http://gatebot.org/
+#
+# Pygate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pygate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pygate.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Latency tracing of a token from the gateboard to its recorded entry.
+
+A traced event carries a |trace_id| and a |trace|: a list of [stage, time]
+stamps, appended to as the event, and the latch and entry that follow from
+it, pass through the client, gatenet server, event hub, managers and
+backend.  When the entry's EntryCreatedEvent is published the trace is
+finished: the time between each pair of consecutive stamps is recorded in a
+histogram named for the pair, and the trace is appended to --trace_log.
+
+Stamps are time.time() values, since a trace crosses processes.
+"""
+
+import logging
+import random
+import threading
+import time
+
+import gflags
+
+from pygate.core import kbjson
+from pygate.core import util
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_boolean('trace_events', False,
+    'If true, gatenet clients start a latency trace on every auth token '
+    'event they send.')
+
+gflags.DEFINE_string('trace_log', '',
+    'If set, each finished latency trace is appended to this file, as one '
+    'JSON object per line.')
+
+gflags.DEFINE_string('trace_histogram_file', '',
+    'If set, the latency histograms are written to this file, as JSON, on '
+    'every status dump.')
+
+
+def NewTraceId():
+  return '%016x' % random.getrandbits(64)
+
+
+def StartTrace(event, stage):
+  """Starts a new trace on |event|."""
+  event.trace_id = NewTraceId()
+  event.trace = [[stage, time.time()]]
+
+
+def Stamp(event, stage):
+  """Records that |event| reached |stage|, if it is traced."""
+  if event.trace_id is not None:
+    event.trace.append([stage, time.time()])
+
+
+def Fork(event, stage):
+  """Returns a copy of |event|'s trace with |stage| stamped on it, or None.
+
+  Used where one event leads to another, such as a token opening a latch,
+  so that the new trace does not see stamps later added to the event.
+  """
+  if event.trace_id is None:
+    return None
+  return Trace(event.trace_id, event.trace + [[stage, time.time()]])
+
+
+class Trace(object):
+  """A trace carried by something other than an event."""
+  def __init__(self, trace_id, stamps):
+    self.trace_id = trace_id
+    self.stamps = stamps
+
+  def Stamp(self, stage):
+    self.stamps.append([stage, time.time()])
+
+  def Copy(self):
+    return Trace(self.trace_id, list(self.stamps))
+
+  def ApplyTo(self, event):
+    """Sets a copy of this trace on |event|."""
+    event.trace_id = self.trace_id
+    event.trace = list(self.stamps)
+
+
+class Tracer(object):
+  """Collects finished traces."""
+  def __init__(self):
+    self._histograms = {}
+    self._lock = threading.Lock()
+    self._logger = logging.getLogger('tracer')
+    self.finished = 0
+
+  def Finish(self, event):
+    """Records the stage latencies of |event|'s trace, if it is traced."""
+    if event.trace_id is None:
+      return
+    stamps = event.trace
+    for (prev_stage, prev_time), (stage, stamp_time) in zip(stamps,
+        stamps[1:]):
+      self._GetHistogram('%s->%s' % (prev_stage, stage)).Record(
+          stamp_time - prev_time)
+    self._GetHistogram('total').Record(stamps[-1][1] - stamps[0][1])
+    self.finished += 1
+    if FLAGS.trace_log:
+      self._WriteLine(FLAGS.trace_log, kbjson.dumps({
+        'trace_id': event.trace_id,
+        'event': event.__class__.__name__,
+        'trace': stamps,
+      }, indent=None))
+
+  @util.synchronized
+  def _GetHistogram(self, name):
+    histogram = self._histograms.get(name)
+    if histogram is None:
+      histogram = self._histograms[name] = util.LatencyHistogram()
+    return histogram
+
+  @util.synchronized
+  def _WriteLine(self, path, line):
+    try:
+      f = open(path, 'a')
+      try:
+        f.write(line + '\n')
+      finally:
+        f.close()
+    except IOError, e:
+      self._logger.warning('Could not write trace to %s: %s' % (path, e))
+
+  def GetHistograms(self):
+    return dict(self._histograms)
+
+  def GetStatus(self):
+    ret = ['traces finished: %i' % self.finished]
+    histograms = self.GetHistograms()
+    for name in sorted(histograms):
+      ret.extend(histograms[name].GetStatus(name))
+    return ret
+
+  def DumpHistograms(self, path):
+    """Writes every histogram to |path| as JSON, for offline analysis."""
+    histograms = self.GetHistograms()
+    data = {
+      'dumped_at': time.time(),
+      'traces': self.finished,
+      'bucket_limits_ms': [1 << i for i in
+          xrange(util.LatencyHistogram.NUM_BUCKETS)],
+      'histograms': dict((name, h.AsDict()) for name, h in
+          histograms.iteritems()),
+    }
+    f = open(path, 'w')
+    try:
+      f.write(kbjson.dumps(data))
+    finally:
+      f.close()
+
+
+_TRACER = Tracer()
+
+def GetTracer():
+  return _TRACER
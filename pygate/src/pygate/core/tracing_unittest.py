@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""Unittest for tracing module"""
+
+import os
+import tempfile
+import unittest
+
+import gflags
+
+from pygate.core import kbevent
+from pygate.core import kbjson
+from pygate.core import tracing
+from pygate.core.net import binproto
+
+FLAGS = gflags.FLAGS
+
+
+class TraceTestCase(unittest.TestCase):
+  def testUntraced(self):
+    event = kbevent.TokenAuthEvent(gate_name='gate0')
+    tracing.Stamp(event, 'hub_dispatch')
+    self.assertEqual(event.trace, None)
+    self.assertEqual(tracing.Fork(event, 'auth_handle'), None)
+    self.assert_('trace_id' not in event.ToDict()['data'])
+
+  def testStampAndFork(self):
+    event = kbevent.TokenAuthEvent(gate_name='gate0')
+    tracing.StartTrace(event, 'client_send')
+    tracing.Stamp(event, 'core_receive')
+    trace = tracing.Fork(event, 'auth_handle')
+    tracing.Stamp(event, 'hub_dispatch')
+    self.assertEqual([s for s, t in event.trace],
+        ['client_send', 'core_receive', 'hub_dispatch'])
+    self.assertEqual([s for s, t in trace.stamps],
+        ['client_send', 'core_receive', 'auth_handle'])
+
+    update = kbevent.LatchUpdate()
+    trace.ApplyTo(update)
+    trace.Stamp('latch_close')
+    self.assertEqual(update.trace_id, event.trace_id)
+    self.assertEqual(len(update.trace), 3)
+
+  def testEncoding(self):
+    event = kbevent.TokenAuthEvent(gate_name='gate0')
+    tracing.StartTrace(event, 'client_send')
+    decoded = kbevent.DecodeEvent(event.ToJson())
+    self.assertEqual(decoded.trace_id, event.trace_id)
+    self.assertEqual(decoded.trace, event.trace)
+    decoded = binproto.DecodeEvent(binproto.EncodeEvent(event)[
+        binproto.FRAME_HEADER_SIZE:])
+    self.assertEqual(decoded.trace, event.trace)
+
+  def testHubStamp(self):
+    hub = kbevent.EventHub()
+    event = kbevent.Ping()
+    tracing.StartTrace(event, 'client_send')
+    hub.PublishEvent(event)
+    hub.DispatchNextEvent(timeout=0)
+    self.assertEqual(event.trace[-1][0], 'hub_dispatch')
+
+
+class TracerTestCase(unittest.TestCase):
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp()
+    os.close(fd)
+    self._old_trace_log = FLAGS.trace_log
+
+  def tearDown(self):
+    FLAGS.trace_log = self._old_trace_log
+    os.unlink(self.path)
+
+  def testFinish(self):
+    FLAGS.trace_log = self.path
+    tracer = tracing.Tracer()
+    event = kbevent.EntryCreatedEvent(trace_id='abc', trace=[
+        ['client_send', 100.0], ['hub_dispatch', 100.003],
+        ['entry_recorded', 100.010]])
+    tracer.Finish(event)
+    tracer.Finish(kbevent.EntryCreatedEvent())
+    self.assertEqual(tracer.finished, 1)
+
+    histograms = tracer.GetHistograms()
+    self.assertEqual(sorted(histograms), ['client_send->hub_dispatch',
+        'hub_dispatch->entry_recorded', 'total'])
+    self.assertEqual(histograms['total'].count, 1)
+    self.assertAlmostEqual(histograms['total'].max, 10.0, 3)
+    self.assertEqual(len(tracer.GetStatus()), 4)
+
+    lines = open(self.path).readlines()
+    self.assertEqual(len(lines), 1)
+    self.assertEqual(kbjson.loads(lines[0]).trace_id, 'abc')
+
+    tracer.DumpHistograms(self.path)
+    dumped = kbjson.loads(open(self.path).read())
+    self.assertEqual(dumped.histograms.total.count, 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,6 +21,7 @@
 import asyncore
 import errno
 import os
+import Queue
 import sys
 import types
 import threading
@@ -126,6 +127,148 @@ class AsyncoreThread(GatebotThread):
     self._logger.info('Quitting')
 
 
+class QueueStats(object):
+  """Counters describing how a queue is being drained in batches."""
+  def __init__(self, name):
+    self.name = name
+    self.batches = 0
+    self.items = 0
+    self.last_batch_size = 0
+    self.max_batch_size = 0
+    self.max_depth = 0
+    # Time from enqueue to dequeue, for queues which record it.
+    self.residence = LatencyHistogram()
+
+  def Record(self, batch_size, remaining):
+    """Records a drained batch of |batch_size| with |remaining| left queued."""
+    self.batches += 1
+    self.items += batch_size
+    self.last_batch_size = batch_size
+    self.max_batch_size = max(self.max_batch_size, batch_size)
+    self.max_depth = max(self.max_depth, batch_size + remaining)
+
+  def RecordResidence(self, seconds):
+    """Records that an item spent |seconds| in the queue."""
+    self.residence.Record(seconds)
+
+  def GetStatus(self, queue):
+    ret = []
+    ret.append('%s queue depth: %i (max %i)' % (self.name, queue.qsize(),
+        self.max_depth))
+    if self.batches:
+      avg = float(self.items) / self.batches
+    else:
+      avg = 0.0
+    ret.append('%s batches: %i, items: %i, batch size last/avg/max: '
+        '%i/%.1f/%i' % (self.name, self.batches, self.items,
+        self.last_batch_size, avg, self.max_batch_size))
+    if self.residence.count:
+      ret.extend(self.residence.GetStatus('%s queue residence' % self.name))
+    return ret
+
+  def AsDict(self, queue):
+    return {
+      'depth': queue.qsize(),
+      'max_depth': self.max_depth,
+      'batches': self.batches,
+      'items': self.items,
+      'max_batch_size': self.max_batch_size,
+      'residence': self.residence.AsDict(),
+    }
+
+
+
+class LatencyHistogram(object):
+  """Counts durations in power-of-two millisecond buckets."""
+  # Bucket i counts durations under 2**i ms; the last bucket is everything
+  # longer.
+  NUM_BUCKETS = 18
+
+  def __init__(self):
+    self.buckets = [0] * (self.NUM_BUCKETS + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self._lock = threading.Lock()
+
+  def Record(self, seconds):
+    ms = seconds * 1000.0
+    i = 0
+    while i < self.NUM_BUCKETS and ms >= (1 << i):
+      i += 1
+    self._lock.acquire()
+    try:
+      self.buckets[i] += 1
+      self.count += 1
+      self.total += ms
+      self.max = max(self.max, ms)
+    finally:
+      self._lock.release()
+
+  def Percentile(self, pct):
+    """Returns an upper bound, in ms, on the |pct| percentile duration."""
+    if not self.count:
+      return 0.0
+    needed = self.count * pct / 100.0
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= needed:
+        if i == self.NUM_BUCKETS:
+          break
+        return min(float(1 << i), self.max)
+    return self.max
+
+  def GetStatus(self, name):
+    if self.count:
+      mean = self.total / self.count
+    else:
+      mean = 0.0
+    return ['%s: count=%i mean=%.1fms p50<=%.1fms p95<=%.1fms p99<=%.1fms '
+        'max=%.1fms' % (name, self.count, mean, self.Percentile(50),
+        self.Percentile(95), self.Percentile(99), self.max)]
+
+  def AsDict(self):
+    return {
+      'count': self.count,
+      'total_ms': self.total,
+      'max_ms': self.max,
+      'p50_ms': self.Percentile(50),
+      'p95_ms': self.Percentile(95),
+      'p99_ms': self.Percentile(99),
+      'buckets': list(self.buckets),
+    }
+
+class CallStats(object):
+  """Call count, total and maximum time for each of a set of keys.
+
+  Record() is meant to be called from a single thread; the other methods may
+  be called from any thread.
+  """
+  def __init__(self):
+    # Maps key to [count, total seconds, max seconds].
+    self._stats = {}
+
+  def Record(self, key, seconds):
+    stats = self._stats.get(key)
+    if stats is None:
+      stats = self._stats[key] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += seconds
+    if seconds > stats[2]:
+      stats[2] = seconds
+
+  def Get(self, key):
+    """Returns (count, total seconds, max seconds) for |key|."""
+    return tuple(self._stats.get(key, (0, 0.0, 0.0)))
+
+  def Items(self):
+    """Returns a list of (key, (count, total, max)), slowest total first."""
+    items = [(key, tuple(stats)) for key, stats in self._stats.items()]
+    items.sort(key=lambda item: item[1][1], reverse=True)
+    return items
+
+
 class AttrDict(dict):
   def __setattr__(self, name, value):
     self.__setitem__(name, value)
@@ -170,6 +313,13 @@ class SimpleGraph:
 
 class DeclarativeMeta(type):
   def __new__(meta, class_name, bases, new_attrs):
+    # __classprepare__ may rewrite the attributes (eg, to add __slots__)
+    # before the class is created; __classinit__ runs after.
+    for base in bases:
+      prepare = getattr(base, '__classprepare__', None)
+      if prepare is not None:
+        new_attrs = prepare(class_name, bases, dict(new_attrs))
+        break
     cls = type.__new__(meta, class_name, bases, new_attrs)
     cls.__classinit__.im_func(cls, new_attrs)
     return cls
@@ -177,6 +327,7 @@ class DeclarativeMeta(type):
 
 class Declarative(object):
   __metaclass__ = DeclarativeMeta
+  __slots__ = ()
   def __classinit__(cls, new_attrs):
     pass
 
@@ -259,6 +410,115 @@ class BaseMessage(Declarative):
     self._values[fieldname] = value
 
 
+class SlotsMessage(Declarative):
+  """A BaseMessage work-alike which stores field values in __slots__.
+
+  The slots and accessors are built once, when each subclass is created.
+  Fields that do not override BaseField.ParseValue are plain slots; others
+  are stored in a '_f_<name>' slot behind a property which parses on set.
+  Unset fields read as None.  Instances have no __dict__, so only declared
+  fields may be assigned.
+  """
+  __slots__ = ()
+  class_fields = {}
+  _fields = class_fields
+  # (field name, slot descriptor) for every field, including inherited ones.
+  _field_slots = ()
+
+  @staticmethod
+  def __classprepare__(class_name, bases, new_attrs):
+    slots = list(new_attrs.get('__slots__', ()))
+    fields = {}
+    for name, value in new_attrs.items():
+      if isinstance(value, BaseField):
+        fields[name] = value
+        del new_attrs[name]
+        if _IsPlainField(value):
+          slots.append(name)
+        else:
+          slots.append('_f_' + name)
+    new_attrs['__slots__'] = tuple(slots)
+    new_attrs['_new_fields'] = fields
+    return new_attrs
+
+  def __classinit__(cls, new_attrs):
+    cls.class_fields = cls.class_fields.copy()
+    cls._fields = cls.class_fields
+    field_slots = list(cls._field_slots)
+    for name, field in new_attrs.get('_new_fields', {}).iteritems():
+      field.name = name
+      cls.class_fields[name] = field
+      if _IsPlainField(field):
+        field_slots.append((name, getattr(cls, name)))
+      else:
+        slot = getattr(cls, '_f_' + name)
+        setattr(cls, name, property(slot.__get__, _MakeParsingSetter(slot,
+            field.ParseValue)))
+        field_slots.append((name, slot))
+    cls._field_slots = tuple(field_slots)
+
+  def __init__(self, initial=None, **kwargs):
+    for name, slot in self._field_slots:
+      slot.__set__(self, None)
+    if initial is not None:
+      self._UpdateFromDict(initial)
+    elif kwargs:
+      self._UpdateFromDict(kwargs)
+
+  def __str__(self):
+    clsname = self.__class__.__name__
+    vallist = []
+    for fieldname, slot in self._field_slots:
+      field = self.class_fields[fieldname]
+      vallist.append('%s=%s' % (fieldname, field.ToString(slot.__get__(self))))
+    valstr = (' '.join(vallist))
+    return '<%s: %s>' % (clsname, valstr)
+
+  def __iter__(self):
+    for name, field in self._GetFields().items():
+      yield field
+
+  def __cmp__(self, other):
+    if not other or type(other) != type(self):
+      return -1
+    return cmp(self.AsDict(), other.AsDict())
+
+  @property
+  def _values(self):
+    """Field values as a new dict, for code written against BaseMessage."""
+    return self.AsDict()
+
+  def _GetFields(self):
+    return self.class_fields
+
+  def _UpdateFromDict(self, d):
+    for k, v in d.iteritems():
+      setattr(self, k, v)
+
+  def AsDict(self):
+    return dict((name, slot.__get__(self)) for name, slot in self._field_slots)
+
+  def SetValue(self, fieldname, value):
+    """Sets a field without parsing |value|."""
+    for name, slot in self._field_slots:
+      if name == fieldname:
+        slot.__set__(self, value)
+        return
+    raise KeyError
+
+
+def _IsPlainField(field):
+  """Returns True if |field| stores values without parsing or validation."""
+  cls = field.__class__
+  return (cls.ParseValue.im_func is BaseField.ParseValue.im_func and
+      cls._Validate.im_func is BaseField._Validate.im_func)
+
+def _MakeParsingSetter(slot, parse):
+  def setter(self, value):
+    slot.__set__(self, parse(value))
+  return setter
+
+
 ### Misc functions
 
 def daemonize():
@@ -299,6 +559,24 @@ def str_to_addr(strdata, default_host='127.0.0.1', default_port=0):
 
   return ip, port
 
+def GetQueueBatch(queue, max_items, timeout=None):
+  """Waits for an item on |queue|, then drains up to |max_items| in total.
+
+  Only the first item is waited for (for up to |timeout| seconds); anything
+  else already queued is taken without blocking.  Returns a possibly-empty
+  list of items.
+  """
+  try:
+    batch = [queue.get(block=True, timeout=timeout)]
+  except Queue.Empty:
+    return []
+  while len(batch) < max_items:
+    try:
+      batch.append(queue.get_nowait())
+    except Queue.Empty:
+      break
+  return batch
+
 def synchronized(f):
   """Decorator that synchronizes a class method with self._lock"""
   def new_f(self, *args, **kwargs):
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Compares util.BaseMessage with util.SlotsMessage.
+
+Reports the time to create, read and write a message shaped like
+kbevent.LatchUpdate, and the memory held by each instance.
+"""
+
+import datetime
+import sys
+import timeit
+
+from pygate.core import util
+
+NUM_ITERATIONS = 100000
+
+class _ParsedField(util.BaseField):
+  def ParseValue(self, value):
+    return int(value)
+
+class DictLatchUpdate(util.BaseMessage):
+  latch_id = _ParsedField()
+  gate_name = util.BaseField()
+  state = util.BaseField()
+  username = util.BaseField()
+  start_time = util.BaseField()
+  last_activity_time = util.BaseField()
+
+class SlotsLatchUpdate(util.SlotsMessage):
+  latch_id = _ParsedField()
+  gate_name = util.BaseField()
+  state = util.BaseField()
+  username = util.BaseField()
+  start_time = util.BaseField()
+  last_activity_time = util.BaseField()
+
+NOW = datetime.datetime.now()
+DICT_MSG = DictLatchUpdate(latch_id=1, gate_name='gate0', start_time=NOW)
+SLOTS_MSG = SlotsLatchUpdate(latch_id=1, gate_name='gate0', start_time=NOW)
+
+BENCHMARKS = (
+  ('create', '%s(latch_id=1, gate_name="gate0", state="active", '
+      'start_time=NOW, last_activity_time=NOW)'),
+  ('create empty', '%s()'),
+  ('get', 'MSG.gate_name'),
+  ('set', 'MSG.gate_name = "gate1"'),
+  ('set parsed', 'MSG.latch_id = 2'),
+)
+
+def _Time(stmt, cls_name, msg_name):
+  stmt = stmt.replace('MSG', msg_name)
+  if '%s' in stmt:
+    stmt = stmt % cls_name
+  total = timeit.Timer(stmt, 'from __main__ import DictLatchUpdate, '
+      'SlotsLatchUpdate, DICT_MSG, SLOTS_MSG, NOW').timeit(NUM_ITERATIONS)
+  return total / NUM_ITERATIONS * 1e6
+
+def _InstanceSize(msg):
+  """Returns the size of |msg|, its __dict__, and any dicts held in it."""
+  size = sys.getsizeof(msg)
+  attrs = getattr(msg, '__dict__', None)
+  if attrs is not None:
+    size += sys.getsizeof(attrs)
+    for value in attrs.itervalues():
+      if isinstance(value, dict):
+        size += sys.getsizeof(value)
+  return size
+
+def main():
+  print '%-14s %12s %12s' % ('', 'dict (us)', 'slots (us)')
+  for name, stmt in BENCHMARKS:
+    print '%-14s %12.3f %12.3f' % (name,
+        _Time(stmt, 'DictLatchUpdate', 'DICT_MSG'),
+        _Time(stmt, 'SlotsLatchUpdate', 'SLOTS_MSG'))
+  print '%-14s %12i %12i' % ('bytes/instance', _InstanceSize(DICT_MSG),
+      _InstanceSize(SLOTS_MSG))
+
+if __name__ == '__main__':
+  main()
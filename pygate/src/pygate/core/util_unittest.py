@@ -2,6 +2,7 @@
 
 """Unittest for util module"""
 
+import Queue
 import unittest
 import util
 
@@ -39,5 +40,88 @@ class SimpleGraphTestCase(unittest.TestCase):
     self.assertEquals(['a', 'c'], self.graph.ShortestPath('a', 'c'))
     self.assertEquals(['a', 'c', 'e', 'f'], self.graph.ShortestPath('a', 'f'))
 
+
+class QueueBatchTestCase(unittest.TestCase):
+  def testBatching(self):
+    q = Queue.Queue()
+    self.assertEqual(util.GetQueueBatch(q, 10, timeout=0), [])
+    for i in xrange(5):
+      q.put(i)
+    self.assertEqual(util.GetQueueBatch(q, 3, timeout=0), [0, 1, 2])
+    self.assertEqual(util.GetQueueBatch(q, 3, timeout=0), [3, 4])
+
+    stats = util.QueueStats('test')
+    stats.Record(3, 2)
+    stats.Record(2, 0)
+    self.assertEqual(stats.batches, 2)
+    self.assertEqual(stats.items, 5)
+    self.assertEqual(stats.max_batch_size, 3)
+    self.assertEqual(stats.max_depth, 5)
+
+class LatencyHistogramTestCase(unittest.TestCase):
+  def testPercentiles(self):
+    h = util.LatencyHistogram()
+    self.assertEqual(h.Percentile(50), 0.0)
+    for i in xrange(98):
+      h.Record(0.0015)
+    h.Record(0.040)
+    h.Record(0.250)
+    self.assertEqual(h.count, 100)
+    self.assertEqual(h.Percentile(50), 2.0)
+    self.assertEqual(h.Percentile(99), 64.0)
+    self.assertEqual(h.Percentile(100), 250.0)
+    self.assertEqual(len(h.GetStatus('test')), 1)
+    self.assertEqual(h.AsDict()['p95_ms'], 2.0)
+    self.assertEqual(sum(h.AsDict()['buckets']), 100)
+
+  def testOverflow(self):
+    h = util.LatencyHistogram()
+    h.Record(3600)
+    self.assertEqual(h.buckets[-1], 1)
+    self.assertEqual(h.Percentile(99), 3600000.0)
+
+
+class _ParsedField(util.BaseField):
+  def ParseValue(self, value):
+    return int(value)
+
+
+class _Message(util.SlotsMessage):
+  name = util.BaseField()
+  count = _ParsedField()
+
+
+class _SubMessage(_Message):
+  extra = util.BaseField()
+
+
+class SlotsMessageTestCase(unittest.TestCase):
+  def testFields(self):
+    msg = _Message(name='foo')
+    self.assertEqual(msg.name, 'foo')
+    self.assertEqual(msg.count, None)
+    msg.count = '3'
+    self.assertEqual(msg.count, 3)
+    msg.SetValue('count', '4')
+    self.assertEqual(msg.count, '4')
+    self.assertRaises(KeyError, msg.SetValue, 'nonexistent', 1)
+    self.assertEqual(msg.AsDict(), {'name': 'foo', 'count': '4'})
+    self.assertEqual(msg._values, msg.AsDict())
+    self.assert_(str(_Message(count=1)).startswith('<_Message: '))
+    self.assert_('count=1' in str(_Message(count=1)))
+
+    # Only declared fields may be set.
+    self.assert_(not hasattr(msg, '__dict__'))
+    self.assertRaises(AttributeError, setattr, msg, 'nonexistent', 1)
+
+  def testInheritance(self):
+    msg = _SubMessage({'name': 'foo', 'count': 2, 'extra': 'bar'})
+    self.assertEqual(msg.AsDict(), {'name': 'foo', 'count': 2, 'extra': 'bar'})
+    self.assertEqual(sorted(_SubMessage.class_fields.keys()),
+        ['count', 'extra', 'name'])
+    self.assertEqual(sorted(_Message.class_fields.keys()), ['count', 'name'])
+    self.assertEqual(msg, _SubMessage(name='foo', count=2, extra='bar'))
+    self.assertNotEqual(msg, _SubMessage(name='foo'))
+
 if __name__ == '__main__':
   unittest.main()
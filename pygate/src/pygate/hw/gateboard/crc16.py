@@ -1,6 +1,12 @@
+import array
+import struct
+import sys
 import types
 
 _CRC16_CCITT_TABLE = []
+_CRC16_CCITT_PAIR_TABLE = None
+
+_DIGEST = struct.Struct('<H')
 
 def _crc16_ccitt_update(crc, byte):
   """CRC-16-CCITT (x^16 + x^12 + x^5 + 1)"""
@@ -23,10 +29,61 @@ def _get_crc16_ccitt_table():
     _CRC16_CCITT_TABLE = ret
   return _CRC16_CCITT_TABLE
 
+def _get_crc16_ccitt_pair_table():
+  """Returns a table advancing the crc over two bytes at once.
+
+  Entry i is the crc after feeding two bytes into a crc register holding i,
+  where the bytes have already been xored into the register (first byte in
+  the low half).
+  """
+  global _CRC16_CCITT_PAIR_TABLE
+  if _CRC16_CCITT_PAIR_TABLE is None:
+    table = _get_crc16_ccitt_table()
+    def step(crc):
+      return (crc >> 8) ^ table[crc & 0xff]
+    _CRC16_CCITT_PAIR_TABLE = array.array('H',
+        (step(step(i)) for i in xrange(0x10000)))
+  return _CRC16_CCITT_PAIR_TABLE
+
+
+class Crc16(object):
+  """Incremental CRC-16-CCITT, matching crc16_ccitt.
+
+  Data may be fed in chunks of any size with update().  Whole chunks are
+  processed two bytes per step using a 64K-entry table.
+  """
+  def __init__(self, data=None):
+    self.crc = 0
+    if data:
+      self.update(data)
+
+  def update(self, data):
+    crc = self.crc
+    even_len = len(data) & ~1
+    if even_len:
+      words = array.array('H')
+      words.fromstring(buffer(data, 0, even_len))
+      if sys.byteorder != 'little':
+        words.byteswap()
+      pair_table = _get_crc16_ccitt_pair_table()
+      for word in words:
+        crc = pair_table[crc ^ word]
+    if even_len != len(data):
+      table = _get_crc16_ccitt_table()
+      last = data[even_len]
+      if type(last) != types.IntType:
+        last = ord(last)
+      crc = (crc >> 8) ^ table[(crc ^ last) & 0xff]
+    self.crc = crc
+
+  def digest(self):
+    """Returns the crc as it is sent on the wire (little endian)."""
+    return _DIGEST.pack(self.crc)
+
+
 def crc16_ccitt(bytes):
-  table = _get_crc16_ccitt_table()
-  crc = 0
-  for byte in bytes:
-    byte = ord(byte)
-    crc = ((crc >> 8) ^ table[(crc ^ byte) & 0xff])
-  return crc
+  return Crc16(bytes).crc
+
+def verify(bytes):
+  """Returns True if |bytes| ends with a valid crc of the bytes before it."""
+  return len(bytes) >= 2 and crc16_ccitt(bytes) == 0
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""Compares crc16 throughput with the byte-at-a-time implementation."""
+
+import os
+import time
+
+from pygate.hw.gateboard import crc16
+
+STREAM_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 4096
+
+def _LegacyCrc16Ccitt(bytes):
+  table = crc16._get_crc16_ccitt_table()
+  crc = 0
+  for byte in bytes:
+    byte = ord(byte)
+    crc = ((crc >> 8) ^ table[(crc ^ byte) & 0xff])
+  return crc
+
+def _Chunked(data):
+  engine = crc16.Crc16()
+  for i in xrange(0, len(data), CHUNK_SIZE):
+    engine.update(data[i:i + CHUNK_SIZE])
+  return engine.crc
+
+def _Throughput(fn, data):
+  start = time.time()
+  result = fn(data)
+  return result, len(data) / (time.time() - start) / 1e6
+
+def main():
+  data = os.urandom(STREAM_SIZE)
+  # Build the tables outside the timed runs.
+  crc16.crc16_ccitt('xx')
+  expected = None
+  for name, fn in (('legacy', _LegacyCrc16Ccitt),
+                   ('crc16_ccitt', crc16.crc16_ccitt),
+                   ('Crc16 %i-byte chunks' % CHUNK_SIZE, _Chunked)):
+    result, rate = _Throughput(fn, data)
+    if expected is None:
+      expected = result
+    assert result == expected
+    print '%-24s %8.2f MB/s' % (name, rate)
+
+if __name__ == '__main__':
+  main()
@@ -13,3 +13,30 @@ class CrcTestCase(unittest.TestCase):
     crc = crc16.crc16_ccitt(data)
     data += struct.pack('<H', crc)
     self.assertEqual(crc16.crc16_ccitt(data), 0)
+
+  def testIncremental(self):
+    data = ''.join(chr(i % 251) for i in xrange(1000))
+    crc = crc16.crc16_ccitt(data)
+    # Reference: the byte-at-a-time table algorithm.
+    table = crc16._get_crc16_ccitt_table()
+    expected = 0
+    for c in data:
+      expected = (expected >> 8) ^ table[(expected ^ ord(c)) & 0xff]
+    self.assertEqual(crc, expected)
+
+    for chunk_size in (1, 2, 3, 7, 64):
+      engine = crc16.Crc16()
+      for i in xrange(0, len(data), chunk_size):
+        engine.update(data[i:i + chunk_size])
+      self.assertEqual(engine.crc, crc)
+      self.assertEqual(engine.digest(), struct.pack('<H', crc))
+
+    self.assertEqual(crc16.Crc16(bytearray(data[:-1])).crc,
+        crc16.crc16_ccitt(data[:-1]))
+
+  def testVerify(self):
+    data = 'GBSP v1:\x01\x00\x04\x00\x01\x02\x03\x00'
+    framed = data + crc16.Crc16(data).digest()
+    self.assert_(crc16.verify(framed))
+    self.assert_(not crc16.verify(framed[:-1] + '\x00'))
+    self.assert_(not crc16.verify(''))
@@ -18,9 +18,11 @@
 
 """Python interfaces to a Gateboard device."""
 
-import cStringIO
 import errno
+import glob
 import logging
+import os
+import select
 import struct
 import string
 
@@ -33,7 +35,8 @@ FLAGS = gflags.FLAGS
 
 gflags.DEFINE_string('gateboard_device', '/dev/ttyACM1',
     'An explicit device file (eg /dev/ttyACM0) on which to listen for gateboard '
-    'packets.')
+    'packets.  The gateboard daemon accepts a comma-separated list of device '
+    'files or glob patterns (eg /dev/ttyACM*).')
 
 gflags.DEFINE_integer('gateboard_speed', 115200,
     'Baud rate of device at --gateboard_device')
@@ -42,6 +45,12 @@ GBSP_PREFIX = "GBSP v1:"
 GBSP_PAYLOAD_MAXLEN = 112
 GBSP_TRAILER = "\r\n"
 
+_HEADER = struct.Struct('<HH')
+_PREFIX_LEN = len(GBSP_PREFIX)
+_HEADER_LEN = _PREFIX_LEN + _HEADER.size
+# CRC and trailer.
+_FOOTER_LEN = 2 + len(GBSP_TRAILER)
+
 class GateboardError(Exception):
   """Generic error with Gateboard"""
 
@@ -66,6 +75,10 @@ class Field(util.BaseField):
   def __init__(self, tagnum):
     self.tagnum = tagnum
 
+  def Decode(self, data, start, length):
+    """Returns the value encoded in string |data| at [start:start+length]."""
+    return self.ParseValue(data[start:start + length])
+
   def ToBytes(self, value):
     raise NotImplementedError
 
@@ -77,15 +90,21 @@ class StructField(Field):
   _STRUCT_FORMAT = '<'
   def __init__(self, tagnum):
     Field.__init__(self, tagnum)
-    self._packed_size = struct.calcsize(self._STRUCT_FORMAT)
+    self._struct = struct.Struct(self._STRUCT_FORMAT)
+    self._packed_size = self._struct.size
 
   def ParseValue(self, value):
     if len(value) != self._packed_size:
       raise ValueError, "Bad length, must be exactly %i bytes" % (self._packed_size,)
-    return struct.unpack(self._STRUCT_FORMAT, value)[0]
+    return self._struct.unpack(value)[0]
+
+  def Decode(self, data, start, length):
+    if length != self._packed_size:
+      raise ValueError, "Bad length, must be exactly %i bytes" % (self._packed_size,)
+    return self._struct.unpack_from(data, start)[0]
 
   def ToBytes(self, value):
-    return struct.pack(self._STRUCT_FORMAT, value)
+    return self._struct.pack(value)
 
 
 class Uint8Field(StructField):
@@ -117,6 +136,9 @@ class StringField(Field):
   def ParseValue(self, bytes):
     return bytes.strip('\x00')
 
+  def Decode(self, data, start, length):
+    return data[start:start + length].strip('\x00')
+
   def ToBytes(self, value):
     return str(value) + '\x00'
 
@@ -128,6 +150,9 @@ class BytesField(Field):
   def ParseValue(self, bytes):
     return bytes
 
+  def Decode(self, data, start, length):
+    return data[start:start + length]
+
   def ToBytes(self, value):
     return value
 
@@ -139,6 +164,9 @@ class OutputField(Uint16Field):
     else:
       return 0
 
+  def Decode(self, data, start, length):
+    return self.ParseValue(data[start:start + length])
+
   def ToString(self, value):
     if value:
       return 'on'
@@ -148,12 +176,83 @@ class OutputField(Uint16Field):
 
 ### Message types
 
-class Message(util.BaseMessage):
+_FIELD_HEADER = struct.Struct('<BB')
+_CRC = struct.Struct('<H')
+
+def _DecodesStruct(field):
+  """Returns True if |field| decodes to exactly its struct's value."""
+  cls = field.__class__
+  return (cls.ParseValue.im_func is StructField.ParseValue.im_func and
+      cls.Decode.im_func is StructField.Decode.im_func)
+
+
+class _MessageCodec(object):
+  """Payload encoder and decoder for one Message subclass.
+
+  Built once per class from its Fields: encoding walks the fields in tag
+  order, and decoding stores each field's value directly in its slot.
+  Fields are decoded at offsets into the payload, so only field values are
+  ever copied out of it.
+  """
+  def __init__(self, cls):
+    slots = dict(cls._field_slots)
+    self._fields = []
+    self._by_tag = {}
+    for name, field in cls.class_fields.iteritems():
+      slot = slots[name]
+      self._fields.append((field.tagnum, field, slot))
+      # Fixed-size fields are unpacked inline, saving a call per field,
+      # unless they parse the unpacked bytes themselves.
+      packer = getattr(field, '_struct', None)
+      if packer is not None and _DecodesStruct(field):
+        self._by_tag[field.tagnum] = (slot.__set__, packer.unpack_from,
+            packer.size, field.Decode)
+      else:
+        self._by_tag[field.tagnum] = (slot.__set__, None, 0, field.Decode)
+    self._fields.sort()
+
+  def Decode(self, message, payload):
+    if not isinstance(payload, str):
+      # Eg a bytearray or memoryview of a read buffer.  Slicing a small
+      # string is cheaper than slicing a memoryview, so copy it once.
+      payload = memoryview(payload).tobytes()
+    end = len(payload)
+    pos = 0
+    by_tag = self._by_tag
+    while pos + 2 <= end:
+      tag, length = _FIELD_HEADER.unpack_from(payload, pos)
+      pos += 2
+      # If field number is known, set its value. (Ignore it otherwise.)
+      entry = by_tag.get(tag)
+      if entry is not None:
+        setter, unpack_from, size, decode = entry
+        if unpack_from is not None and length == size and pos + size <= end:
+          setter(message, unpack_from(payload, pos)[0])
+        else:
+          setter(message, decode(payload, pos, min(length, end - pos)))
+      pos += length
+
+  def Encode(self, message_id, message):
+    parts = []
+    for tagnum, field, slot in self._fields:
+      field_bytes = field.ToBytes(slot.__get__(message))
+      parts.append(_FIELD_HEADER.pack(tagnum, len(field_bytes)))
+      parts.append(field_bytes)
+    payload = ''.join(parts)
+    frame = GBSP_PREFIX + _HEADER.pack(message_id, len(payload)) + payload
+    return frame + _CRC.pack(crc16.crc16_ccitt(frame)) + GBSP_TRAILER
+
+
+class Message(util.SlotsMessage):
+  def __classinit__(cls, new_attrs):
+    util.SlotsMessage.__classinit__.im_func(cls, new_attrs)
+    cls._tag_to_field = {}
+    for field in cls.class_fields.itervalues():
+      cls._tag_to_field[field.tagnum] = field
+    cls._codec = _MessageCodec(cls)
+
   def __init__(self, initial=None, bytes=None, payload_bytes=None, **kwargs):
-    util.BaseMessage.__init__(self, initial, **kwargs)
-    self._tag_to_field = {}
-    for field in self._fields.itervalues():
-      self._tag_to_field[field.tagnum] = field
+    util.SlotsMessage.__init__(self, initial, **kwargs)
     if bytes is not None:
       self.UnpackFromBytes(bytes)
     if payload_bytes is not None:
@@ -173,44 +272,15 @@ class Message(util.BaseMessage):
     if len(payload) != message_len:
       raise ValueError, "Payload size does not match tag"
 
-    # TODO(mikey): assert checked_crc == 0
-    checked_crc = crc16.crc16_ccitt(crcd_bytes)
+    if not crc16.verify(crcd_bytes):
+      raise ValueError, "Bad CRC"
     self.UnpackFromPayload(payload)
 
   def UnpackFromPayload(self, payload):
-    pos = 0
-    payload_len = len(payload)
-    while (pos + 2) <= payload_len:
-      fieldlen = self._ParseField(payload[pos:])
-      pos += 2 + fieldlen
-
-  def _ParseField(self, field_bytes):
-    tag, length = struct.unpack('<BB', field_bytes[:2])
-    data = field_bytes[2:2+length]
-    # If field number is known, set its value. (Ignore it otherwise.)
-    field = self._tag_to_field.get(tag)
-    if field:
-      setattr(self, field.name, data)
-    return length
+    self._codec.Decode(self, payload)
 
   def ToBytes(self):
-    payload = cStringIO.StringIO()
-    for field_name, field in self._fields.iteritems():
-      field_bytes = field.ToBytes(self._values[field_name])
-      payload.write(struct.pack('<BB', field.tagnum, len(field_bytes)))
-      payload.write(field_bytes)
-
-    payload_str = payload.getvalue()
-    payload.close()
-
-    out = cStringIO.StringIO()
-    out.write(GBSP_PREFIX)
-    out.write(struct.pack('<HH', self.MESSAGE_ID, len(payload_str)))
-    out.write(payload_str)
-    crc = crc16.crc16_ccitt(out.getvalue())
-    out.write(struct.pack('<H', crc))
-    out.write('\r\n')
-    return out.getvalue()
+    return self._codec.Encode(self.MESSAGE_ID, self)
 
 class HelloMessage(Message):
   MESSAGE_ID = 0x01
@@ -280,16 +350,35 @@ def GetMessageById(message_id, payload_bytes=None):
 
 
 class GateboardReader(object):
+  """Reads GBSP messages from a serial port or other file-like object.
+
+  Bytes are read in bulk, as many as the device has available, and parsed
+  incrementally: the prefix is found with a bytes search, and frames with a
+  bad length, trailer or CRC are skipped.  Callers with their own I/O loop can
+  instead Feed() bytes and call PopBufferedMessage().
+  """
+  READ_SIZE = 4096
+
   def __init__(self, fd):
     self._logger = logging.getLogger('gateboard-reader')
     self._fd = fd
+    self._buf = bytearray()
+    # Start of unparsed data in _buf; consumed bytes are discarded in bulk.
+    self._pos = 0
+    self._framing_broken = False
+    self.frames = 0
+    self.framing_errors = 0
+    self.crc_errors = 0
 
   def _read(self, count):
     """Wrapper for fd read which handles EAGAIN."""
+    return self._Retry(self._fd.read, count)
+
+  def _Retry(self, read_fn, *args):
     attempts = 0
     while attempts < 100:
       try:
-        return self._fd.read(count)
+        return read_fn(*args)
       except OSError, e:
         if e.errno == errno.EAGAIN:
           attempts += 1
@@ -297,63 +386,214 @@ class GateboardReader(object):
         raise e
     raise RuntimeError('Read caused EAGAIN too many times.')
 
-  def WriteMessage(self, message):
-    if not isinstance(message, Message):
-      raise ValueError, "WriteMessage must be called with a Message instance"
-    self._fd.write(message.ToBytes())
-
-  def GetNextMessage(self):
-    header_pos = 0
-    header_len = len(GBSP_PREFIX)
+  def _ReadAvailable(self):
+    """Blocks for at least one byte, and returns all bytes available."""
+    in_waiting = getattr(self._fd, 'inWaiting', None)
+    if in_waiting is not None:
+      # pyserial: read() blocks until exactly |count| bytes arrive.
+      return self._read(max(1, in_waiting()))
+    fileno = getattr(self._fd, 'fileno', None)
+    if fileno is not None:
+      # Unlike file.read(), os.read() returns as soon as any data is ready.
+      return self._Retry(os.read, fileno(), self.READ_SIZE)
+    return self._read(1)
+
+  def Feed(self, data):
+    """Adds bytes read from the device to the parse buffer."""
+    if self._pos and self._pos * 2 >= len(self._buf):
+      del self._buf[:self._pos]
+      self._pos = 0
+    self._buf.extend(data)
+
+  def _Resync(self, pos, reason):
+    """Discards everything before |pos| after a framing error."""
+    if not self._framing_broken:
+      self._logger.info('Packet framing broken (%s); reframing.' % reason)
+      self._framing_broken = True
+    self.framing_errors += 1
+    self._pos = pos
+
+  def _PopFrame(self):
+    """Returns (message_id, payload) for the next valid frame, or None."""
+    buf = self._buf
     while True:
-      # Find the prefix, re-aligning the messages as needed.
-      logged_frame_error = False
-      while header_pos < header_len:
-        byte = self._read(1)
-        if byte == GBSP_PREFIX[header_pos]:
-          # Got the expected byte.
-          header_pos += 1
-          if logged_frame_error:
-            self._logger.info('Packet framing fixed.')
-            logged_frame_error = False
-        else:
-          # Wrong byte, log the error and start over.
-          if not logged_frame_error:
-            expected = GBSP_PREFIX[header_pos]
-            self._logger.info('Packet framing broken (found %s, expected %s); '
-                              'reframing.' % (repr(byte), repr(expected)))
-            logged_frame_error = True
-          if byte == GBSP_PREFIX[0]:
-            header_pos = 1
-          else:
-            header_pos = 0
-
-      # Read message type and message length.
-      header_bytes = self._read(4)
-      message_id, message_len = struct.unpack('<HH', header_bytes)
+      start = buf.find(GBSP_PREFIX, self._pos)
+      if start < 0:
+        # Keep anything which could be the start of a prefix.
+        keep = max(self._pos, len(buf) - _PREFIX_LEN + 1)
+        if keep > self._pos:
+          self._Resync(keep, 'no prefix in %i bytes' % (keep - self._pos))
+        return None
+      if start > self._pos:
+        self._Resync(start, 'skipped %i bytes' % (start - self._pos))
+
+      if len(buf) - start < _HEADER_LEN:
+        return None
+      message_id, message_len = _HEADER.unpack_from(buffer(buf),
+          start + _PREFIX_LEN)
       if message_len > GBSP_PAYLOAD_MAXLEN:
         self._logger.warning('Bogus message length (%i), skipping message' %
                              message_len)
-        header_pos = 0
+        self._Resync(start + 1, 'bad length')
         continue
 
-      # Read payload and trailer.
-      payload = self._read(message_len)
-      crc = self._read(2)
-      trailer = self._read(2)
-
+      payload_end = start + _HEADER_LEN + message_len
+      end = payload_end + _FOOTER_LEN
+      if len(buf) < end:
+        return None
+      trailer = str(buf[payload_end + 2:end])
       if trailer != GBSP_TRAILER:
         self._logger.warning('Bad trailer (%s), skipping message' %
                              repr(trailer))
-        # Bogus trailer; start over.
-        header_pos = 0
+        self._Resync(start + 1, 'bad trailer')
+        continue
+      if not crc16.verify(buffer(buf, start, payload_end + 2 - start)):
+        self._logger.warning('Bad CRC, skipping message')
+        self.crc_errors += 1
+        self._Resync(start + 1, 'bad crc')
         continue
 
+      if self._framing_broken:
+        self._logger.info('Packet framing fixed.')
+        self._framing_broken = False
+      self._pos = end
+      self.frames += 1
+      payload = str(buf[start + _HEADER_LEN:payload_end])
       if FLAGS.verbose:
-        rawstr = ''.join((header_bytes, payload, crc, trailer))
-        rawstr = bytes_to_hexstr(rawstr)
+        rawstr = bytes_to_hexstr(str(buf[start + _PREFIX_LEN:end]))
         dumpstr = 'ID=%i PAYLOAD=%s' % (message_id, bytes_to_hexstr(payload))
         self._logger.debug('RX: %s' % rawstr)
         self._logger.debug(dumpstr)
+      return message_id, payload
+
+  def PopBufferedMessage(self):
+    """Returns the next message from bytes already read, or None."""
+    frame = self._PopFrame()
+    if frame is None:
+      return None
+    return GetMessageById(*frame)
+
+  def ReadFromDevice(self):
+    """Reads and buffers whatever the device has ready, without blocking.
+
+    Meant to be called once select() reports the device readable.  Returns
+    False if the device has closed.
+    """
+    try:
+      data = self._Retry(os.read, self._fd.fileno(), self.READ_SIZE)
+    except OSError, e:
+      # A tty whose other end has gone away reads as EIO.
+      if e.errno != errno.EIO:
+        raise
+      data = ''
+    if not data:
+      return False
+    self.Feed(data)
+    return True
 
-      return GetMessageById(message_id, payload)
+  def WriteMessage(self, message):
+    if not isinstance(message, Message):
+      raise ValueError, "WriteMessage must be called with a Message instance"
+    self._fd.write(message.ToBytes())
+
+  def GetNextMessage(self):
+    """Blocks until a complete message is read, and returns it.
+
+    Returns None if the device returns no data (end of file, or a read
+    timeout).
+    """
+    while True:
+      frame = self._PopFrame()
+      if frame is not None:
+        return GetMessageById(*frame)
+      data = self._ReadAvailable()
+      if not data:
+        return None
+      self.Feed(data)
+
+
+def ExpandDevicePaths(spec):
+  """Returns the device files named by a comma-separated list of paths or
+  glob patterns.  A pattern which matches nothing is returned verbatim."""
+  ret = []
+  for pattern in spec.split(','):
+    pattern = pattern.strip()
+    if not pattern:
+      continue
+    for path in sorted(glob.glob(pattern)) or [pattern]:
+      if path not in ret:
+        ret.append(path)
+  return ret
+
+
+class GateboardMultiplexer(object):
+  """Reads messages from several gateboard devices on one thread.
+
+  Each device keeps its own GateboardReader, and so its own framing state.
+  Poll() waits on all devices with a single select() and reads only those
+  which are ready.
+  """
+  def __init__(self):
+    self._logger = logging.getLogger('gateboard-mux')
+    self._readers = {}
+    self._names_by_fileno = {}
+
+  def AddDevice(self, name, fd):
+    if name in self._readers:
+      raise ValueError('Device %s already added' % name)
+    self._readers[name] = GateboardReader(fd)
+    self._names_by_fileno[fd.fileno()] = name
+
+  def RemoveDevice(self, name):
+    reader = self._readers.pop(name)
+    del self._names_by_fileno[reader._fd.fileno()]
+    return reader._fd
+
+  def GetDeviceNames(self):
+    return sorted(self._readers.keys())
+
+  def GetReader(self, name):
+    return self._readers[name]
+
+  def WriteMessage(self, name, message):
+    self._readers[name].WriteMessage(message)
+
+  def Poll(self, timeout=None):
+    """Waits up to |timeout| seconds for input from any device.
+
+    Returns a list of (device name, message).  A message of None means the
+    device closed; it has been removed, and its file is left to the caller.
+    """
+    if not self._readers:
+      return []
+    try:
+      readable = select.select(self._names_by_fileno.keys(), [], [],
+          timeout)[0]
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+    ret = []
+    for fileno in readable:
+      name = self._names_by_fileno[fileno]
+      reader = self._readers[name]
+      if not reader.ReadFromDevice():
+        self.RemoveDevice(name)
+        ret.append((name, None))
+        continue
+      while True:
+        # The frame is consumed even if it does not decode, so a bad frame
+        # only costs its own device that one message.
+        try:
+          message = reader.PopBufferedMessage()
+        except UnknownMessageError:
+          self._logger.warning('%s: read unknown message, skipping' % name)
+          continue
+        except (MessageError, ValueError), e:
+          self._logger.warning('%s: read malformed message, skipping: %s' %
+              (name, e))
+          continue
+        if message is None:
+          break
+        ret.append((name, message))
+    return ret
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""Measures GBSP message encoding and decoding throughput.
+
+The per-class codec is compared with the slicing decoder and cStringIO
+encoder it replaced, which are reproduced here.
+"""
+
+import cStringIO
+import struct
+import time
+
+from pygate.hw.gateboard import crc16
+from pygate.hw.gateboard import gateboard
+
+NUM_MESSAGES = 50000
+
+
+def _LegacyUnpackFromPayload(message, payload):
+  pos = 0
+  payload_len = len(payload)
+  while (pos + 2) <= payload_len:
+    field_bytes = payload[pos:]
+    tag, length = struct.unpack('<BB', field_bytes[:2])
+    data = field_bytes[2:2+length]
+    field = message._tag_to_field.get(tag)
+    if field:
+      setattr(message, field.name, data)
+    pos += 2 + length
+
+def _LegacyToBytes(message):
+  payload = cStringIO.StringIO()
+  for field_name, field in message._fields.iteritems():
+    field_bytes = field.ToBytes(getattr(message, field_name))
+    payload.write(struct.pack('<BB', field.tagnum, len(field_bytes)))
+    payload.write(field_bytes)
+  payload_str = payload.getvalue()
+  payload.close()
+
+  out = cStringIO.StringIO()
+  out.write(gateboard.GBSP_PREFIX)
+  out.write(struct.pack('<HH', message.MESSAGE_ID, len(payload_str)))
+  out.write(payload_str)
+  crc = crc16.crc16_ccitt(out.getvalue())
+  out.write(struct.pack('<H', crc))
+  out.write('\r\n')
+  return out.getvalue()
+
+def _Rate(fn, *args):
+  """Returns the best of three runs, in calls per second."""
+  best = None
+  for run in xrange(3):
+    start = time.time()
+    for i in xrange(NUM_MESSAGES):
+      fn(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return NUM_MESSAGES / best
+
+def _Messages():
+  token = gateboard.AuthTokenMessage()
+  token.SetValue('device', 'onewire')
+  token.SetValue('token', '\x01\x02\x03\x04\x05\x06\x07\x08')
+  token.SetValue('status', 1)
+  config = gateboard.ConfigurationMessage()
+  config.SetValue('board_name', 'gateboard')
+  config.SetValue('baud_rate', 9600)
+  config.SetValue('update_interval', 100)
+  return token, config
+
+def main():
+  print '%-24s %14s %14s' % ('', 'legacy msg/s', 'codec msg/s')
+  for message in _Messages():
+    cls = message.__class__
+    payload = message.ToBytes()[12:-4]
+    print '%-24s %14i %14i' % ('decode %s' % cls.__name__,
+        _Rate(lambda: _LegacyUnpackFromPayload(cls(), payload)),
+        _Rate(lambda: cls().UnpackFromPayload(payload)))
+    print '%-24s %14i %14i' % ('encode %s' % cls.__name__,
+        _Rate(_LegacyToBytes, message), _Rate(message.ToBytes))
+
+if __name__ == '__main__':
+  main()
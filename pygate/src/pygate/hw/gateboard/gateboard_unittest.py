@@ -3,9 +3,19 @@
 """Unittest for gateboard module"""
 
 import os
+import pty
+import tty
 import unittest
 import struct
 
+try:
+  import serial
+except ImportError:
+  serial = None
+
+# Defines --verbose, which the reader checks.
+from pygate.core import kb_app
+from pygate.hw.gateboard import crc16
 from pygate.hw.gateboard import gateboard
 
 TESTDATA_PATH = os.path.join(os.path.dirname(gateboard.__file__), 'testdata')
@@ -14,7 +24,7 @@ CAP_FILE = os.path.join(TESTDATA_PATH, 'one_flow_active.bin')
 
 class MessageTestCase(unittest.TestCase):
   def testMessageCreate(self):
-    hello_bytes = gateboard.GBSP_PREFIX + '\x01\x00\x04\x00\x01\x02\x03\x00\x3f\x29\r\n'
+    hello_bytes = gateboard.GBSP_PREFIX + '\x01\x00\x04\x00\x01\x02\x03\x00\x88\x2c\r\n'
     m = gateboard.HelloMessage(bytes=hello_bytes)
     self.assertEqual(m.firmware_version, 3)
 
@@ -22,6 +32,81 @@ class MessageTestCase(unittest.TestCase):
     self.assertEqual(m.firmware_version, 3)
     print m
 
+    corrupt_bytes = hello_bytes[:-4] + '\x00\x00\r\n'
+    self.assertRaises(ValueError, gateboard.GetMessageForBytes, corrupt_bytes)
+
+
+_SAMPLE_VALUES = (
+  (gateboard.OutputField, 1),
+  (gateboard.OnewireIdField, 0x0102030405060708),
+  (gateboard.Uint8Field, 0x12),
+  (gateboard.Uint16Field, 0x1234),
+  (gateboard.Int32Field, -5),
+  (gateboard.Uint32Field, 0x12345678),
+  (gateboard.Uint64Field, 0x0102030405060708),
+  (gateboard.StringField, 'name'),
+  (gateboard.BytesField, '\x00\x01\x02'),
+)
+
+def _SampleMessage(cls):
+  message = cls()
+  for name, field in cls.class_fields.iteritems():
+    for field_cls, value in _SAMPLE_VALUES:
+      if isinstance(field, field_cls):
+        message.SetValue(name, value)
+        break
+  return message
+
+
+class CodecTestCase(unittest.TestCase):
+  def testRoundTrip(self):
+    for message_id, cls in gateboard.MESSAGE_ID_TO_CLASS.iteritems():
+      message = _SampleMessage(cls)
+      message_bytes = message.ToBytes()
+      decoded = gateboard.GetMessageForBytes(message_bytes)
+      self.assertEqual(decoded.AsDict(), message.AsDict())
+      self.assertEqual(decoded.ToBytes(), message_bytes)
+
+      payload = message_bytes[12:-4]
+      decoded = gateboard.GetMessageById(message_id, payload)
+      self.assertEqual(decoded.AsDict(), message.AsDict())
+
+  def testToBytes(self):
+    message = gateboard.ConfigurationMessage()
+    message.SetValue('board_name', 'kb')
+    message.SetValue('baud_rate', 9600)
+    message.SetValue('update_interval', 1)
+    payload = ('\x01\x03kb\x00' + '\x02\x02' + struct.pack('<H', 9600) +
+        '\x03\x02\x01\x00')
+    frame = gateboard.GBSP_PREFIX + struct.pack('<HH', 0x02, len(payload))
+    frame += payload
+    frame += struct.pack('<H', crc16.crc16_ccitt(frame)) + '\r\n'
+    self.assertEqual(message.ToBytes(), frame)
+
+  def testDecodeMatchesFieldParsing(self):
+    # Fields out of order, an unknown tag, and a truncated final field.
+    payload = ('\x03\x02\x01\x00' + '\x09\x01\xff' + '\x02\x02\x80\x25' +
+        '\x01\x08kb')
+    decoded = gateboard.GetMessageById(0x02, payload)
+    expected = gateboard.ConfigurationMessage()
+    expected.update_interval = '\x01\x00'
+    expected.baud_rate = '\x80\x25'
+    expected.board_name = 'kb'
+    self.assertEqual(decoded.AsDict(), expected.AsDict())
+
+    self.assertRaises(ValueError, gateboard.GetMessageById, 0x01,
+        '\x01\x03\x01\x02\x03')
+
+  def testOutputField(self):
+    # Any non-zero reading is "on".
+    for reading in ('\x00\x01', '\x05\x00', '\x01\x00'):
+      decoded = gateboard.GetMessageById(gateboard.OutputCommand.MESSAGE_ID,
+          '\x02\x02' + reading)
+      self.assertEqual(decoded.output_mode, 1)
+    decoded = gateboard.GetMessageById(gateboard.OutputCommand.MESSAGE_ID,
+        '\x02\x02\x00\x00')
+    self.assertEqual(decoded.output_mode, 0)
+
 
 class GateboardReaderTestCase(unittest.TestCase):
   def testBasicUse(self):
@@ -50,6 +135,153 @@ class GateboardReaderTestCase(unittest.TestCase):
   def testAgainstBogusData(self):
     pass
 
+
+def _HelloBytes(version):
+  message = gateboard.HelloMessage()
+  message.SetValue('firmware_version', version)
+  return message.ToBytes()
+
+def _TokenBytes(token):
+  message = gateboard.AuthTokenMessage()
+  message.SetValue('device', 'onewire')
+  message.SetValue('token', token)
+  message.SetValue('status', 1)
+  return message.ToBytes()
+
+
+class StreamingReaderTestCase(unittest.TestCase):
+  def setUp(self):
+    self.master, self.slave = pty.openpty()
+    tty.setraw(self.slave)
+    hello = _HelloBytes(4)
+    corrupt = _HelloBytes(5)
+    corrupt = corrupt[:-4] + chr(ord(corrupt[-4]) ^ 0xff) + corrupt[-3:]
+    self.data = ('noise' + gateboard.GBSP_PREFIX[:4] + hello + corrupt +
+        gateboard.GBSP_PREFIX + _TokenBytes('\x01\x02\x03\x04'))
+
+  def tearDown(self):
+    os.close(self.master)
+    os.close(self.slave)
+
+  def _CheckMessages(self, reader, read_fn):
+    hello = read_fn()
+    self.assert_(isinstance(hello, gateboard.HelloMessage))
+    self.assertEqual(hello.firmware_version, 4)
+    token = read_fn()
+    self.assert_(isinstance(token, gateboard.AuthTokenMessage))
+    self.assertEqual(token.device, 'onewire')
+    self.assertEqual(token.token, '\x01\x02\x03\x04')
+    self.assertEqual(reader.frames, 2)
+    self.assertEqual(reader.crc_errors, 1)
+    self.assert_(reader.framing_errors >= 3)
+
+  def testFeed(self):
+    reader = gateboard.GateboardReader(None)
+    messages = []
+    for c in self.data:
+      reader.Feed(c)
+      message = reader.PopBufferedMessage()
+      if message:
+        messages.append(message)
+    self._CheckMessages(reader, lambda: messages.pop(0))
+    self.assertEqual(reader.PopBufferedMessage(), None)
+
+  def testPty(self):
+    fd = os.fdopen(os.dup(self.slave), 'rb', 0)
+    reader = gateboard.GateboardReader(fd)
+    os.write(self.master, self.data[:20])
+    os.write(self.master, self.data[20:])
+    self._CheckMessages(reader, reader.GetNextMessage)
+    fd.close()
+
+  @unittest.skipIf(serial is None, 'pyserial not installed')
+  def testPyserial(self):
+    fd = serial.Serial(os.ttyname(self.slave), timeout=0.2)
+    reader = gateboard.GateboardReader(fd)
+    os.write(self.master, self.data)
+    self._CheckMessages(reader, reader.GetNextMessage)
+    # Read timeout.
+    self.assertEqual(reader.GetNextMessage(), None)
+    fd.close()
+
+class MultiplexerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.ptys = []
+    self.mux = gateboard.GateboardMultiplexer()
+    for name in ('board0', 'board1'):
+      master, slave = pty.openpty()
+      tty.setraw(slave)
+      self.ptys.append((master, slave))
+      self.mux.AddDevice(name, os.fdopen(os.dup(slave), 'r+b', 0))
+
+  def tearDown(self):
+    for name in self.mux.GetDeviceNames():
+      self.mux.RemoveDevice(name).close()
+    for master, slave in self.ptys:
+      for fd in (master, slave):
+        try:
+          os.close(fd)
+        except OSError:
+          pass
+
+  def _PollUntil(self, count):
+    ret = []
+    for i in xrange(20):
+      ret.extend(self.mux.Poll(timeout=0.1))
+      if len(ret) >= count:
+        break
+    return ret
+
+  def testMultipleDevices(self):
+    (master0, slave0), (master1, slave1) = self.ptys
+    hello = _HelloBytes(4)
+    token = _TokenBytes('\x01\x02\x03\x04')
+    # Interleave partial frames; each device keeps its own framing state.
+    os.write(master0, hello[:7])
+    os.write(master1, token[:3])
+    self.assertEqual(self.mux.Poll(timeout=0.1), [])
+    os.write(master1, token[3:] + hello)
+    os.write(master0, hello[7:])
+    received = self._PollUntil(3)
+    by_name = {}
+    for name, message in received:
+      by_name.setdefault(name, []).append(message.__class__)
+    self.assertEqual(by_name['board0'], [gateboard.HelloMessage])
+    self.assertEqual(by_name['board1'],
+        [gateboard.AuthTokenMessage, gateboard.HelloMessage])
+
+    self.mux.WriteMessage('board1', gateboard.PingCommand())
+    self.assertEqual(os.read(master1, 100), gateboard.PingCommand().ToBytes())
+
+    # A device which goes away is reported once and removed.
+    os.close(master0)
+    self.assertEqual(self._PollUntil(1), [('board0', None)])
+    self.assertEqual(self.mux.GetDeviceNames(), ['board1'])
+
+  def testMalformedMessage(self):
+    (master0, slave0), (master1, slave1) = self.ptys
+    # A frame with a good CRC, whose 16-bit field is 3 bytes long.
+    payload = '\x01\x03\x01\x02\x03'
+    frame = gateboard.GBSP_PREFIX + struct.pack('<HH', 0x01, len(payload))
+    frame += payload
+    frame += struct.pack('<H', crc16.crc16_ccitt(frame)) + '\r\n'
+    os.write(master0, frame + _HelloBytes(4))
+    os.write(master1, _HelloBytes(5))
+    received = self._PollUntil(2)
+    self.assertEqual(sorted((name, message.firmware_version)
+        for name, message in received), [('board0', 4), ('board1', 5)])
+
+  def testExpandDevicePaths(self):
+    names = [os.ttyname(slave) for master, slave in self.ptys]
+    self.assertEqual(gateboard.ExpandDevicePaths(' , '.join(names)), names)
+    pattern = os.path.join(os.path.dirname(names[0]), '*')
+    expanded = gateboard.ExpandDevicePaths(pattern + ',' + names[0])
+    for name in names:
+      self.assert_(name in expanded)
+    self.assertEqual(len(expanded), len(set(expanded)))
+    self.assertEqual(gateboard.ExpandDevicePaths('/dev/nonexistent*'),
+        ['/dev/nonexistent*'])
+
 if __name__ == '__main__':
   import logging
   logging.basicConfig()
@@ -76,6 +76,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'pygate.web.middleware.KegbotSiteMiddleware',
+    'pygate.web.middleware.CoreNotifierMiddleware',
     'django.middleware.doc.XViewMiddleware',
 )
 
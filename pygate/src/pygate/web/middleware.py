@@ -1,4 +1,13 @@
+import logging
+import socket
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from pygate.core import kb_common
+from pygate.core import kbevent
 from pygate.core import models
+from pygate.core.net import gatenet
 
 class KegbotSiteMiddleware:
   def process_request(self, request):
@@ -7,3 +16,29 @@ class KegbotSiteMiddleware:
       if 'site' in request.GET:
         sitename = request.GET['site']
       request.kbsite = models.GatebotSite.objects.get(name=sitename)
+
+
+def _NotifyCore(sender, auth_device=None, token_value=None, **kwargs):
+  addr = getattr(settings, 'KB_CORE_ADDR', kb_common.KB_CORE_DEFAULT_ADDR)
+  event = kbevent.AuthTokenChangedEvent(auth_device=auth_device,
+      token_value=token_value)
+  try:
+    gatenet.SendEvent(event, addr)
+  except socket.error, e:
+    # The core will still see the change once its cached copy expires.
+    logging.getLogger('web').warning('Could not tell the core about a token '
+        'change: %s' % e)
+
+
+class CoreNotifierMiddleware:
+  """Tells the core when a token or user is changed through the web, so that
+  it drops its cached copy rather than waiting for it to expire.
+
+  The core does not see these changes otherwise: the models' signals are
+  only sent in the process that saves them.  This only connects a signal
+  handler, when the web app starts; it handles no requests.
+  """
+  def __init__(self):
+    models.auth_token_changed.connect(_NotifyCore, weak=False,
+        dispatch_uid='pygate.web.middleware.CoreNotifierMiddleware')
+    raise MiddlewareNotUsed